@@ -166,6 +166,9 @@ _C.DATASETS.NO_RANDOM_PACK_PROBABILITY = 0.0
 _C.DATASETS.SAFEGUARD_POSITIVE_CAPTION = True
 _C.DATASETS.CAPTION_FORMAT_VERSION = "v1"
 _C.DATASETS.LOCAL_DEBUG = False
+# root of the training image caches (tools/build_image_cache.py), one sub directory per dataset,
+# used by the datasets that have one
+_C.DATASETS.IMAGE_CACHE_DIR = ""
 
 
 # Od in the wild
@@ -202,6 +205,11 @@ _C.DATALOADER.MIN_KPS_PER_IMS = 0
 _C.DATALOADER.USE_RANDOM_SEED = False
 
 _C.DATALOADER.DISTRIBUTE_CHUNK_AMONG_NODE = False
+# If > 0, shuffle blocks of that many consecutive samples instead of single samples (LocalitySampler),
+# so that tsv rows are mostly read in file order
+_C.DATALOADER.LOCALITY_BLOCK_SIZE = 0
+# Samples are shuffled within windows of that many positions of the block order, 0 for one block
+_C.DATALOADER.LOCALITY_WINDOW = 0
 # ---------------------------------------------------------------------------- #
 # Backbone options
 # ---------------------------------------------------------------------------- #
@@ -270,6 +278,8 @@ _C.MODEL.LANGUAGE_BACKBONE.CORPUS_PATH = ""
 _C.MODEL.LANGUAGE_BACKBONE.VOCAB_SIZE = 0
 
 _C.MODEL.LANGUAGE_BACKBONE.PAD_MAX = True
+# number of prompts whose language features are cached at inference, 0 to disable
+_C.MODEL.LANGUAGE_BACKBONE.FEATURE_CACHE_SIZE = 0
 # ---------------------------------------------------------------------------- #
 # FPN options
 # ---------------------------------------------------------------------------- #
@@ -488,6 +498,10 @@ _C.MODEL.DYHEAD.FUSE_CONFIG.CLAMP_MAX_FOR_OVERFLOW = False
 _C.MODEL.DYHEAD.FUSE_CONFIG.CLAMP_BERTATTN_MIN_FOR_UNDERFLOW = False
 _C.MODEL.DYHEAD.FUSE_CONFIG.CLAMP_BERTATTN_MAX_FOR_OVERFLOW = False
 _C.MODEL.DYHEAD.FUSE_CONFIG.CLAMP_DOT_PRODUCT = False
+# run the image-text cross attention through F.scaled_dot_product_attention (torch >= 2.0)
+_C.MODEL.DYHEAD.FUSE_CONFIG.USE_FUSED_ATTN = False
+# image tokens per chunk of the image-text cross attention, bounds its memory at high resolution; 0 disables
+_C.MODEL.DYHEAD.FUSE_CONFIG.ATTN_CHUNK_SIZE = 0
 
 # MLM Loss
 _C.MODEL.DYHEAD.FUSE_CONFIG.MLM_LOSS = False
@@ -531,6 +545,8 @@ _C.MODEL.RPN.USE_RELATIVE_SIZE = False
 # Remove RPN anchors that go outside the image by RPN_STRADDLE_THRESH pixels
 # Set to -1 or a large value, e.g. 100000, to disable pruning anchors
 _C.MODEL.RPN.STRADDLE_THRESH = 0
+# Number of (feature map sizes, image size) anchor sets kept by the anchor generator, 0 to disable
+_C.MODEL.RPN.ANCHOR_CACHE_SIZE = 32
 # Anchor scales per octave for complex anchors
 _C.MODEL.RPN.OCTAVE = 2.0
 _C.MODEL.RPN.SCALES_PER_OCTAVE = 3
@@ -707,6 +723,8 @@ _C.MODEL.SWINT.APE = False
 _C.MODEL.SWINT.VERSION = "v1"
 _C.MODEL.SWINT.OUT_NORM = True
 _C.MODEL.SWINT.LAYER_SCALE = 0
+# run WindowAttention through F.scaled_dot_product_attention (torch >= 2.0), swint v1 only
+_C.MODEL.SWINT.USE_FUSED_ATTN = False
 
 # ---------------------------------------------------------------------------- #
 # CVT SPEC
@@ -838,6 +856,8 @@ _C.TEST.NUM_CLASSES = 81
 _C.TEST.SELECT_CLASSES = ()
 
 _C.TEST.EVAL_TASK = ""
+# inference precision: "fp32", or "fp16" / "bf16" autocast with the overflow-sensitive ops kept in fp32
+_C.TEST.PRECISION = "fp32"
 _C.TEST.SUBSET = -1
 _C.TEST.CHUNKED_EVALUATION = -1
 _C.TEST.MDETR_STYLE_AGGREGATE_CLASS_NUM = -1
@@ -17,6 +17,7 @@ from .transforms import build_transforms
 
 from transformers import AutoTokenizer
 from .datasets.duplicate_dataset import create_duplicate_dataset
+from .datasets.image_cache import ImageCache, image_cache_sizes
 
 def build_dataset(cfg, dataset_list, transforms, dataset_catalog, is_train=True, class_concat=False, extra_args={}):
     """
@@ -98,6 +99,17 @@ def build_dataset(cfg, dataset_list, transforms, dataset_catalog, is_train=True,
 
         print(dataset_name, 'has the {} data points'.format(len(dataset)), data["factory"])
 
+        if is_train and cfg.DATASETS.IMAGE_CACHE_DIR and getattr(dataset, "supports_image_cache", False):
+            dataset.image_cache_dir = os.path.join(cfg.DATASETS.IMAGE_CACHE_DIR, dataset_name)
+            if ImageCache.exists(dataset.image_cache_dir):
+                image_cache = ImageCache(dataset.image_cache_dir)
+                min_size, max_size = image_cache_sizes(cfg)
+                if image_cache.min_size >= min_size and image_cache.max_size >= max_size:
+                    dataset.image_cache = image_cache
+                    print(dataset_name, 'reads {} cached images from {}'.format(len(image_cache), image_cache.cache_dir))
+                else:
+                    print(dataset_name, 'ignores {}, it was built for smaller images'.format(image_cache))
+
         if class_concat:
             category = list(dataset.contiguous_category_id_to_json_id.values())
             dataset.contiguous_category_id_to_json_id = {}
@@ -193,7 +205,16 @@ def build_dataset_by_group(dataset_list, transforms, dataset_catalog, is_train=T
     return grouped_datasets
 
 
-def make_data_sampler(dataset, shuffle, distributed, num_replicas=None, rank=None, use_random_seed=True):
+def make_data_sampler(dataset, shuffle, distributed, num_replicas=None, rank=None, use_random_seed=True,
+                      locality_block_size=0, locality_window=0):
+    if shuffle and locality_block_size > 0:
+        if distributed:
+            num_replicas = num_replicas or dist.get_world_size()
+            rank = dist.get_rank() if rank is None else rank
+        else:
+            num_replicas, rank = 1, 0
+        return samplers.LocalitySampler(dataset, locality_block_size, window=locality_window,
+                                        num_replicas=num_replicas, rank=rank, use_random=use_random_seed)
     if distributed:
         return samplers.DistributedSampler(dataset, shuffle=shuffle, num_replicas=num_replicas, rank=rank,
                                            use_random=use_random_seed)
@@ -461,7 +482,9 @@ def make_data_loader(cfg, is_train=True, is_distributed=False, num_replicas=None
             )
         else:
             sampler = make_data_sampler(dataset, shuffle, is_distributed, num_replicas=num_replicas, rank=rank,
-                                        use_random_seed=cfg.DATALOADER.USE_RANDOM_SEED)
+                                        use_random_seed=cfg.DATALOADER.USE_RANDOM_SEED,
+                                        locality_block_size=cfg.DATALOADER.LOCALITY_BLOCK_SIZE,
+                                        locality_window=cfg.DATALOADER.LOCALITY_WINDOW)
         batch_sampler = make_batch_data_sampler(
             dataset, sampler, aspect_grouping, images_per_gpu, num_iters, start_iter, drop_last=is_train
         )
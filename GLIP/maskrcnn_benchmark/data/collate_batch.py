@@ -89,15 +89,6 @@ class BatchGroundingCollator(object):
         origin_images = transposed_batch[6]
         idx = transposed_batch[7]
 
-        # compute batched positive map
-        max_len = max([v.shape[1] for v in positive_maps])
-        nb_boxes = sum([v.shape[0] for v in positive_maps])
-        batched_pos_map = torch.zeros((nb_boxes, max_len), dtype=torch.bool)
-        cur_count = 0
-        for cur_pos in positive_maps:
-            batched_pos_map[cur_count: cur_count + len(cur_pos), : cur_pos.shape[1]] = cur_pos
-            cur_count += len(cur_pos)
-
         max_size = tuple(max(s) for s in zip(*[img.shape for img in images]))
         if self.size_divisible > 0:
             import math
@@ -115,8 +106,8 @@ class BatchGroundingCollator(object):
 
         image_sizes = [im.shape[-2:] for im in images]
 
-        assert cur_count == len(batched_pos_map)
-        positive_map = batched_pos_map.bool()
+        # one positive map per image, so that each image is only scored against its own entities
+        positive_map = [v.bool() for v in positive_maps]
 
         return batched_imgs, image_sizes, captions, positive_map, entities, new_to_old_entity_list, new_entity_to_id_list, origin_images, idx
 
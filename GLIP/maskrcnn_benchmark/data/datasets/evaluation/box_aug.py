@@ -9,16 +9,24 @@ from maskrcnn_benchmark.structures.boxlist_ops import cat_boxlist
 from maskrcnn_benchmark.layers import nms, soft_nms
 
 
-def im_detect_bbox_aug(model, images, device, captions=None, positive_map_label_to_token=None):
+def im_detect_bbox_aug(model, images, device, captions=None, positive_map_label_to_token=None, queries=None):
+    """
+    Test time augmented detection. If `queries`, a list of (captions, positive_map_label_to_token)
+    pairs, is given, every query is run on each augmented image with the visual backbone
+    shared across queries, and a list with the results of each query is returned.
+    """
+    multi_query = queries is not None
+    if not multi_query:
+        queries = [(captions, positive_map_label_to_token)]
+
     # Collect detections computed under different transformations
-    boxlists_ts = []
-    for _ in range(len(images)):
-        boxlists_ts.append([])
+    boxlists_ts = [[[] for _ in range(len(images))] for _ in queries]
 
-    def add_preds_t(boxlists_t):
-        for i, boxlist_t in enumerate(boxlists_t):
-            # Resize the boxlist as the first one
-            boxlists_ts[i].append(boxlist_t.resize(images[i].size))
+    def add_preds_t(boxlists_t_per_query):
+        for query_i, boxlists_t in enumerate(boxlists_t_per_query):
+            for i, boxlist_t in enumerate(boxlists_t):
+                # Resize the boxlist as the first one
+                boxlists_ts[query_i][i].append(boxlist_t.resize(images[i].size))
 
     # Compute detections at different scales
     if len(cfg.TEST.RANGES)==len(cfg.TEST.SCALES):
@@ -30,44 +38,67 @@ def im_detect_bbox_aug(model, images, device, captions=None, positive_map_label_
         max_size = cfg.TEST.MAX_SIZE
         boxlists_scl = im_detect_bbox_scale(
             model, images, scale, max_size, device,
-            captions=captions,
-            positive_map_label_to_token=positive_map_label_to_token,
+            queries=queries,
         )
         if keep_range is not None:
-            boxlists_scl = remove_boxes(boxlists_scl, *keep_range)
+            boxlists_scl = [remove_boxes(b, *keep_range) for b in boxlists_scl]
         add_preds_t(boxlists_scl)
 
         if cfg.TEST.FLIP:
             boxlists_scl_hf = im_detect_bbox_scale(
                 model, images, scale, max_size, device,
-                captions=captions,
-                positive_map_label_to_token=positive_map_label_to_token,
+                queries=queries,
                 hflip=True
             )
             if keep_range is not None:
-                boxlists_scl_hf = remove_boxes(boxlists_scl_hf, *keep_range)
+                boxlists_scl_hf = [remove_boxes(b, *keep_range) for b in boxlists_scl_hf]
             add_preds_t(boxlists_scl_hf)
 
     # Merge boxlists detected by different bbox aug params
-    boxlists = []
-    for i, boxlist_ts in enumerate(boxlists_ts):
-        bbox = torch.cat([boxlist_t.bbox for boxlist_t in boxlist_ts])
-        scores = torch.cat([boxlist_t.get_field('scores') for boxlist_t in boxlist_ts])
-        labels = torch.cat([boxlist_t.get_field('labels') for boxlist_t in boxlist_ts])
-        boxlist = BoxList(bbox, boxlist_ts[0].size, boxlist_ts[0].mode)
-        boxlist.add_field('scores', scores)
-        boxlist.add_field('labels', labels)
-        boxlists.append(boxlist)
-    results = merge_result_from_multi_scales(boxlists)
-    return results
+    all_results = []
+    for boxlists_ts_q in boxlists_ts:
+        boxlists = []
+        for i, boxlist_ts in enumerate(boxlists_ts_q):
+            bbox = torch.cat([boxlist_t.bbox for boxlist_t in boxlist_ts])
+            scores = torch.cat([boxlist_t.get_field('scores') for boxlist_t in boxlist_ts])
+            labels = torch.cat([boxlist_t.get_field('labels') for boxlist_t in boxlist_ts])
+            boxlist = BoxList(bbox, boxlist_ts[0].size, boxlist_ts[0].mode)
+            boxlist.add_field('scores', scores)
+            boxlist.add_field('labels', labels)
+            boxlists.append(boxlist)
+        all_results.append(merge_result_from_multi_scales(boxlists))
+    if not multi_query:
+        return all_results[0]
+    return all_results
+
+
+def _run_queries(model, images, queries):
+    """
+    Run every (captions, positive_map) query on the same images, computing the
+    visual backbone only once when the model supports it.
+    """
+    if len(queries) == 1:
+        captions, positive_map_label_to_token = queries[0]
+        if captions is None:
+            return [model(images)]
+        return [model(images, captions=captions, positive_map=positive_map_label_to_token)]
+    detector = model.module if hasattr(model, "module") else model
+    if hasattr(detector, "forward_multi_query"):
+        return detector.forward_multi_query(images,
+                                            [query[0] for query in queries],
+                                            [query[1] for query in queries])
+    return [model(images, captions=captions, positive_map=positive_map_label_to_token)
+            for captions, positive_map_label_to_token in queries]
 
 
 def im_detect_bbox(model, images, target_scale, target_max_size, device,
                    captions=None,
-                   positive_map_label_to_token=None
+                   positive_map_label_to_token=None,
+                   queries=None
                    ):
     """
     Performs bbox detection on the original image.
+    With `queries`, returns a list with the detections of each query.
     """
     if cfg.INPUT.FORMAT is not '':
         input_format = cfg.INPUT.FORMAT
@@ -82,18 +113,15 @@ def im_detect_bbox(model, images, target_scale, target_max_size, device,
     ])
     images = [transform(image) for image in images]
     images = to_image_list(images, cfg.DATALOADER.SIZE_DIVISIBILITY)
-    if captions is None:
-        return model(images.to(device))
-    else:
-        return model(images.to(device),
-                     captions=captions,
-                     positive_map=positive_map_label_to_token
-                     )
+    if queries is not None:
+        return _run_queries(model, images.to(device), queries)
+    return _run_queries(model, images.to(device), [(captions, positive_map_label_to_token)])[0]
 
 
 def im_detect_bbox_hflip(model, images, target_scale, target_max_size, device,
                          captions=None,
-                         positive_map_label_to_token=None
+                         positive_map_label_to_token=None,
+                         queries=None
                          ):
     """
     Performs bbox detection on the horizontally flipped image.
@@ -113,23 +141,23 @@ def im_detect_bbox_hflip(model, images, target_scale, target_max_size, device,
     ])
     images = [transform(image) for image in images]
     images = to_image_list(images, cfg.DATALOADER.SIZE_DIVISIBILITY)
-    if captions is None:
-        boxlists = model(images.to(device))
-    else:
-        boxlists = model(images.to(device),
-                         captions=captions,
-                         positive_map=positive_map_label_to_token
-                         )
+    multi_query = queries is not None
+    if not multi_query:
+        queries = [(captions, positive_map_label_to_token)]
+    boxlists_per_query = _run_queries(model, images.to(device), queries)
 
     # Invert the detections computed on the flipped image
-    boxlists_inv = [boxlist.transpose(0) for boxlist in boxlists]
+    boxlists_inv = [[boxlist.transpose(0) for boxlist in boxlists] for boxlists in boxlists_per_query]
+    if not multi_query:
+        return boxlists_inv[0]
     return boxlists_inv
 
 
 def im_detect_bbox_scale(model, images, target_scale, target_max_size, device,
                          captions=None,
                          positive_map_label_to_token=None,
-                         hflip=False):
+                         hflip=False,
+                         queries=None):
     """
     Computes bbox detections at the given scale.
     Returns predictions in the scaled image space.
@@ -137,12 +165,14 @@ def im_detect_bbox_scale(model, images, target_scale, target_max_size, device,
     if hflip:
         boxlists_scl = im_detect_bbox_hflip(model, images, target_scale, target_max_size, device,
                                             captions=captions,
-                                            positive_map_label_to_token=positive_map_label_to_token
+                                            positive_map_label_to_token=positive_map_label_to_token,
+                                            queries=queries
                                             )
     else:
         boxlists_scl = im_detect_bbox(model, images, target_scale, target_max_size, device,
                                       captions=captions,
-                                      positive_map_label_to_token=positive_map_label_to_token
+                                      positive_map_label_to_token=positive_map_label_to_token,
+                                      queries=queries
                                       )
     return boxlists_scl
 
@@ -0,0 +1,135 @@
+"""
+Cache of decoded training images, downscaled once to the largest training resolution.
+
+A cache directory holds uint8 HxWx3 RGB arrays stored back to back in shard_*.bin files,
+memory-mapped when read, plus a small index: index.npy (shard, offset and sizes of every
+image) and index.json (the image keys and the sizes the cache was built for).
+"""
+import json
+import os
+import os.path as op
+
+import numpy as np
+from PIL import Image
+
+INDEX_DTYPE = np.dtype([('shard', '<i4'), ('offset', '<i8'), ('height', '<i4'), ('width', '<i4'),
+                        ('orig_height', '<i4'), ('orig_width', '<i4')])
+
+
+def image_cache_sizes(cfg):
+    """(min_size, max_size) of the cached images: the largest training Resize"""
+    min_size = cfg.AUGMENT.MULT_MIN_SIZE_TRAIN or cfg.INPUT.MIN_SIZE_TRAIN
+    if not isinstance(min_size, (list, tuple)):
+        min_size = (min_size,)
+    return max(min_size), cfg.INPUT.MAX_SIZE_TRAIN
+
+
+def _shard_path(cache_dir, shard):
+    return op.join(cache_dir, 'shard_{:05d}.bin'.format(shard))
+
+
+def write_image_cache(cache_dir, keys, load_image, min_size, max_size, shard_bytes=1 << 30):
+    """
+    Arguments:
+        cache_dir (str): created if needed, an existing cache is replaced
+        keys (list[str]): image key of every index of the dataset, repeated keys are stored once
+        load_image (callable): index -> PIL image at its original size
+        min_size, max_size (int): images are downscaled like Resize(min_size, max_size) would,
+            smaller images are stored as they are
+    """
+    from maskrcnn_benchmark.data.transforms.transforms import Resize
+
+    resize = Resize(min_size, max_size)
+    os.makedirs(cache_dir, exist_ok=True)
+    stored_keys, entries = [], []
+    seen = set()
+    shard, offset = 0, 0
+    fp = open(_shard_path(cache_dir, shard) + '.tmp', 'wb')
+    for i, key in enumerate(keys):
+        if key in seen:
+            continue
+        seen.add(key)
+        img = load_image(i).convert('RGB')
+        orig_width, orig_height = img.size
+        height, width = resize.get_size(img.size)
+        if height * width < orig_height * orig_width:
+            img = img.resize((width, height), Image.BILINEAR)
+        array = np.asarray(img, dtype=np.uint8)
+        if offset > 0 and offset + array.nbytes > shard_bytes:
+            fp.close()
+            shard, offset = shard + 1, 0
+            fp = open(_shard_path(cache_dir, shard) + '.tmp', 'wb')
+        fp.write(array.tobytes())
+        stored_keys.append(key)
+        entries.append((shard, offset, array.shape[0], array.shape[1], orig_height, orig_width))
+        offset += array.nbytes
+    fp.close()
+
+    for i in range(shard + 1):
+        os.replace(_shard_path(cache_dir, i) + '.tmp', _shard_path(cache_dir, i))
+    np.save(op.join(cache_dir, 'index.npy'), np.array(entries, dtype=INDEX_DTYPE))
+    # index.json last, ImageCache.exists looks for it
+    with open(op.join(cache_dir, 'index.json.tmp'), 'w') as fp:
+        json.dump({'min_size': min_size, 'max_size': max_size, 'keys': stored_keys}, fp)
+    os.replace(op.join(cache_dir, 'index.json.tmp'), op.join(cache_dir, 'index.json'))
+
+
+class ImageCache(object):
+    """
+    Read side of write_image_cache. get(key) returns the downscaled image with the original
+    image size, the dataset builds its target at the original size and resizes it to the image.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        with open(op.join(cache_dir, 'index.json'), 'r') as fp:
+            meta = json.load(fp)
+        self.min_size = meta['min_size']
+        self.max_size = meta['max_size']
+        self._key_to_row = {key: row for row, key in enumerate(meta['keys'])}
+        self._index = np.load(op.join(cache_dir, 'index.npy'))
+        self._shards = {}
+        self.pid = None
+
+    @staticmethod
+    def exists(cache_dir):
+        return op.isfile(op.join(cache_dir, 'index.json'))
+
+    def __getstate__(self):
+        # workers map the shards themselves
+        state = self.__dict__.copy()
+        state['_shards'] = {}
+        return state
+
+    def __str__(self):
+        return "ImageCache(cache_dir='{}')".format(self.cache_dir)
+
+    def __repr__(self):
+        return str(self)
+
+    def __len__(self):
+        return len(self._key_to_row)
+
+    def __contains__(self, key):
+        return key in self._key_to_row
+
+    def get(self, key):
+        """
+        Returns:
+            (PIL.Image, (int, int)): the cached image and the (width, height) of the original,
+                None when key is not cached
+        """
+        row = self._key_to_row.get(key)
+        if row is None:
+            return None
+        shard, offset, height, width, orig_height, orig_width = self._index[row].tolist()
+        array = self._shard(shard)[offset:offset + height * width * 3].reshape(height, width, 3)
+        return Image.fromarray(array, 'RGB'), (orig_width, orig_height)
+
+    def _shard(self, shard):
+        if self.pid != os.getpid():
+            self._shards = {}
+            self.pid = os.getpid()
+        if shard not in self._shards:
+            self._shards[shard] = np.memmap(_shard_path(self.cache_dir, shard), dtype=np.uint8, mode='r')
+        return self._shards[shard]
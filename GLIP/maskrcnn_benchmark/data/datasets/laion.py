@@ -2,12 +2,16 @@ import os
 import io
 import numpy as np
 from PIL import Image
-import webdataset as wds
 import torch.utils.data as data
 import re
 import math
 import torch
 from GLIP.maskrcnn_benchmark.structures.image_list import to_image_list
+from GLIP.maskrcnn_benchmark.utils.comm import get_rank, get_world_size
+from GLIP.maskrcnn_benchmark.utils.bucketing import bucket_by_key
+from GLIP.maskrcnn_benchmark.utils.laion_io import clean_caption, doc_noun_chunks, \
+    noun_chunk_path, load_noun_chunks, sample_id, iter_tar_samples
+from GLIP.maskrcnn_benchmark.utils.positive_map import create_positive_map
 
 SOLUTION = "720p"
 RESOLUTIONS = {"240p": (320, 240), "480p": (720, 480), "720p": (1280, 720), "1080p": (1920, 1080), "2K": (2560, 1440),
@@ -33,42 +37,6 @@ def pil_loader(image_b):
     return pil_image
 
 
-def create_positive_map(tokenized, tokens_positive):
-    """construct a map such that positive_map[i,j] = True iff box i is associated to token j"""
-    positive_map = torch.zeros((len(tokens_positive), 256), dtype=torch.float)
-
-    for j, tok_list in enumerate(tokens_positive):
-        for (beg, end) in tok_list:
-            try:
-                beg_pos = tokenized.char_to_token(beg)
-                end_pos = tokenized.char_to_token(end - 1)
-            except Exception as e:
-                print("beg:", beg, "end:", end)
-                print("token_positive:", tokens_positive)
-                # print("beg_pos:", beg_pos, "end_pos:", end_pos)
-                raise e
-            if beg_pos is None:
-                try:
-                    beg_pos = tokenized.char_to_token(beg + 1)
-                    if beg_pos is None:
-                        beg_pos = tokenized.char_to_token(beg + 2)
-                except:
-                    beg_pos = None
-            if end_pos is None:
-                try:
-                    end_pos = tokenized.char_to_token(end - 2)
-                    if end_pos is None:
-                        end_pos = tokenized.char_to_token(end - 3)
-                except:
-                    end_pos = None
-            if beg_pos is None or end_pos is None:
-                continue
-
-            assert beg_pos is not None and end_pos is not None
-            positive_map[j, beg_pos: end_pos + 1].fill_(1)
-    return positive_map / (positive_map.sum(-1)[:, None] + 1e-6)
-
-
 def create_positive_map_label_to_token_from_positive_map(positive_map, plus=0):
     positive_map_label_to_token = {}
     for i in range(len(positive_map)):
@@ -92,30 +60,37 @@ def compute_image_shape(original_shape):
     return 1600, FACTOR_DICT[1600]  # just in case
 
 
-class Laion(data.Dataset):
-    """ Laion dataset.
+def image_target_shape(image_b):
+    """Resize shape of an encoded image, read from its header without decoding the pixels."""
+    return compute_image_shape(Image.open(io.BytesIO(image_b)).size)
 
-    Args:
-        root (string): part directory where tar and meta files are at.
-        index (string): index to tar and meta file.
-        transform (callable, optional): A function/transform that  takes in an PIL image
-            and returns a transformed version. E.g, ``transforms.ToTensor``
+
+class LaionProcessor(object):
+    """Turn one raw (id, PIL image, caption) Laion record into a grounding sample.
+
+    ``noun_chunks`` optionally maps sample ids to precomputed noun chunks, samples
+    found there skip the spacy parse. When nlp is None, the spacy model ``spacy_model``
+    is loaded on the first sample missing from them.
     """
 
-    def __init__(self, index, root, nlp, tokenizer, transforms=None, rpn_architecture="VLDYHEAD"):
+    def __init__(self, nlp, tokenizer, transforms=None, rpn_architecture="VLDYHEAD", noun_chunks=None,
+                 spacy_model="en_core_web_trf"):
         self.tokenizer = tokenizer
-        self.root = root
         self.transform = transforms
         self.nlp = nlp
+        self.spacy_model = spacy_model
         self.rpn_architecture = rpn_architecture
+        self.noun_chunks = noun_chunks if noun_chunks is not None else {}
 
-        wds_ds = wds.WebDataset(os.path.join(root, "{}.tar".format(index)))
-        self.samples = [[d['id'].decode(), pil_loader(d['jpg']), d['txt'].decode()] for d in wds_ds]
+    def parse(self, idx, caption):
+        if self.nlp is None:
+            import spacy
+            print("sample {} is missing from the noun chunk sidecar, loading {}".format(idx, self.spacy_model))
+            self.nlp = spacy.load(self.spacy_model)
+        return self.nlp(caption)
 
-    def __getitem__(self, index):
-        idx, image, caption = self.samples[index]
-        r = "[+=^*<>{}「」【】()（）/\[\]]"
-        caption = re.sub(r, ' ', caption)
+    def __call__(self, idx, image, caption):
+        caption = clean_caption(caption)
         origin_image = np.array(image)[:, :, [2, 1, 0]]
 
         image_shape = image.size
@@ -125,8 +100,10 @@ class Laion(data.Dataset):
 
         if self.transform is not None:
             image = self.transform(image)
-        doc = self.nlp(caption)
-        nouns = [t.text.lower() for t in doc.noun_chunks]
+        noun_chunks = self.noun_chunks.get(idx)
+        if noun_chunks is None:
+            noun_chunks = doc_noun_chunks(self.parse(idx, caption))
+        nouns = [text for text, _ in noun_chunks]
         empty_nouns = False
         if len(nouns) == 0:
             print("No entities found, using caption as entity, caption: {}".format(caption))
@@ -144,8 +121,8 @@ class Laion(data.Dataset):
                 new_entities.append("{}-{}".format(chunk, entity_dict[chunk]))
         new_to_old_entity = dict(zip(new_entities, nouns))
         if not empty_nouns:
-            new_entity_to_id = dict(zip(new_entities, [noun_chunk[0].idx for noun_chunk in
-                                                       doc.noun_chunks]))  # starting position of the first token
+            new_entity_to_id = dict(zip(new_entities, [start for _, start in
+                                                       noun_chunks]))  # starting position of the first token
         else:
             # use caption as only entity
             new_entity_to_id = {new_entities[0]: 0}
@@ -173,5 +150,109 @@ class Laion(data.Dataset):
         # positive_map_label_to_token = create_positive_map_label_to_token_from_positive_map(positive_map, plus=plus)
         return image, caption, positive_map, new_entities, new_to_old_entity, new_entity_to_id, origin_image, idx
 
+
+def _load_sidecar(root, index, noun_chunk_file=None):
+    if noun_chunk_file is None:
+        noun_chunk_file = noun_chunk_path(root, index)
+        if not os.path.exists(noun_chunk_file):
+            return None
+    return load_noun_chunks(noun_chunk_file)
+
+
+class Laion(data.Dataset):
+    """ Laion dataset.
+
+    Samples are kept as encoded JPEG bytes and only decoded in ``__getitem__``,
+    so the (DataLoader-worker) memory footprint is that of the tar, not of the
+    decoded images.
+
+    Args:
+        root (string): part directory where tar and meta files are at.
+        index (string): index to tar and meta file.
+        transform (callable, optional): A function/transform that  takes in an PIL image
+            and returns a transformed version. E.g, ``transforms.ToTensor``
+        noun_chunk_file (string, optional): noun chunk sidecar written by nounChunkExtractor.py,
+            defaults to ``<root>/<index>.nouns.jsonl`` if it exists. nlp is only used for the
+            samples missing from it and may be None, spacy is then loaded on the first miss.
+    """
+
+    def __init__(self, index, root, nlp, tokenizer, transforms=None, rpn_architecture="VLDYHEAD",
+                 noun_chunk_file=None):
+        self.tokenizer = tokenizer
+        self.root = root
+        self.transform = transforms
+        self.nlp = nlp
+        self.rpn_architecture = rpn_architecture
+        self.processor = LaionProcessor(nlp, tokenizer, transforms=transforms, rpn_architecture=rpn_architecture,
+                                        noun_chunks=_load_sidecar(root, index, noun_chunk_file))
+
+        tar_path = os.path.join(root, "{}.tar".format(index))
+        self.samples = [[d['id'].decode(), d['jpg'], d['txt'].decode()] for d in iter_tar_samples(tar_path)]
+
+    def __getitem__(self, index):
+        idx, image_b, caption = self.samples[index]
+        return self.processor(idx, pil_loader(image_b), caption)
+
     def __len__(self):
         return len(self.samples)
+
+    def get_target_shapes(self):
+        """Resize shape of every sample, e.g. for ShapeBucketBatchSampler."""
+        return [image_target_shape(image_b) for _, image_b, _ in self.samples]
+
+
+class LaionStream(data.IterableDataset):
+    """ Streaming Laion dataset.
+
+    Reads tar members on demand and decodes them inside the DataLoader workers,
+    so memory stays bounded regardless of the shard size. Samples are split
+    round-robin over ``world_size * num_workers`` shards; each worker only reads
+    the payload of its own samples.
+
+    Args:
+        root (string): part directory where tar and meta files are at.
+        index (string): index to tar and meta file.
+        rank (int, optional): rank of this process, defaults to the torch.distributed rank.
+        world_size (int, optional): number of ranks, defaults to the torch.distributed world size.
+        batch_size (int, optional): if given, yield lists of ``batch_size`` samples sharing the same
+            resize shape instead of single samples, so that batches need no padding. Use with
+            ``DataLoader(batch_size=None, collate_fn=BatchGroundingCollator())``.
+        bucket_window (int, optional): maximum number of raw samples a worker holds back to fill
+            a bucket, defaults to ``8 * batch_size``.
+        noun_chunk_file (string, optional): noun chunk sidecar, see ``Laion``.
+        skip_ids (set, optional): ids of samples not to yield, e.g. the ones already processed
+            before a restart.
+    """
+
+    def __init__(self, index, root, nlp, tokenizer, transforms=None, rpn_architecture="VLDYHEAD",
+                 rank=None, world_size=None, batch_size=None, bucket_window=None, noun_chunk_file=None,
+                 skip_ids=None):
+        self.root = root
+        self.tar_path = os.path.join(root, "{}.tar".format(index))
+        self.processor = LaionProcessor(nlp, tokenizer, transforms=transforms, rpn_architecture=rpn_architecture,
+                                        noun_chunks=_load_sidecar(root, index, noun_chunk_file))
+        self.rank = get_rank() if rank is None else rank
+        self.world_size = get_world_size() if world_size is None else world_size
+        self.batch_size = batch_size
+        self.bucket_window = bucket_window
+        self.skip_ids = set(skip_ids) if skip_ids else set()
+
+    def __iter__(self):
+        worker_info = data.get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        shard_id = self.rank * num_workers + worker_id
+        num_shards = self.world_size * num_workers
+        samples = (d for d in iter_tar_samples(self.tar_path, shard_id=shard_id, num_shards=num_shards)
+                   if 'jpg' in d and 'txt' in d and sample_id(d) not in self.skip_ids)
+        if self.batch_size is None:
+            for d in samples:
+                yield self._process(d)
+            return
+        # bucket the still encoded samples, only their headers are read to get the shape
+        window = 8 * self.batch_size if self.bucket_window is None else self.bucket_window
+        for bucket in bucket_by_key(samples, lambda d: image_target_shape(d['jpg']), self.batch_size, window):
+            yield [self._process(d) for d in bucket]
+
+    def _process(self, d):
+        idx = sample_id(d)
+        return self.processor(idx, pil_loader(d['jpg']), d['txt'].decode())
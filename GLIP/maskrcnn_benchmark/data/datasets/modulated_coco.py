@@ -15,11 +15,16 @@ from pycocotools import mask as coco_mask
 from maskrcnn_benchmark.structures.bounding_box import BoxList
 from maskrcnn_benchmark.structures.segmentation_mask import SegmentationMask
 from maskrcnn_benchmark.data.datasets.coco import has_valid_annotation
+from maskrcnn_benchmark.utils.positive_map import create_positive_map
 from .od_to_grounding import convert_od_to_grounding_simple, check_for_positive_overflow, sanity_check_target_after_processing, convert_object_detection_to_grounding_optimized_for_od
 import pdb
 import json
 
 class CocoGrounding(torchvision.datasets.CocoDetection):
+    # ImageCache of downscaled images, set by build_dataset when one exists for the dataset
+    image_cache = None
+    supports_image_cache = True
+
     def __init__(self,
                  img_folder,
                  ann_file,
@@ -127,13 +132,32 @@ class CocoGrounding(torchvision.datasets.CocoDetection):
         x1, y1, x2, y2 = rect[0], rect[1], rect[2], rect[3]
         return [[x1, y1, x1, y2, x2, y2, x2, y1]]
 
+    def image_cache_key(self, idx):
+        return self.coco.loadImgs(self.ids[idx])[0]["file_name"]
+
+    def get_cached_image(self, idx):
+        """(downscaled image, original (w, h)) from the image cache, None when it is not cached"""
+        if self.image_cache is None:
+            return None
+        return self.image_cache.get(self.image_cache_key(idx))
+
+    def get_image(self, idx):
+        path = self.coco.loadImgs(self.ids[idx])[0]["file_name"]
+        return Image.open(os.path.join(self.root, path)).convert("RGB")
+
     def __getitem__(self, idx):
-        img, tgt = super(CocoGrounding, self).__getitem__(idx)
+        cached = self.get_cached_image(idx)
+        if cached is None:
+            img, tgt = super(CocoGrounding, self).__getitem__(idx)
+            img_size = img.size
+        else:
+            img, img_size = cached
+            tgt = self.coco.loadAnns(self.coco.getAnnIds(imgIds=self.ids[idx]))
         image_id = self.ids[idx]
         tgt = [obj for obj in tgt if obj["iscrowd"] == 0]
         boxes = [obj["bbox"] for obj in tgt]
         boxes = torch.as_tensor(boxes).reshape(-1, 4)  # guard against no boxes
-        target = BoxList(boxes, img.size, mode="xywh").convert("xyxy")
+        target = BoxList(boxes, img_size, mode="xywh").convert("xyxy")
         classes = [obj["category_id"] for obj in tgt]
         classes = [self.json_category_id_to_contiguous_id[c] for c in classes]
         classes = torch.tensor(classes)
@@ -147,15 +171,19 @@ class CocoGrounding(torchvision.datasets.CocoDetection):
                     masks.append(obj["segmentation"])
                     is_box_mask.append(0)
                 else:
-                    masks.append(self.get_box_mask(bbox, img.size, mode="poly"))
+                    masks.append(self.get_box_mask(bbox, img_size, mode="poly"))
                     is_box_mask.append(1)
-            masks = SegmentationMask(masks, img.size, mode="poly")
+            masks = SegmentationMask(masks, img_size, mode="poly")
             is_box_mask = torch.tensor(is_box_mask)
             target.add_field("masks", masks)
             target.add_field("is_box_mask", is_box_mask)
         
         if not self.disable_clip_to_image:
             target = target.clip_to_image(remove_empty=True)
+
+        if img.size != img_size:
+            # downscaled cached image, the annotations are in original image coordinates
+            target = target.resize(img.size)
         
         if self.special_safeguard_for_coco_grounding:
             # Intended for LVIS
@@ -612,36 +640,6 @@ def convert_coco_poly_to_mask(segmentations, height, width):
     return masks
 
 
-def create_positive_map(tokenized, tokens_positive):
-    """construct a map such that positive_map[i,j] = True iff box i is associated to token j"""
-    positive_map = torch.zeros((len(tokens_positive), 256), dtype=torch.float)
-
-    for j, tok_list in enumerate(tokens_positive):
-        for (beg, end) in tok_list:
-            beg_pos = tokenized.char_to_token(beg)
-            end_pos = tokenized.char_to_token(end - 1)
-            if beg_pos is None:
-                try:
-                    beg_pos = tokenized.char_to_token(beg + 1)
-                    if beg_pos is None:
-                        beg_pos = tokenized.char_to_token(beg + 2)
-                except:
-                    beg_pos = None
-            if end_pos is None:
-                try:
-                    end_pos = tokenized.char_to_token(end - 2)
-                    if end_pos is None:
-                        end_pos = tokenized.char_to_token(end - 3)
-                except:
-                    end_pos = None
-            if beg_pos is None or end_pos is None:
-                continue
-
-            assert beg_pos is not None and end_pos is not None
-            positive_map[j, beg_pos: end_pos + 1].fill_(1)
-    return positive_map / (positive_map.sum(-1)[:, None] + 1e-6)
-
-
 def pil_loader(path, retry=5):
     # open path as file to avoid ResourceWarning (https://github.com/python-pillow/Pillow/issues/835)
     ri = 0
@@ -3,10 +3,14 @@ import os.path as op
 import json
 # import logging
 import base64
+import binascii
+import mmap
 import yaml
 import errno
 import io
 import math
+from collections import OrderedDict
+import numpy as np
 from PIL import Image, ImageDraw
 
 from maskrcnn_benchmark.structures.bounding_box import BoxList
@@ -22,14 +26,24 @@ def load_linelist_file(linelist_file):
         return line_list
 
 
-def img_from_base64(imagestring):
+def img_from_bytes(imagebytes):
     try:
-        img = Image.open(io.BytesIO(base64.b64decode(imagestring)))
+        img = Image.open(io.BytesIO(imagebytes))
         return img.convert('RGB')
     except ValueError:
         return None
 
 
+def img_from_base64(imagestring):
+    # a2b_base64 takes str, bytes or a memoryview column of TSVFile.seek_columns as is,
+    # base64.b64decode would first copy a memoryview to bytes
+    try:
+        imagebytes = binascii.a2b_base64(imagestring)
+    except ValueError:
+        return None
+    return img_from_bytes(imagebytes)
+
+
 def load_from_yaml_file(yaml_file):
     with open(yaml_file, 'r') as fp:
         return yaml.load(fp, Loader=yaml.CLoader)
@@ -47,16 +61,131 @@ def find_file_path_in_yaml(fname, root):
             )
 
 
-def create_lineidx(filein, idxout):
-    idxout_tmp = idxout + '.tmp'
-    with open(filein, 'r') as tsvin, open(idxout_tmp, 'w') as tsvout:
+# binary lineidx: the start offset of every row as a packed little-endian uint64 array
+LINEIDX_DTYPE = np.dtype('<u8')
+
+
+def _lineidx_bin_path(lineidx):
+    return lineidx + '.bin'
+
+
+def _is_stale(derived, *sources):
+    """True if derived is missing or older than any of the existing sources it is built from"""
+    if not op.isfile(derived):
+        return True
+    mtime = op.getmtime(derived)
+    return any(op.isfile(source) and op.getmtime(source) > mtime for source in sources)
+
+
+def _write_lineidx_bin(idxout, offset_chunks, dtype=LINEIDX_DTYPE):
+    # per process tmp file, ranks building the same index at once each rename a complete file
+    idxout_tmp = '{}.tmp{}'.format(idxout, os.getpid())
+    with open(idxout_tmp, 'wb') as fp:
+        for offsets in offset_chunks:
+            fp.write(np.ascontiguousarray(offsets, dtype=dtype).tobytes())
+    os.replace(idxout_tmp, idxout)
+
+
+def _scan_line_offsets(filein, chunk_size=1 << 26):
+    with open(filein, 'rb') as tsvin:
         fsize = os.fstat(tsvin.fileno()).st_size
+        if fsize > 0:
+            yield np.zeros(1, dtype=LINEIDX_DTYPE)
         fpos = 0
-        while fpos != fsize:
-            tsvout.write(str(fpos) + "\n")
-            tsvin.readline()
-            fpos = tsvin.tell()
-    os.rename(idxout_tmp, idxout)
+        while True:
+            chunk = tsvin.read(chunk_size)
+            if not chunk:
+                break
+            starts = np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == ord('\n')) + (fpos + 1)
+            fpos += len(chunk)
+            # the last newline of the file does not start a row
+            yield starts[starts < fsize]
+
+
+def _read_lineidx_text(lineidx, chunk_lines=1 << 20):
+    with open(lineidx, 'r') as fp:
+        while True:
+            lines = fp.readlines(chunk_lines * 8)
+            if not lines:
+                break
+            yield np.array([int(i) for i in lines], dtype=LINEIDX_DTYPE)
+
+
+def create_lineidx(filein, idxout):
+    """
+    Write the binary lineidx of the tsv file filein to idxout (a .lineidx.bin file), scanning
+    the file for newlines in large chunks instead of reading it line by line.
+    """
+    _write_lineidx_bin(idxout, _scan_line_offsets(filein))
+
+
+def convert_lineidx(lineidx, idxout=None):
+    """Migrate a text .lineidx file, one offset per line, to the binary format."""
+    _write_lineidx_bin(idxout or _lineidx_bin_path(lineidx), _read_lineidx_text(lineidx))
+
+
+def load_lineidx(lineidx_bin, dtype=LINEIDX_DTYPE):
+    """
+    Returns:
+        np.memmap[uint64]: read-only map of a binary lineidx, its pages are shared by all the
+            processes that load it (e.g. DataLoader workers) instead of copied into each
+    """
+    if op.getsize(lineidx_bin) == 0:
+        # mmap cannot map an empty file
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(lineidx_bin, dtype=dtype, mode='r')
+
+
+# binary seq file of CompositeTSVFile: (source tsv, row in it) of every composite row
+SEQ_DTYPE = np.dtype([('source', '<i4'), ('row', '<i8')])
+
+
+def _read_seq_text(seq_file, chunk_lines=1 << 20):
+    with open(seq_file, 'r') as fp:
+        while True:
+            lines = fp.readlines(chunk_lines * 16)
+            if not lines:
+                break
+            parts = [line.strip().split('\t') for line in lines]
+            yield np.array([(int(p[0]), int(p[1])) for p in parts], dtype=SEQ_DTYPE)
+
+
+def load_seq_file(seq_file):
+    """
+    Map the packed binary version of a text seq file, one "source\trow" per line, converting
+    it on first use and again whenever the text file is newer.
+
+    Returns:
+        np.memmap[SEQ_DTYPE]
+    """
+    seq_bin = seq_file + '.bin'
+    if _is_stale(seq_bin, seq_file):
+        try:
+            _write_lineidx_bin(seq_bin, _read_seq_text(seq_file), dtype=SEQ_DTYPE)
+        except OSError:
+            # read-only dataset directory
+            return np.concatenate([np.zeros(0, dtype=SEQ_DTYPE)] + list(_read_seq_text(seq_file)))
+    return load_lineidx(seq_bin, dtype=SEQ_DTYPE)
+
+
+_WHITESPACE = frozenset(b' \t\n\r\x0b\x0c')
+
+
+def _strip_bounds(buf, start, end):
+    while start < end and buf[start] in _WHITESPACE:
+        start += 1
+    while end > start and buf[end - 1] in _WHITESPACE:
+        end -= 1
+    return start, end
+
+
+def _map_file(path):
+    # the map stays valid once the file is closed, an open file keeps a single descriptor
+    with open(path, 'rb') as fp:
+        # mmap cannot map an empty file
+        if os.fstat(fp.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
 
 
 def read_to_character(fp, c):
@@ -76,18 +205,34 @@ class TSVFile(object):
     def __init__(self, tsv_file, generate_lineidx=False):
         self.tsv_file = tsv_file
         self.lineidx = op.splitext(tsv_file)[0] + '.lineidx'
-        self._fp = None
+        self.lineidx_bin = _lineidx_bin_path(self.lineidx)
+        # read-only map of the tsv file, rows are sliced out of it
+        self._mm = None
+        self._view = None
         self._lineidx = None
         # the process always keeps the process which opens the file.
         # If the pid is not equal to the currrent pid, we will re-open the file.
         self.pid = None
-        # generate lineidx if not exist
-        if not op.isfile(self.lineidx) and generate_lineidx:
-            create_lineidx(self.tsv_file, self.lineidx)
-
-    def __del__(self):
-        if self._fp:
-            self._fp.close()
+        # a binary lineidx older than the text lineidx or the tsv it indexes is rebuilt
+        if _is_stale(self.lineidx_bin, self.lineidx, self.tsv_file):
+            if op.isfile(self.lineidx):
+                # migrate the text lineidx, kept next to it for older readers
+                try:
+                    convert_lineidx(self.lineidx, self.lineidx_bin)
+                except OSError:
+                    # read-only dataset directory, _ensure_lineidx_loaded parses the text file
+                    pass
+            elif generate_lineidx or op.isfile(self.lineidx_bin):
+                # generate lineidx if not exist, or rescan the rewritten tsv
+                create_lineidx(self.tsv_file, self.lineidx_bin)
+
+    def __getstate__(self):
+        # spawned workers re-open the tsv file and re-map the lineidx rather than copy them
+        state = self.__dict__.copy()
+        state['_mm'] = None
+        state['_view'] = None
+        state['_lineidx'] = None
+        return state
 
     def __str__(self):
         return "TSVFile(tsv_file='{}')".format(self.tsv_file)
@@ -99,23 +244,46 @@ class TSVFile(object):
         self._ensure_lineidx_loaded()
         return len(self._lineidx)
 
-    def seek(self, idx):
-        self._ensure_tsv_opened()
+    def _row_bounds(self, idx):
         self._ensure_lineidx_loaded()
         try:
-            pos = self._lineidx[idx]
+            pos = int(self._lineidx[idx])
         except:
             # logging.info('{}-{}'.format(self.tsv_file, idx))
             raise
-        self._fp.seek(pos)
-        return [s.strip() for s in self._fp.readline().split('\t')]
+        self._ensure_tsv_opened()
+        end = self._mm.find(b'\n', pos)
+        return pos, len(self._mm) if end < 0 else end
+
+    def seek(self, idx):
+        pos, end = self._row_bounds(idx)
+        return [s.strip() for s in self._mm[pos:end].decode('utf-8').split('\t')]
+
+    def seek_columns(self, idx):
+        """
+        Zero-copy seek: the columns of row idx, stripped of ascii whitespace, as memoryviews
+        of the mapped tsv file. Meant for large columns such as base64 images, pass them to
+        img_from_base64 or decode them with bytes(column).decode('utf-8').
+
+        Returns:
+            list[memoryview]
+        """
+        pos, end = self._row_bounds(idx)
+        columns = []
+        while True:
+            tab = self._mm.find(b'\t', pos, end)
+            col_end = end if tab < 0 else tab
+            col_start, col_end = _strip_bounds(self._mm, pos, col_end)
+            columns.append(self._view[col_start:col_end])
+            if tab < 0:
+                return columns
+            pos = tab + 1
 
     def seek_first_column(self, idx):
-        self._ensure_tsv_opened()
-        self._ensure_lineidx_loaded()
-        pos = self._lineidx[idx]
-        self._fp.seek(pos)
-        return read_to_character(self._fp, '\t')
+        pos, _ = self._row_bounds(idx)
+        tab = self._mm.find(b'\t', pos)
+        assert tab >= 0
+        return self._mm[pos:tab].decode('utf-8')
 
     def get_key(self, idx):
         return self.seek_first_column(idx)
@@ -129,22 +297,106 @@ class TSVFile(object):
     def _ensure_lineidx_loaded(self):
         if self._lineidx is None:
             # logging.info('loading lineidx: {}'.format(self.lineidx))
-            with open(self.lineidx, 'r') as fp:
-                self._lineidx = [int(i.strip()) for i in fp.readlines()]
+            if not _is_stale(self.lineidx_bin, self.lineidx):
+                self._lineidx = load_lineidx(self.lineidx_bin)
+            else:
+                self._lineidx = np.concatenate([np.zeros(0, dtype=LINEIDX_DTYPE)] +
+                                               list(_read_lineidx_text(self.lineidx)))
 
     def _ensure_tsv_opened(self):
-        if self._fp is None:
-            self._fp = open(self.tsv_file, 'r')
-            self.pid = os.getpid()
+        if self._mm is None:
+            self._open()
 
         if self.pid != os.getpid():
             # logging.info('re-open {} because the process id changed'.format(self.tsv_file))
-            self._fp = open(self.tsv_file, 'r')
+            self._open()
+
+    def close(self):
+        """Release the map of the file and the lineidx, they are re-opened on the next read."""
+        self._mm = None
+        self._view = None
+        self._lineidx = None
+
+    def _open(self):
+        self._mm = _map_file(self.tsv_file)
+        self._view = memoryview(self._mm)
+        self.pid = os.getpid()
+
+
+def raw_image_path(tsv_file):
+    return op.splitext(tsv_file)[0] + '.rawimg'
+
+
+def create_raw_image_file(tsv_file, column=-1, raw_file=None):
+    """
+    Write the raw image sidecar of an image tsv: the base64 column decoded once, the encoded
+    images (jpeg, png, ...) stored back to back in a .rawimg file, with a .rawimg.idx of
+    num_rows + 1 uint64 offsets. TSVDataset reads its images from the sidecar when it exists.
+    """
+    raw_file = raw_file or raw_image_path(tsv_file)
+    tsv = TSVFile(tsv_file, generate_lineidx=True)
+    offsets = np.zeros(len(tsv) + 1, dtype=LINEIDX_DTYPE)
+    raw_file_tmp = '{}.tmp{}'.format(raw_file, os.getpid())
+    with open(raw_file_tmp, 'wb') as fp:
+        for i in range(len(tsv)):
+            imagebytes = binascii.a2b_base64(tsv.seek_columns(i)[column])
+            fp.write(imagebytes)
+            offsets[i + 1] = offsets[i] + len(imagebytes)
+    # the index first, readers only look for it once the images are there
+    _write_lineidx_bin(raw_file + '.idx', [offsets])
+    os.replace(raw_file_tmp, raw_file)
+
+
+class RawImageFile(object):
+    """
+    Images of a raw image sidecar, see create_raw_image_file. self[idx] is a memoryview of the
+    encoded image, for img_from_bytes: no base64 decoding and no copy before the image decoder.
+    """
+
+    def __init__(self, raw_file):
+        self.raw_file = raw_file
+        self._view = None
+        self._offsets = None
+        self.pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_view'] = None
+        state['_offsets'] = None
+        return state
+
+    def __str__(self):
+        return "RawImageFile(raw_file='{}')".format(self.raw_file)
+
+    def __repr__(self):
+        return str(self)
+
+    def __len__(self):
+        self._ensure_opened()
+        return len(self._offsets) - 1
+
+    def __getitem__(self, idx):
+        self._ensure_opened()
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("{} has no image {}".format(self, idx))
+        return self._view[int(self._offsets[idx]):int(self._offsets[idx + 1])]
+
+    def _ensure_opened(self):
+        if self._view is None or self.pid != os.getpid():
+            self._view = memoryview(_map_file(self.raw_file))
+            self._offsets = load_lineidx(self.raw_file + '.idx')
             self.pid = os.getpid()
 
 
 class CompositeTSVFile():
-    def __init__(self, file_list, seq_file, root='.'):
+    def __init__(self, file_list, seq_file, root='.', max_open_files=64):
+        """
+        Arguments:
+            max_open_files (int): at most that many source tsv files are kept open, with their
+                lineidx, the least recently read ones are closed first. 0 for no limit.
+        """
         if isinstance(file_list, str):
             self.file_list = load_list_file(file_list)
         else:
@@ -153,20 +405,46 @@ class CompositeTSVFile():
 
         self.seq_file = seq_file
         self.root = root
+        self.max_open_files = max_open_files
         self.initialized = False
         self.initialize()
 
+    def __getstate__(self):
+        # the seq map and the open files are re-created by the process that unpickles
+        state = self.__dict__.copy()
+        state['initialized'] = False
+        state['seq'] = None
+        state['tsvs'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.initialize()
+
+    def get_tsv(self, idx_source):
+        """TSVFile of a source file, from the pool of open files"""
+        tsv = self.tsvs.get(idx_source)
+        if tsv is not None:
+            self.tsvs.move_to_end(idx_source)
+            return tsv
+        tsv = TSVFile(op.join(self.root, self.file_list[idx_source]))
+        self.tsvs[idx_source] = tsv
+        if self.max_open_files > 0 and len(self.tsvs) > self.max_open_files:
+            _, evicted = self.tsvs.popitem(last=False)
+            evicted.close()
+        return tsv
+
     def get_key(self, index):
-        idx_source, idx_row = self.seq[index]
-        k = self.tsvs[idx_source].get_key(idx_row)
+        idx_source, idx_row = self.seq[index].tolist()
+        k = self.get_tsv(idx_source).get_key(idx_row)
         return '_'.join([self.file_list[idx_source], k])
 
     def num_rows(self):
         return len(self.seq)
 
     def __getitem__(self, index):
-        idx_source, idx_row = self.seq[index]
-        return self.tsvs[idx_source].seek(idx_row)
+        idx_source, idx_row = self.seq[index].tolist()
+        return self.get_tsv(idx_source).seek(idx_row)
 
     def __len__(self):
         return len(self.seq)
@@ -178,12 +456,9 @@ class CompositeTSVFile():
         '''
         if self.initialized:
             return
-        self.seq = []
-        with open(self.seq_file, 'r') as fp:
-            for line in fp:
-                parts = line.strip().split('\t')
-                self.seq.append([int(parts[0]), int(parts[1])])
-        self.tsvs = [TSVFile(op.join(self.root, f)) for f in self.file_list]
+        self.seq = load_seq_file(self.seq_file)
+        # source index -> TSVFile, opened on first read, in least recently read order
+        self.tsvs = OrderedDict()
         self.initialized = True
 
 
@@ -197,6 +472,11 @@ def load_list_file(fname):
 
 
 class TSVDataset(object):
+    # ImageCache of downscaled images, set by build_dataset when one exists for the dataset
+    image_cache = None
+    # only datasets whose target is a BoxList, which __getitem__ resizes to a cached image
+    supports_image_cache = False
+
     def __init__(self, img_file, label_file=None, hw_file=None,
                  linelist_file=None, imageid2idx_file=None):
         """Constructor.
@@ -214,6 +494,11 @@ class TSVDataset(object):
         self.linelist_file = linelist_file
 
         self.img_tsv = TSVFile(img_file)
+        raw_img_file = raw_image_path(img_file)
+        # a sidecar older than the image tsv was built from a previous version of it
+        self.raw_img = None
+        if op.isfile(raw_img_file) and not _is_stale(raw_img_file + '.idx', img_file):
+            self.raw_img = RawImageFile(raw_img_file)
         self.label_tsv = None if label_file is None else TSVFile(label_file, generate_lineidx=True)
         self.hw_tsv = None if hw_file is None else TSVFile(hw_file)
         self.line_list = load_linelist_file(linelist_file)
@@ -233,11 +518,18 @@ class TSVDataset(object):
             return len(self.line_list)
 
     def __getitem__(self, idx):
-        img = self.get_image(idx)
-        img_size = img.size  # w, h
+        cached = self.get_cached_image(idx)
+        if cached is None:
+            img = self.get_image(idx)
+            img_size = img.size  # w, h
+        else:
+            img, img_size = cached
         annotations = self.get_annotations(idx)
         # print(idx, annotations)
         target = self.get_target_from_annotations(annotations, img_size, idx)
+        if img.size != img_size and target is not None:
+            # downscaled cached image, the annotations are in original image coordinates
+            target = target.resize(img.size)
         img, target = self.apply_transforms(img, target)
 
         if self.transforms is None:
@@ -250,6 +542,15 @@ class TSVDataset(object):
     def get_line_no(self, idx):
         return idx if self.line_list is None else self.line_list[idx]
 
+    def image_cache_key(self, idx):
+        return str(self.get_line_no(idx))
+
+    def get_cached_image(self, idx):
+        """(downscaled image, original (w, h)) from the image cache, None when it is not cached"""
+        if self.image_cache is None:
+            return None
+        return self.image_cache.get(self.image_cache_key(idx))
+
     def get_image(self, idx):
         line_no = self.get_line_no(idx)
         if self.imageid2idx is not None:
@@ -258,7 +559,9 @@ class TSVDataset(object):
             annotations = json.loads(row[1])
             imageid = annotations["img_id"]
             line_no = self.imageid2idx[imageid]
-        row = self.img_tsv.seek(line_no)
+        if self.raw_img is not None:
+            return img_from_bytes(self.raw_img[line_no])
+        row = self.img_tsv.seek_columns(line_no)
         # use -1 to support old format with multiple columns.
         img = img_from_base64(row[-1])
         return img
@@ -355,6 +658,7 @@ class ODTSVDataset(TSVYamlDataset):
     """
     Generic TSV dataset format for Object Detection.
     """
+    supports_image_cache = True
 
     def __init__(self, yaml_file, extra_fields=(), transforms=None,
                  is_load_label=True, **kwargs):
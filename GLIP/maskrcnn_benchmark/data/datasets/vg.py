@@ -79,6 +79,7 @@ class VGTSVDataset(TSVYamlDataset):
     """
     Generic TSV dataset format for Object Detection.
     """
+    supports_image_cache = True
 
     def __init__(self, yaml_file, extra_fields=None, transforms=None,
                  is_load_label=True, filter_duplicate_rels=True,
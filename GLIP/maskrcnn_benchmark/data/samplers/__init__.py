@@ -2,5 +2,8 @@
 from .distributed import DistributedSampler
 from .grouped_batch_sampler import GroupedBatchSampler
 from .iteration_based_batch_sampler import IterationBasedBatchSampler
+from .shape_bucket_batch_sampler import ShapeBucketBatchSampler, PaddingStats, bucket_by_key
+from .locality_sampler import LocalitySampler
 
-__all__ = ["DistributedSampler", "GroupedBatchSampler", "IterationBasedBatchSampler"]
+__all__ = ["DistributedSampler", "GroupedBatchSampler", "IterationBasedBatchSampler",
+           "ShapeBucketBatchSampler", "PaddingStats", "bucket_by_key", "LocalitySampler"]
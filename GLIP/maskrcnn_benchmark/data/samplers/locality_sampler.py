@@ -0,0 +1,113 @@
+import logging
+import math
+
+import torch
+from torch.utils.data.sampler import Sampler
+
+from maskrcnn_benchmark.utils.comm import shared_random_seed
+
+
+def contiguous_blocks(dataset, block_size):
+    """
+    Cuts the index range of dataset into blocks of at most block_size consecutive indices,
+    a block never spans two datasets of a ConcatDataset.
+
+    Returns:
+        LongTensor[num_blocks]: first index of every block, increasing
+        LongTensor[num_blocks]: length of every block
+    """
+    ends = list(getattr(dataset, "cumulative_sizes", [len(dataset)]))
+    starts, lengths = [], []
+    begin = 0
+    for end in ends:
+        for start in range(begin, end, block_size):
+            starts.append(start)
+            lengths.append(min(block_size, end - start))
+        begin = end
+    return torch.as_tensor(starts, dtype=torch.long), torch.as_tensor(lengths, dtype=torch.long)
+
+
+def sequential_read_ratio(indices, block_starts):
+    """Fraction of the reads in the same block as the previous read"""
+    if len(indices) < 2:
+        return 1.0
+    blocks = torch.searchsorted(block_starts, torch.as_tensor(indices), right=True)
+    return (blocks[1:] == blocks[:-1]).double().mean().item()
+
+
+class LocalitySampler(Sampler):
+    """
+    Shuffles a dataset while keeping reads local: the indices are cut into blocks of
+    consecutive indices (consecutive rows of the underlying TSV files), the blocks are shuffled,
+    then the indices are shuffled within windows of ``window // block_size`` consecutive blocks
+    of that order.
+    Like DistributedSampler, every replica takes a contiguous slice of the same padded order,
+    which set_epoch (called by IterationBasedBatchSampler) reshuffles.
+
+    Arguments:
+        dataset: Dataset used for sampling.
+        block_size (int): number of consecutive indices read in a row.
+        window (int): indices are moved by less than ``window`` positions within the block order,
+            rounded down to whole blocks. Defaults to block_size, i.e. each block is read in a
+            random order.
+        num_replicas (optional): Number of processes participating in distributed training.
+        rank (optional): Rank of the current process within num_replicas.
+    """
+
+    def __init__(self, dataset, block_size, window=None, num_replicas=1, rank=0, shuffle=True, use_random=False):
+        self.dataset = dataset
+        self.block_size = block_size
+        self.window = window or block_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self.num_samples = int(math.ceil(len(self.dataset) * 1.0 / self.num_replicas))
+        self.total_size = self.num_samples * self.num_replicas
+        self.shuffle = shuffle
+        self.use_random = use_random
+        self.block_starts, self.block_lengths = contiguous_blocks(dataset, block_size)
+        # of the last order of this replica
+        self.sequential_read_ratio = None
+
+    def __iter__(self):
+        if self.shuffle:
+            # deterministically shuffle based on epoch
+            _seed = self.epoch
+            if self.use_random:
+                _seed = int(shared_random_seed())
+            g = torch.Generator()
+            g.manual_seed(_seed)
+            perm = torch.randperm(len(self.block_starts), generator=g)
+            starts, lengths = self.block_starts[perm], self.block_lengths[perm]
+            # position of each index within its block
+            block_offsets = torch.cumsum(lengths, 0) - lengths
+            positions = torch.arange(len(self.dataset)) - torch.repeat_interleave(block_offsets, lengths)
+            indices = torch.repeat_interleave(starts, lengths) + positions
+            # sorting by window + uniform noise shuffles within each window only
+            blocks_per_window = max(self.window // self.block_size, 1)
+            window_ids = torch.repeat_interleave(torch.arange(len(lengths)) // blocks_per_window, lengths).double()
+            noise = torch.rand(len(indices), generator=g, dtype=torch.float64)
+            indices = indices[torch.argsort(window_ids + noise)].tolist()
+        else:
+            indices = torch.arange(len(self.dataset)).tolist()
+
+        # add extra samples to make it evenly divisible
+        indices += indices[: (self.total_size - len(indices))]
+        assert len(indices) == self.total_size
+
+        # subsample
+        offset = self.num_samples * self.rank
+        indices = indices[offset : offset + self.num_samples]
+        assert len(indices) == self.num_samples
+
+        self.sequential_read_ratio = sequential_read_ratio(indices, self.block_starts)
+        logger = logging.getLogger(__name__)
+        logger.info("LocalitySampler epoch {}: {} samples, {:.2%} of the reads in the block of the previous one"
+                    .format(self.epoch, len(indices), self.sequential_read_ratio))
+        return iter(indices)
+
+    def __len__(self):
+        return self.num_samples
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
@@ -0,0 +1,83 @@
+import math
+from collections import Counter
+
+from torch.utils.data.sampler import BatchSampler
+from torch.utils.data.sampler import Sampler
+
+from maskrcnn_benchmark.utils.bucketing import bucket_by_key
+
+
+class ShapeBucketBatchSampler(BatchSampler):
+    """
+    Wraps another sampler to yield mini-batches of indices with the same target
+    image shape, so that the collated batch needs no padding. Unlike
+    GroupedBatchSampler it works on a bounded window, elements are reordered by at
+    most ``window`` positions.
+
+    Arguments:
+        sampler (Sampler): Base sampler.
+        shapes (list): target shape of each element of the dataset.
+        batch_size (int): Size of mini-batch.
+        window (int): maximum number of elements held back to fill a bucket.
+        drop_uneven (bool): If ``True``, the sampler will drop the batches whose
+            size is less than ``batch_size``
+    """
+
+    def __init__(self, sampler, shapes, batch_size, window=None, drop_uneven=False):
+        if not isinstance(sampler, Sampler):
+            raise ValueError(
+                "sampler should be an instance of "
+                "torch.utils.data.Sampler, but got sampler={}".format(sampler)
+            )
+        self.sampler = sampler
+        self.shapes = [tuple(s) for s in shapes]
+        self.batch_size = batch_size
+        self.window = 8 * batch_size if window is None else window
+        self.drop_uneven = drop_uneven
+        self.shape_counts = list(Counter(self.shapes).values())
+
+    def __iter__(self):
+        for batch in bucket_by_key(self.sampler, lambda i: self.shapes[i], self.batch_size, self.window):
+            if self.drop_uneven and len(batch) < self.batch_size:
+                continue
+            yield batch
+
+    def __len__(self):
+        """
+        Number of batches if every bucket were filled before being emitted, from the shape counts of
+        the dataset scaled to len(sampler), without running the sampler. Buckets flushed early by the
+        window add batches (or drop them with drop_uneven), so an epoch can differ slightly.
+        """
+        scale = len(self.sampler) / max(len(self.shapes), 1)
+        rounding = math.floor if self.drop_uneven else math.ceil
+        return sum(rounding(count * scale / self.batch_size) for count in self.shape_counts)
+
+
+class PaddingStats(object):
+    """
+    Accumulates how much of the collated image batches is real image content.
+    """
+
+    def __init__(self):
+        self.image_pixels = 0
+        self.batch_pixels = 0
+        self.num_batches = 0
+
+    def update(self, batch_shape, image_sizes):
+        """
+        batch_shape: shape of the padded batch tensor, (N, C, H, W)
+        image_sizes: (h, w) of each image before padding
+        """
+        self.image_pixels += sum(int(h) * int(w) for h, w in image_sizes)
+        self.batch_pixels += len(image_sizes) * int(batch_shape[-2]) * int(batch_shape[-1])
+        self.num_batches += 1
+
+    @property
+    def efficiency(self):
+        if self.batch_pixels == 0:
+            return 1.0
+        return self.image_pixels / self.batch_pixels
+
+    def __str__(self):
+        return "{} batches, padding efficiency {:.2%} ({:.2%} of the pixels are padding)".format(
+            self.num_batches, self.efficiency, 1 - self.efficiency)
@@ -0,0 +1,123 @@
+"""
+Static-weight inference export of GeneralizedVLRCNN with a VLDyHeadModule.
+
+Only the tensor part of the detector, visual backbone + FPN + VLDyHead, is compiled.
+Tokenization, the language backbone, anchor generation and box selection stay in Python:
+they are cheap, data-dependent, and would break the trace or cause recompilations.
+"""
+import torch
+from torch import nn
+
+from maskrcnn_benchmark.structures.image_list import to_image_list
+
+
+def _tensor_fields(language_dict_features):
+    # mlm_labels is None in inference, traced and compiled graphs only take tensors
+    return {k: v for k, v in language_dict_features.items() if torch.is_tensor(v)}
+
+
+class VLDetectorCore(nn.Module):
+    """
+    Backbone, FPN and VLDyHead of a GeneralizedVLRCNN on plain tensors, so it can be
+    traced or compiled. Shares its modules and weights with the wrapped model.
+    """
+
+    def __init__(self, model):
+        super(VLDetectorCore, self).__init__()
+        if 'vl' in model.cfg.MODEL.SWINT.VERSION:
+            raise NotImplementedError("the language is fused inside {} backbones, export it eagerly"
+                                      .format(model.cfg.MODEL.SWINT.VERSION))
+        if model.cfg.MODEL.RPN_ARCHITECTURE != "VLDYHEAD" or model.roi_heads:
+            raise NotImplementedError("only the VLDYHEAD rpn without roi heads can be exported")
+        self.backbone = model.backbone
+        self.rpn = model.rpn
+
+    def forward(self, images, language_dict_features):
+        """
+        Arguments:
+            images (Tensor): padded image batch, the tensors of an ImageList
+            language_dict_features (dict[str, Tensor]): output of the language backbone
+
+        Returns:
+            dict[str, tuple[Tensor]]: per-level "features", "box_cls", "box_regression", "centerness",
+                and "token_logits" / "dot_product_logits" when the head computes them
+        """
+        # the fusion layers replace "hidden", keep the caller's dict as it is
+        language_dict_features = dict(language_dict_features)
+        features = self.backbone(images)
+        embedding = self.rpn.language_embedding(language_dict_features)
+        box_cls, box_regression, centerness, token_logits, _, _, dot_product_logits, _, _, _ = \
+            self.rpn.head(features, language_dict_features, embedding)
+        # a trace can only return tensors and tuples of tensors
+        outputs = {"features": features,
+                   "box_cls": box_cls,
+                   "box_regression": box_regression,
+                   "centerness": centerness,
+                   "token_logits": token_logits,
+                   "dot_product_logits": dot_product_logits}
+        return {k: tuple(v) for k, v in outputs.items() if v is not None}
+
+
+class ExportedVLDetector(nn.Module):
+    """
+    Drop-in replacement of a GeneralizedVLRCNN for inference, running a compiled or traced
+    VLDetectorCore between the eager language backbone and the eager box selection.
+    """
+
+    def __init__(self, model, core):
+        super(ExportedVLDetector, self).__init__()
+        self.model = model
+        self.core = core
+        self.cfg = model.cfg
+
+    @torch.no_grad()
+    def forward(self, images, captions=None, positive_map=None):
+        images = to_image_list(images, self.cfg.DATALOADER.SIZE_DIVISIBILITY)
+        language_dict_features, positive_map = self.model._forward_language(
+            captions=captions, device=images.tensors.device, positive_map=positive_map)
+        language_dict_features = _tensor_fields(language_dict_features)
+
+        outputs = self.core(images.tensors, language_dict_features)
+
+        rpn = self.model.rpn
+        outputs = {k: list(v) for k, v in outputs.items()}
+        anchors = rpn.anchor_generator(images, outputs["features"])
+        boxes, _, _ = rpn._forward_test(outputs["box_regression"], outputs["centerness"], anchors,
+                                        outputs["box_cls"],
+                                        outputs.get("token_logits"),
+                                        outputs.get("dot_product_logits"),
+                                        positive_map)
+        return boxes
+
+
+def export_for_inference(model, mode="compile", example_images=None, example_captions=None):
+    """
+    Arguments:
+        model (GeneralizedVLRCNN): model with loaded weights, switched to eval mode here
+        mode (str): "compile" for torch.compile (torch >= 2.0), which recompiles for new
+            image shapes, or "trace" for torch.jit.trace, which is fixed to the example shape
+        example_images (ImageList or list[Tensor]): inputs to trace with, "trace" only
+        example_captions (list[str]): captions to trace with, "trace" only
+
+    Returns:
+        ExportedVLDetector
+    """
+    model.eval()
+    core = VLDetectorCore(model).eval()
+    if mode == "compile":
+        if not hasattr(torch, "compile"):
+            raise RuntimeError("torch.compile needs torch >= 2.0, use mode='trace'")
+        core = torch.compile(core)
+    elif mode == "trace":
+        assert example_images is not None and example_captions is not None, \
+            "tracing needs example_images and example_captions"
+        example_images = to_image_list(example_images, model.cfg.DATALOADER.SIZE_DIVISIBILITY)
+        with torch.no_grad():
+            language_dict_features, _ = model._forward_language(
+                captions=example_captions, device=example_images.tensors.device)
+            language_dict_features = _tensor_fields(language_dict_features)
+            core = torch.jit.trace(core, (example_images.tensors, language_dict_features),
+                                   strict=False, check_trace=False)
+    else:
+        raise ValueError("unknown export mode {}".format(mode))
+    return ExportedVLDetector(model, core)
@@ -13,6 +13,7 @@ from maskrcnn_benchmark.data.datasets.evaluation import evaluate, im_detect_bbox
 from ..utils.comm import is_main_process
 from ..utils.comm import all_gather
 from ..utils.comm import synchronize
+from ..utils.amp import inference_autocast
 import pdb
 from maskrcnn_benchmark.data.datasets.evaluation.flickr.flickr_eval import FlickrEvaluator
 from maskrcnn_benchmark.structures.bounding_box import BoxList
@@ -458,9 +459,10 @@ def inference(
 
         all_output = []
         mdetr_style_output = []
-        with torch.no_grad():
+        with torch.no_grad(), inference_autocast(device, cfg.TEST.PRECISION):
             if cfg.TEST.USE_MULTISCALE:
                 query_time = len(all_queries)
+                queries = []
                 for query_i in range(query_time):
                     if task == "detection":
                         captions = [all_queries[query_i] for ii in range(len(targets))]
@@ -468,21 +470,26 @@ def inference(
                     else:
                         captions = None
                         positive_map_label_to_token = None
+                    queries.append((captions, positive_map_label_to_token))
 
-                output = im_detect_bbox_aug(model, images, device, captions, positive_map_label_to_token)
-                output = [o.to(cpu_device) for o in output]
-                all_output.append(output)
+                # every scale/flip runs the backbone once for all the queries
+                outputs = im_detect_bbox_aug(model, images, device, queries=queries)
+                for output in outputs:
+                    output = [o.to(cpu_device) for o in output]
+                    all_output.append(output)
             else:
                 images = images.to(device)
                 query_time = len(all_queries)
 
-                for query_i in range(query_time):
-                    if not isinstance(targets[0], dict): # For LVIS dataset and datasets directly copied from MDETR
-                        targets = [target.to(device) for target in targets]
-                    '''
-                    different datasets seem to have different data format... For LVIS dataset, the target is a dictionary, while for modulatedDataset such as COCO/Flickr, the target is a BoxList
-                    '''
+                if not isinstance(targets[0], dict): # For LVIS dataset and datasets directly copied from MDETR
+                    targets = [target.to(device) for target in targets]
+                '''
+                different datasets seem to have different data format... For LVIS dataset, the target is a dictionary, while for modulatedDataset such as COCO/Flickr, the target is a BoxList
+                '''
 
+                all_captions = []
+                all_maps = []
+                for query_i in range(query_time):
                     if task == "detection":
                         captions = [all_queries[query_i] for ii in range(len(targets))]
                         positive_map_label_to_token = all_positive_map_label_to_token[query_i]
@@ -496,7 +503,18 @@ def inference(
                         assert(len(positive_map_eval) == 1) # Let's just use one image per batch
                         positive_map_eval = positive_map_eval[0]
                         positive_map_label_to_token = create_positive_map_label_to_token_from_positive_map(positive_map_eval, plus=plus)
-                    output = model(images, captions=captions, positive_map=positive_map_label_to_token)
+                    all_captions.append(captions)
+                    all_maps.append(positive_map_label_to_token)
+
+                # the visual backbone does not depend on the query, so compute it once for all query chunks
+                detector = model.module if hasattr(model, "module") else model
+                if query_time > 1 and hasattr(detector, "forward_multi_query"):
+                    outputs = detector.forward_multi_query(images, all_captions, all_maps)
+                else:
+                    outputs = [model(images, captions=captions, positive_map=positive_map_label_to_token)
+                               for captions, positive_map_label_to_token in zip(all_captions, all_maps)]
+
+                for output, positive_map_label_to_token in zip(outputs, all_maps):
                     output = [o.to(cpu_device) for o in output]
 
                     if "flickr" in cfg.DATASETS.TEST[0]:
@@ -10,13 +10,15 @@ from torchvision import transforms as T
 import pdb
 from maskrcnn_benchmark.modeling.detector import build_detection_model
 from maskrcnn_benchmark.utils.checkpoint import DetectronCheckpointer
-from maskrcnn_benchmark.utils.dist import get_iou
 from maskrcnn_benchmark.structures.image_list import to_image_list, ImageList
-from maskrcnn_benchmark.structures.boxlist_ops import boxlist_iou
+from maskrcnn_benchmark.structures.boxlist_ops import boxlist_iou, boxlist_iou_filter
 from maskrcnn_benchmark.structures.bounding_box import BoxList
 from maskrcnn_benchmark import layers as L
 from maskrcnn_benchmark.modeling.roi_heads.mask_head.inference import Masker
 from maskrcnn_benchmark.utils import cv2_util
+from maskrcnn_benchmark.utils.quantization import quantize_dynamic_vl
+from maskrcnn_benchmark.utils.amp import inference_autocast
+from maskrcnn_benchmark.utils.positive_map import create_positive_map
 
 engine = inflect.engine()
 
@@ -30,9 +32,14 @@ class GLIPDemo(object):
                  min_image_size=None,
                  show_mask_heatmaps=False,
                  masks_per_dim=5,
-                 load_model=True
+                 load_model=True,
+                 language_cache_size=0,
+                 quantize=False,
+                 precision=None
                  ):
         self.cfg = cfg.clone()
+        # "fp32", "fp16" or "bf16", defaults to TEST.PRECISION
+        self.precision = precision or cfg.TEST.PRECISION
         if load_model:
             self.model = build_detection_model(cfg)
             self.model.eval()
@@ -46,6 +53,13 @@ class GLIPDemo(object):
         if load_model:
             checkpointer = DetectronCheckpointer(cfg, self.model, save_dir=save_dir)
             _ = checkpointer.load(cfg.MODEL.WEIGHT)
+            if quantize:
+                # int8 language backbone and fusion linears, the dynamic kernels only exist on cpu
+                assert self.device.type == "cpu", "quantized inference needs MODEL.DEVICE cpu"
+                quantize_dynamic_vl(self.model)
+            if language_cache_size > 0:
+                # fixed-vocabulary serving: encode each distinct prompt only once
+                self.model.enable_language_cache(language_cache_size)
 
         self.transforms = self.build_transform()
 
@@ -178,7 +192,7 @@ class GLIPDemo(object):
         images = images.to(self.device)
         # print("captions:", captions)
         # print("positive_map_label_to_tokens:", positive_map_label_to_tokens)
-        with torch.no_grad():
+        with torch.no_grad(), inference_autocast(self.device, self.precision):
             predictions = self.model(images, captions, positive_map_label_to_tokens)
             predictions = [p.to("cpu") for p in predictions]
         # for origin_image, prediction in zip(origin_images, predictions):
@@ -186,9 +200,14 @@ class GLIPDemo(object):
         #     prediction = prediction.resize((width, height))
         predictions = [prediction.resize((origin_image.shape[1], origin_image.shape[0])) for prediction, origin_image in
                        zip(predictions, origin_images)]
-        list_locations = get_entity_list_locs(entity_lists)
-        top_predictions = [self._post_process(prediction, list_loc, thresh) for
+        if isinstance(positive_map_label_to_tokens, (list, tuple)):
+            # per-image positive maps: labels already index each image's own entity list
+            list_locations = [(0, len(entity_list)) for entity_list in entity_lists]
+        else:
+            list_locations = get_entity_list_locs(entity_lists)
+        top_predictions = [self._post_process(prediction, list_loc, thresh, filter_iou=False) for
                            prediction, entity_list, list_loc in zip(predictions, entity_lists, list_locations)]
+        top_predictions = self.batched_filter_iou(top_predictions)
         results = None
         if save_img:
             results = [image.copy() for image in origin_images]
@@ -241,28 +260,14 @@ class GLIPDemo(object):
         _, idx = scores.sort(0, descending=True)
         return predictions[idx]
 
-    def filter_iou(self, prediction, threshold=0.95):
+    def filter_iou(self, prediction, threshold=0.95, per_label=False):
         # predictions in descending order
-        qualified = {}
-        labels = prediction.get_field("labels").tolist()
-        scores = prediction.get_field("scores").tolist()
-        for idx, bbox in enumerate(prediction.bbox):
-            top_left, bottom_right = bbox[:2].tolist(), bbox[2:].tolist()
-            top_left = (top_left[0], top_left[1])
-            bottom_right = (bottom_right[0], bottom_right[1])
-            if len(qualified) == 0:
-                qualified[(top_left, bottom_right)] = idx
-                continue
-            add = True
-            for tl, rb in *qualified.keys(),:
-                iou = get_iou(top_left, bottom_right, tl, rb)
-                if get_iou(top_left, bottom_right, tl, rb) > threshold:
-                    add = False
-                    break
-            if add:
-                qualified[(top_left, bottom_right)] = idx
-        ids = list(qualified.values())
-        return prediction[ids]
+        return self.batched_filter_iou([prediction], threshold, per_label)[0]
+
+    def batched_filter_iou(self, predictions, threshold=0.95, per_label=False):
+        # drop boxes overlapping a higher scored box of the same image (and label if per_label) by more than threshold
+        label_field = "labels" if per_label else None
+        return boxlist_iou_filter(predictions, threshold, label_field=label_field)
 
     def compute_prediction(self, original_image, original_caption, custom_entities=None):
         # image
@@ -319,7 +324,7 @@ class GLIPDemo(object):
         # tic = timeit.time.perf_counter()
 
         # compute predictions
-        with torch.no_grad():
+        with torch.no_grad(), inference_autocast(self.device, self.precision):
             predictions = self.model(image_list, captions=[original_caption], positive_map=positive_map_label_to_token)
             predictions = [o.to(self.cpu_device) for o in predictions]
         # print("inference time per image: {}".format(timeit.time.perf_counter() - tic))
@@ -351,7 +356,7 @@ class GLIPDemo(object):
                 ids.append(idx)
         return prediction[ids]
 
-    def _post_process(self, prediction, list_loc, threshold=0.5):
+    def _post_process(self, prediction, list_loc, threshold=0.5, filter_iou=True):
         scores = prediction.get_field("scores")
         # print("before post process")
         # print("scores:", scores)
@@ -378,7 +383,8 @@ class GLIPDemo(object):
         # print("after object filter:")
         # print("scores:", prediction.get_field("scores"))
         # print("labels:", prediction.get_field("labels"))
-        prediction = self.filter_iou(prediction)
+        if filter_iou:
+            prediction = self.filter_iou(prediction)
         # print("final:")
         # print("scores:", prediction.get_field("scores"))
         # print("labels:", prediction.get_field("labels"))
@@ -513,40 +519,6 @@ def create_positive_map_label_to_token_from_positive_map(positive_map, plus=0):
     return positive_map_label_to_token
 
 
-def create_positive_map(tokenized, tokens_positive):
-    """construct a map such that positive_map[i,j] = True iff box i is associated to token j"""
-    positive_map = torch.zeros((len(tokens_positive), 256), dtype=torch.float)
-
-    for j, tok_list in enumerate(tokens_positive):
-        for (beg, end) in tok_list:
-            try:
-                beg_pos = tokenized.char_to_token(beg)
-                end_pos = tokenized.char_to_token(end - 1)
-            except Exception as e:
-                # print("beg_pos:", beg_pos, "end_pos:", end_pos)
-                raise e
-            if beg_pos is None:
-                try:
-                    beg_pos = tokenized.char_to_token(beg + 1)
-                    if beg_pos is None:
-                        beg_pos = tokenized.char_to_token(beg + 2)
-                except:
-                    beg_pos = None
-            if end_pos is None:
-                try:
-                    end_pos = tokenized.char_to_token(end - 2)
-                    if end_pos is None:
-                        end_pos = tokenized.char_to_token(end - 3)
-                except:
-                    end_pos = None
-            if beg_pos is None or end_pos is None:
-                continue
-
-            assert beg_pos is not None and end_pos is not None
-            positive_map[j, beg_pos: end_pos + 1].fill_(1)
-    return positive_map / (positive_map.sum(-1)[:, None] + 1e-6)
-
-
 def find_noun_phrases(caption: str) -> List[str]:
     caption = caption.lower()
     tokens = nltk.word_tokenize(caption)
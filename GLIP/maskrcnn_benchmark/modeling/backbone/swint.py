@@ -3,6 +3,8 @@
 # modified from https://github.com/SwinTransformer/Swin-Transformer-Object-Detection/blob/master/mmdet/models/backbones/swin_transformer.py
 # --------------------------------------------------------
 
+from collections import OrderedDict
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -61,6 +63,80 @@ def window_reverse(windows, window_size, H, W):
     return x
 
 
+# SW-MSA masks only depend on the padded feature size, so they are shared by all layers of both swint variants
+_SHIFT_MASK_CACHE = OrderedDict()
+_SHIFT_MASK_CACHE_SIZE = 64
+
+
+def shifted_window_mask(Hp, Wp, window_size, shift_size, device):
+    """
+    Args:
+        Hp, Wp (int): Height and width of the feature padded to a multiple of window_size
+        window_size (int): Window size
+        shift_size (int): Shift size for SW-MSA
+        device (torch.device): Device of the mask
+    Returns:
+        attn_mask: (0/-100) mask with shape of (num_windows, window_size*window_size, window_size*window_size),
+            cached, must not be modified in place
+    """
+    key = (Hp, Wp, window_size, shift_size, device)
+    attn_mask = _SHIFT_MASK_CACHE.get(key)
+    if attn_mask is not None:
+        _SHIFT_MASK_CACHE.move_to_end(key)
+        return attn_mask
+
+    img_mask = torch.zeros((1, Hp, Wp, 1), device=device)  # 1 Hp Wp 1
+    h_slices = (slice(0, -window_size),
+                slice(-window_size, -shift_size),
+                slice(-shift_size, None))
+    w_slices = (slice(0, -window_size),
+                slice(-window_size, -shift_size),
+                slice(-shift_size, None))
+    cnt = 0
+    for h in h_slices:
+        for w in w_slices:
+            img_mask[:, h, w, :] = cnt
+            cnt += 1
+
+    mask_windows = window_partition(img_mask, window_size)  # nW, window_size, window_size, 1
+    mask_windows = mask_windows.view(-1, window_size * window_size)
+    attn_mask = mask_windows.unsqueeze(1) - mask_windows.unsqueeze(2)
+    attn_mask = attn_mask.masked_fill(attn_mask != 0, float(-100.0)).masked_fill(attn_mask == 0, float(0.0))
+
+    _SHIFT_MASK_CACHE[key] = attn_mask
+    if len(_SHIFT_MASK_CACHE) > _SHIFT_MASK_CACHE_SIZE:
+        _SHIFT_MASK_CACHE.popitem(last=False)
+    return attn_mask
+
+
+def fused_window_attention(q, k, v, relative_position_bias, mask=None, q_scale=1.0, dropout_p=0.):
+    """ Window attention through F.scaled_dot_product_attention, without materializing the
+    (num_windows*B, nH, N, N) attention weights or a per-image copy of the mask.
+    Args:
+        q, k, v: (num_windows*B, nH, N, head_dim)
+        relative_position_bias: (nH, N, N)
+        mask: (0/-inf) mask with shape of (num_windows, N, N) or None
+        q_scale (float): Extra scale of q, sdpa already scales by head_dim ** -0.5
+        dropout_p (float): Attention dropout probability
+    Returns:
+        x: (num_windows*B, N, nH*head_dim)
+    """
+    B_, nH, N, head_dim = q.shape
+    if q_scale != 1.0:
+        q = q * q_scale
+
+    attn_mask = relative_position_bias.unsqueeze(0)  # 1, nH, N, N
+    if mask is not None:
+        nW = mask.shape[0]
+        # windows are laid out image by image (see window_partition), so the windows of an image
+        # and their heads form one batch row and the (1, nW*nH, N, N) mask broadcasts over images
+        attn_mask = (attn_mask + mask.unsqueeze(1)).view(1, nW * nH, N, N)
+        q, k, v = [t.reshape(B_ // nW, nW * nH, N, head_dim) for t in (q, k, v)]
+
+    x = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask.to(q.dtype), dropout_p=dropout_p)
+    return x.view(B_, nH, N, head_dim).transpose(1, 2).reshape(B_, N, nH * head_dim)
+
+
 class WindowAttention(nn.Module):
     """ Window based multi-head self attention (W-MSA) module with relative position bias.
     It supports both of shifted and non-shifted window.
@@ -72,9 +148,12 @@ class WindowAttention(nn.Module):
         qk_scale (float | None, optional): Override default qk scale of head_dim ** -0.5 if set
         attn_drop (float, optional): Dropout ratio of attention weight. Default: 0.0
         proj_drop (float, optional): Dropout ratio of output. Default: 0.0
+        use_fused_attn (bool, optional): If True, run attention through F.scaled_dot_product_attention with the
+            relative position bias and shift mask as an additive mask. Default: False
     """
 
-    def __init__(self, dim, window_size, num_heads, qkv_bias=True, qk_scale=None, attn_drop=0., proj_drop=0.):
+    def __init__(self, dim, window_size, num_heads, qkv_bias=True, qk_scale=None, attn_drop=0., proj_drop=0.,
+                 use_fused_attn=False):
 
         super().__init__()
         self.dim = dim
@@ -82,6 +161,9 @@ class WindowAttention(nn.Module):
         self.num_heads = num_heads
         head_dim = dim // num_heads
         self.scale = qk_scale or head_dim ** -0.5
+        # sdpa scales by head_dim ** -0.5 itself, q is only rescaled when qk_scale overrides it
+        self.fused_q_scale = self.scale * head_dim ** 0.5
+        self.use_fused_attn = use_fused_attn and hasattr(F, "scaled_dot_product_attention")
 
         # define a parameter table of relative position bias
         self.relative_position_bias_table = nn.Parameter(
@@ -107,6 +189,24 @@ class WindowAttention(nn.Module):
 
         trunc_normal_(self.relative_position_bias_table, std=.02)
         self.softmax = nn.Softmax(dim=-1)
+        self._bias_cache = None
+
+    def get_relative_position_bias(self):
+        """ Gather the (nH, Wh*Ww, Wh*Ww) relative position bias. In inference it is gathered once and
+        reused until the bias table is moved or loaded again.
+        """
+        cacheable = not self.training and not torch.is_grad_enabled()
+        table = self.relative_position_bias_table
+        key = (table.data_ptr(), table._version)
+        if cacheable and self._bias_cache is not None and self._bias_cache[0] == key:
+            return self._bias_cache[1]
+
+        relative_position_bias = table[self.relative_position_index.view(-1)].view(
+            self.window_size[0] * self.window_size[1], self.window_size[0] * self.window_size[1], -1)  # Wh*Ww,Wh*Ww,nH
+        relative_position_bias = relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
+        if cacheable:
+            self._bias_cache = (key, relative_position_bias)
+        return relative_position_bias
 
     def forward(self, x, mask=None):
         """ Forward function.
@@ -118,12 +218,13 @@ class WindowAttention(nn.Module):
         qkv = self.qkv(x).reshape(B_, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
         q, k, v = qkv[0], qkv[1], qkv[2]  # make torchscript happy (cannot use tensor as tuple)
 
+        relative_position_bias = self.get_relative_position_bias()  # nH, Wh*Ww, Wh*Ww
+
+        if self.use_fused_attn:
+            return self._fused_forward(q, k, v, relative_position_bias, mask)
+
         q = q * self.scale
         attn = (q @ k.transpose(-2, -1))
-
-        relative_position_bias = self.relative_position_bias_table[self.relative_position_index.view(-1)].view(
-            self.window_size[0] * self.window_size[1], self.window_size[0] * self.window_size[1], -1)  # Wh*Ww,Wh*Ww,nH
-        relative_position_bias = relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
         attn = attn + relative_position_bias.unsqueeze(0)
 
         if mask is not None:
@@ -141,6 +242,16 @@ class WindowAttention(nn.Module):
         x = self.proj_drop(x)
         return x
 
+    def _fused_forward(self, q, k, v, relative_position_bias, mask=None):
+        """ Same attention as forward, without materializing the (num_windows*B, nH, N, N) weights
+        for the bias add, the mask add, softmax and dropout separately.
+        """
+        x = fused_window_attention(q, k, v, relative_position_bias, mask, q_scale=self.fused_q_scale,
+                                   dropout_p=self.attn_drop.p if self.training else 0.)
+        x = self.proj(x)
+        x = self.proj_drop(x)
+        return x
+
 
 class SwinTransformerBlock(nn.Module):
     """ Swin Transformer Block.
@@ -157,11 +268,12 @@ class SwinTransformerBlock(nn.Module):
         drop_path (float, optional): Stochastic depth rate. Default: 0.0
         act_layer (nn.Module, optional): Activation layer. Default: nn.GELU
         norm_layer (nn.Module, optional): Normalization layer.  Default: nn.LayerNorm
+        use_fused_attn (bool, optional): Use scaled_dot_product_attention in WindowAttention. Default: False
     """
 
     def __init__(self, dim, num_heads, window_size=7, shift_size=0,
                  mlp_ratio=4., qkv_bias=True, qk_scale=None, drop=0., attn_drop=0., drop_path=0.,
-                 act_layer=nn.GELU, norm_layer=nn.LayerNorm):
+                 act_layer=nn.GELU, norm_layer=nn.LayerNorm, use_fused_attn=False):
         super().__init__()
         self.dim = dim
         self.num_heads = num_heads
@@ -173,7 +285,8 @@ class SwinTransformerBlock(nn.Module):
         self.norm1 = norm_layer(dim)
         self.attn = WindowAttention(
             dim, window_size=to_2tuple(self.window_size), num_heads=num_heads,
-            qkv_bias=qkv_bias, qk_scale=qk_scale, attn_drop=attn_drop, proj_drop=drop)
+            qkv_bias=qkv_bias, qk_scale=qk_scale, attn_drop=attn_drop, proj_drop=drop,
+            use_fused_attn=use_fused_attn)
 
         self.drop_path = DropPath(drop_path) if drop_path > 0. else nn.Identity()
         self.norm2 = norm_layer(dim)
@@ -300,6 +413,7 @@ class BasicLayer(nn.Module):
         norm_layer (nn.Module, optional): Normalization layer. Default: nn.LayerNorm
         downsample (nn.Module | None, optional): Downsample layer at the end of the layer. Default: None
         use_checkpoint (bool): Whether to use checkpointing to save memory. Default: False.
+        use_fused_attn (bool): Use scaled_dot_product_attention in WindowAttention. Default: False.
     """
 
     def __init__(self,
@@ -315,7 +429,8 @@ class BasicLayer(nn.Module):
                  drop_path=0.,
                  norm_layer=nn.LayerNorm,
                  downsample=None,
-                 use_checkpoint=False):
+                 use_checkpoint=False,
+                 use_fused_attn=False):
         super().__init__()
         self.window_size = window_size
         self.shift_size = window_size // 2
@@ -335,7 +450,8 @@ class BasicLayer(nn.Module):
                 drop=drop,
                 attn_drop=attn_drop,
                 drop_path=drop_path[i] if isinstance(drop_path, list) else drop_path,
-                norm_layer=norm_layer)
+                norm_layer=norm_layer,
+                use_fused_attn=use_fused_attn)
             for i in range(depth)])
 
         # patch merging layer
@@ -354,23 +470,7 @@ class BasicLayer(nn.Module):
         # calculate attention mask for SW-MSA
         Hp = int(np.ceil(H / self.window_size)) * self.window_size
         Wp = int(np.ceil(W / self.window_size)) * self.window_size
-        img_mask = torch.zeros((1, Hp, Wp, 1), device=x.device)  # 1 Hp Wp 1
-        h_slices = (slice(0, -self.window_size),
-                    slice(-self.window_size, -self.shift_size),
-                    slice(-self.shift_size, None))
-        w_slices = (slice(0, -self.window_size),
-                    slice(-self.window_size, -self.shift_size),
-                    slice(-self.shift_size, None))
-        cnt = 0
-        for h in h_slices:
-            for w in w_slices:
-                img_mask[:, h, w, :] = cnt
-                cnt += 1
-
-        mask_windows = window_partition(img_mask, self.window_size)  # nW, window_size, window_size, 1
-        mask_windows = mask_windows.view(-1, self.window_size * self.window_size)
-        attn_mask = mask_windows.unsqueeze(1) - mask_windows.unsqueeze(2)
-        attn_mask = attn_mask.masked_fill(attn_mask != 0, float(-100.0)).masked_fill(attn_mask == 0, float(0.0))
+        attn_mask = shifted_window_mask(Hp, Wp, self.window_size, self.shift_size, x.device)
 
         for blk in self.blocks:
             blk.H, blk.W = H, W
@@ -454,6 +554,7 @@ class SwinTransformer(nn.Module):
         frozen_stages (int): Stages to be frozen (stop grad and set eval mode).
             -1 means not freezing any parameters.
         use_checkpoint (bool): Whether to use checkpointing to save memory. Default: False.
+        use_fused_attn (bool): Use scaled_dot_product_attention in WindowAttention. Default: False.
     """
 
     def __init__(self,
@@ -476,7 +577,8 @@ class SwinTransformer(nn.Module):
                  frozen_stages=-1,
                  use_checkpoint=False,
                  out_features=["stage2", "stage3", "stage4", "stage5"],
-                 backbone_arch="SWINT-FPN-RETINANET"):
+                 backbone_arch="SWINT-FPN-RETINANET",
+                 use_fused_attn=False):
         super(SwinTransformer, self).__init__()
 
         print("VISION BACKBONE USE GRADIENT CHECKPOINTING: ", use_checkpoint)
@@ -529,7 +631,8 @@ class SwinTransformer(nn.Module):
                 drop_path=dpr[sum(depths[:i_layer]):sum(depths[:i_layer + 1])],
                 norm_layer=norm_layer,
                 downsample=PatchMerging if (i_layer < self.num_layers - 1) else None,
-                use_checkpoint=use_checkpoint and i_layer > self.frozen_stages - 1)
+                use_checkpoint=use_checkpoint and i_layer > self.frozen_stages - 1,
+                use_fused_attn=use_fused_attn)
             self.layers.append(layer)
 
             stage = f'stage{i_layer + 2}'
@@ -646,5 +749,6 @@ def build_swint_backbone(cfg):
         frozen_stages=cfg.MODEL.BACKBONE.FREEZE_CONV_BODY_AT,
         backbone_arch=cfg.MODEL.BACKBONE.CONV_BODY,
         use_checkpoint=cfg.MODEL.BACKBONE.USE_CHECKPOINT,
-        out_features=cfg.MODEL.BACKBONE.OUT_FEATURES
+        out_features=cfg.MODEL.BACKBONE.OUT_FEATURES,
+        use_fused_attn=cfg.MODEL.SWINT.USE_FUSED_ATTN
     )
\ No newline at end of file
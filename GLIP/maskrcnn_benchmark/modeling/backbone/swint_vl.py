@@ -10,6 +10,8 @@ import torch.utils.checkpoint as checkpoint
 import numpy as np
 from timm.models.layers import DropPath, to_2tuple, trunc_normal_
 
+from .swint import shifted_window_mask, fused_window_attention
+
 
 class Mlp(nn.Module):
     """ Multilayer perceptron."""
@@ -73,10 +75,13 @@ class WindowAttention(nn.Module):
         qk_scale (float | None, optional): Override default qk scale of head_dim ** -0.5 if set
         attn_drop (float, optional): Dropout ratio of attention weight. Default: 0.0
         proj_drop (float, optional): Dropout ratio of output. Default: 0.0
+        use_fused_attn (bool, optional): If True, run the image only attention (no x_text) through
+            F.scaled_dot_product_attention. With text, the image to text bias and text mask vary per image,
+            a mask for sdpa would be as large as the attention weights, so that path stays explicit. Default: False
     """
 
     def __init__(self, dim, window_size, num_heads, qkv_bias=True, qk_scale=None, attn_drop=0., proj_drop=0.,
-                 ntext=None, dim_text=None):
+                 ntext=None, dim_text=None, use_fused_attn=False):
 
         super().__init__()
         self.dim = dim
@@ -84,6 +89,9 @@ class WindowAttention(nn.Module):
         self.num_heads = num_heads
         head_dim = dim // num_heads
         self.scale = qk_scale or head_dim ** -0.5
+        # sdpa scales by head_dim ** -0.5 itself, q is only rescaled when qk_scale overrides it
+        self.fused_q_scale = self.scale * head_dim ** 0.5
+        self.use_fused_attn = use_fused_attn and hasattr(F, "scaled_dot_product_attention")
 
         # define a parameter table of relative position bias
         self.relative_position_bias_table = nn.Parameter(
@@ -109,6 +117,7 @@ class WindowAttention(nn.Module):
 
         trunc_normal_(self.relative_position_bias_table, std=.02)
         self.softmax = nn.Softmax(dim=-1)
+        self._bias_cache = None
 
         if ntext is not None:
             self.qkv_text = nn.Linear(dim_text, dim * 3, bias=qkv_bias)
@@ -121,6 +130,23 @@ class WindowAttention(nn.Module):
             trunc_normal_(self.i2t_relative_position_bias, std=.02)
             trunc_normal_(self.t2t_relative_position_bias, std=.02)
 
+    def get_relative_position_bias(self):
+        """ Gather the (nH, Wh*Ww, Wh*Ww) relative position bias. In inference it is gathered once and
+        reused until the bias table is moved or loaded again.
+        """
+        cacheable = not self.training and not torch.is_grad_enabled()
+        table = self.relative_position_bias_table
+        key = (table.data_ptr(), table._version)
+        if cacheable and self._bias_cache is not None and self._bias_cache[0] == key:
+            return self._bias_cache[1]
+
+        relative_position_bias = table[self.relative_position_index.view(-1)].view(
+            self.window_size[0] * self.window_size[1], self.window_size[0] * self.window_size[1], -1)  # Wh*Ww,Wh*Ww,nH
+        relative_position_bias = relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
+        if cacheable:
+            self._bias_cache = (key, relative_position_bias)
+        return relative_position_bias
+
     def forward(self, x, mask=None, x_text=None, mask_text=None):
         """ Forward function.
         Args:
@@ -133,12 +159,18 @@ class WindowAttention(nn.Module):
         qkv = self.qkv(x).reshape(B_, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
         q, k, v = qkv[0], qkv[1], qkv[2]  # make torchscript happy (cannot use tensor as tuple)
 
+        relative_position_bias = self.get_relative_position_bias()  # nH, Wh*Ww, Wh*Ww
+
+        if self.use_fused_attn and x_text is None:
+            x = fused_window_attention(q, k, v, relative_position_bias, mask, q_scale=self.fused_q_scale,
+                                       dropout_p=self.attn_drop.p if self.training else 0.)
+            x = self.proj(x)
+            x = self.proj_drop(x)
+            return x, x_text
+
         q = q * self.scale
         attn = (q @ k.transpose(-2, -1))
 
-        relative_position_bias = self.relative_position_bias_table[self.relative_position_index.view(-1)].view(
-            self.window_size[0] * self.window_size[1], self.window_size[0] * self.window_size[1], -1)  # Wh*Ww,Wh*Ww,nH
-        relative_position_bias = relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
         attn = attn + relative_position_bias.unsqueeze(0)
 
         if mask is not None:
@@ -226,11 +258,12 @@ class SwinTransformerBlock(nn.Module):
         drop_path (float, optional): Stochastic depth rate. Default: 0.0
         act_layer (nn.Module, optional): Activation layer. Default: nn.GELU
         norm_layer (nn.Module, optional): Normalization layer.  Default: nn.LayerNorm
+        use_fused_attn (bool, optional): Use scaled_dot_product_attention in WindowAttention. Default: False
     """
 
     def __init__(self, dim, num_heads, window_size=7, shift_size=0,
                  mlp_ratio=4., qkv_bias=True, qk_scale=None, drop=0., attn_drop=0., drop_path=0.,
-                 act_layer=nn.GELU, norm_layer=nn.LayerNorm, ntext=None, dim_text=None):
+                 act_layer=nn.GELU, norm_layer=nn.LayerNorm, ntext=None, dim_text=None, use_fused_attn=False):
         super().__init__()
         self.dim = dim
         self.num_heads = num_heads
@@ -243,7 +276,7 @@ class SwinTransformerBlock(nn.Module):
         self.attn = WindowAttention(
             dim, window_size=to_2tuple(self.window_size), num_heads=num_heads,
             qkv_bias=qkv_bias, qk_scale=qk_scale, attn_drop=attn_drop, proj_drop=drop,
-            ntext=ntext, dim_text=dim_text
+            ntext=ntext, dim_text=dim_text, use_fused_attn=use_fused_attn
         )
 
         self.drop_path = DropPath(drop_path) if drop_path > 0. else nn.Identity()
@@ -390,6 +423,7 @@ class BasicLayer(nn.Module):
         norm_layer (nn.Module, optional): Normalization layer. Default: nn.LayerNorm
         downsample (nn.Module | None, optional): Downsample layer at the end of the layer. Default: None
         use_checkpoint (bool): Whether to use checkpointing to save memory. Default: False.
+        use_fused_attn (bool): Use scaled_dot_product_attention in WindowAttention. Default: False.
     """
 
     def __init__(self,
@@ -407,7 +441,8 @@ class BasicLayer(nn.Module):
                  downsample=None,
                  use_checkpoint=False,
                  ntext=None,
-                 dim_text=None):
+                 dim_text=None,
+                 use_fused_attn=False):
         super().__init__()
         self.window_size = window_size
         self.shift_size = window_size // 2
@@ -429,7 +464,8 @@ class BasicLayer(nn.Module):
                 drop_path=drop_path[i] if isinstance(drop_path, list) else drop_path,
                 norm_layer=norm_layer,
                 ntext=ntext,
-                dim_text=dim_text)
+                dim_text=dim_text,
+                use_fused_attn=use_fused_attn)
             for i in range(depth)])
 
         # patch merging layer
@@ -450,23 +486,7 @@ class BasicLayer(nn.Module):
         # calculate attention mask for SW-MSA
         Hp = int(np.ceil(H / self.window_size)) * self.window_size
         Wp = int(np.ceil(W / self.window_size)) * self.window_size
-        img_mask = torch.zeros((1, Hp, Wp, 1), device=x.device)  # 1 Hp Wp 1
-        h_slices = (slice(0, -self.window_size),
-                    slice(-self.window_size, -self.shift_size),
-                    slice(-self.shift_size, None))
-        w_slices = (slice(0, -self.window_size),
-                    slice(-self.window_size, -self.shift_size),
-                    slice(-self.shift_size, None))
-        cnt = 0
-        for h in h_slices:
-            for w in w_slices:
-                img_mask[:, h, w, :] = cnt
-                cnt += 1
-
-        mask_windows = window_partition(img_mask, self.window_size)  # nW, window_size, window_size, 1
-        mask_windows = mask_windows.view(-1, self.window_size * self.window_size)
-        attn_mask = mask_windows.unsqueeze(1) - mask_windows.unsqueeze(2)
-        attn_mask = attn_mask.masked_fill(attn_mask != 0, float(-100.0)).masked_fill(attn_mask == 0, float(0.0))
+        attn_mask = shifted_window_mask(Hp, Wp, self.window_size, self.shift_size, x.device)
 
         for blk in self.blocks:
             blk.H, blk.W = H, W
@@ -550,6 +570,7 @@ class SwinTransformer(nn.Module):
         frozen_stages (int): Stages to be frozen (stop grad and set eval mode).
             -1 means not freezing any parameters.
         use_checkpoint (bool): Whether to use checkpointing to save memory. Default: False.
+        use_fused_attn (bool): Use scaled_dot_product_attention in the image only WindowAttention. Default: False.
     """
 
     def __init__(self,
@@ -574,7 +595,8 @@ class SwinTransformer(nn.Module):
                  out_features=["stage2", "stage3", "stage4", "stage5"],
                  backbone_arch="SWINT-FPN-RETINANET",
                  max_query_len=None,
-                 lang_dim=None):
+                 lang_dim=None,
+                 use_fused_attn=False):
         super(SwinTransformer, self).__init__()
 
         print("VISION BACKBONE USE GRADIENT CHECKPOINTING: ", use_checkpoint)
@@ -633,7 +655,8 @@ class SwinTransformer(nn.Module):
                 downsample=PatchMerging if (i_layer < self.num_layers - 1) else None,
                 use_checkpoint=use_checkpoint and i_layer > self.frozen_stages - 1,
                 ntext=ntext,
-                dim_text=dim_text
+                dim_text=dim_text,
+                use_fused_attn=use_fused_attn
             )
             self.layers.append(layer)
 
@@ -770,5 +793,6 @@ def build_swint_backbone(cfg):
         use_checkpoint=cfg.MODEL.BACKBONE.USE_CHECKPOINT,
         out_features=cfg.MODEL.BACKBONE.OUT_FEATURES,
         max_query_len=cfg.MODEL.LANGUAGE_BACKBONE.MAX_QUERY_LEN,
-        lang_dim=cfg.MODEL.LANGUAGE_BACKBONE.LANG_DIM
+        lang_dim=cfg.MODEL.LANGUAGE_BACKBONE.LANG_DIM,
+        use_fused_attn=cfg.MODEL.SWINT.USE_FUSED_ATTN
     )
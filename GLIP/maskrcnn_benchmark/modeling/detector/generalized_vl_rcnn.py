@@ -15,7 +15,7 @@ from ..backbone import build_backbone
 from ..rpn import build_rpn
 from ..roi_heads import build_roi_heads
 
-from ..language_backbone import build_language_backbone
+from ..language_backbone import build_language_backbone, LanguageFeatureCache
 from transformers import AutoTokenizer
 
 import random
@@ -94,6 +94,9 @@ class GeneralizedVLRCNN(nn.Module):
         self.tokenizer_vocab_ids = [item for key, item in self.tokenizer_vocab.items()]
 
         self.language_backbone = build_language_backbone(cfg)
+        self.language_cache = None
+        if cfg.MODEL.LANGUAGE_BACKBONE.FEATURE_CACHE_SIZE > 0:
+            self.enable_language_cache(cfg.MODEL.LANGUAGE_BACKBONE.FEATURE_CACHE_SIZE)
 
         self.rpn = build_rpn(cfg)
         self.roi_heads = build_roi_heads(cfg)
@@ -131,6 +134,14 @@ class GeneralizedVLRCNN(nn.Module):
             self.class_name_to_knowledge = load_from_yaml_file(self.cfg.GLIPKNOW.KNOWLEDGE_FILE)
             self.class_name_list = sorted([k for k in self.class_name_to_knowledge])
 
+    def enable_language_cache(self, max_size=64):
+        """
+        Cache the language backbone output of repeated prompts (fixed vocabulary evaluation
+        or serving). The cache is only used when no gradient flows into the language backbone.
+        max_size=0 disables it.
+        """
+        self.language_cache = LanguageFeatureCache(max_size) if max_size > 0 else None
+
     def train(self, mode=True):
         """Convert the model into training mode while keep layers freezed."""
         super(GeneralizedVLRCNN, self).train(mode)
@@ -198,6 +209,51 @@ class GeneralizedVLRCNN(nn.Module):
         # batch_size = images.tensors.shape[0]
         device = images.tensors.device
 
+        language_dict_features, positive_map = self._forward_language(
+            captions=captions, targets=targets, device=device,
+            positive_map=positive_map, greenlight_map=greenlight_map)
+        # visual embedding
+        swint_feature_c4 = None
+        if 'vl' in self.cfg.MODEL.SWINT.VERSION:
+            # the backbone only updates the "hidden" field in language_dict_features
+            inputs = {"img": images.tensors, "lang": language_dict_features}
+            visual_features, language_dict_features, swint_feature_c4 = self.backbone(inputs)
+        else:
+            visual_features = self.backbone(images.tensors)
+        return self._forward_heads(images, visual_features, targets, language_dict_features,
+                                   positive_map, captions, swint_feature_c4)
+
+    def forward_multi_query(self, images, all_captions, all_positive_maps):
+        """
+        Inference of several queries (e.g. the chunks of a chunked evaluation) on the same images.
+        The visual backbone runs once, only the language backbone, fusion and heads are replayed
+        for each query.
+
+        Arguments:
+            images (ImageList): images to be processed
+            all_captions (list[list[str]]): captions of each query, one per image
+            all_positive_maps (list): positive map of each query
+
+        Returns:
+            list[list[BoxList]]: the detections of each query
+        """
+        assert not self.training, "forward_multi_query is for inference only"
+        if 'vl' in self.cfg.MODEL.SWINT.VERSION:
+            # language is fused inside the backbone, there is nothing query-independent to share
+            return [self(images, captions=captions, positive_map=positive_map)
+                    for captions, positive_map in zip(all_captions, all_positive_maps)]
+
+        device = images.tensors.device
+        visual_features = self.backbone(images.tensors)
+        results = []
+        for captions, positive_map in zip(all_captions, all_positive_maps):
+            language_dict_features, positive_map = self._forward_language(
+                captions=captions, device=device, positive_map=positive_map)
+            results.append(self._forward_heads(images, visual_features, None, language_dict_features,
+                                               positive_map, captions))
+        return results
+
+    def _forward_language(self, captions=None, targets=None, device=None, positive_map=None, greenlight_map=None):
         if self.cfg.GLIPKNOW.PARALLEL_LANGUAGE_INPUT:
             language_dict_features, positive_map = self._forward_language_parallel(
                     captions=captions, targets=targets, device=device,
@@ -230,7 +286,12 @@ class GeneralizedVLRCNN(nn.Module):
                 tokenizer_input = {"input_ids": input_ids,
                                 "attention_mask": tokenized.attention_mask}
 
-                if self.cfg.MODEL.LANGUAGE_BACKBONE.FREEZE:
+                use_cache = self.language_cache is not None and mlm_labels is None \
+                    and (self.cfg.MODEL.LANGUAGE_BACKBONE.FREEZE or not torch.is_grad_enabled())
+                if use_cache:
+                    with torch.no_grad():
+                        language_dict_features = self.language_cache(self.language_backbone, tokenizer_input)
+                elif self.cfg.MODEL.LANGUAGE_BACKBONE.FREEZE:
                     with torch.no_grad():
                         language_dict_features = self.language_backbone(tokenizer_input)
                 else:
@@ -248,14 +309,11 @@ class GeneralizedVLRCNN(nn.Module):
                     language_dict_features["masks"] = 1 - tokenized.special_tokens_mask
                 
                 language_dict_features["mlm_labels"] = mlm_labels
-        # visual embedding
-        swint_feature_c4 = None
-        if 'vl' in self.cfg.MODEL.SWINT.VERSION:
-            # the backbone only updates the "hidden" field in language_dict_features
-            inputs = {"img": images.tensors, "lang": language_dict_features}
-            visual_features, language_dict_features, swint_feature_c4 = self.backbone(inputs)
-        else:
-            visual_features = self.backbone(images.tensors)
+        return language_dict_features, positive_map
+
+    def _forward_heads(self, images, visual_features, targets, language_dict_features,
+                       positive_map=None, captions=None, swint_feature_c4=None):
+        device = images.tensors.device
         # rpn force boxes
         if targets:
             targets = [target.to(device)
@@ -4,3 +4,4 @@ from .build import build_tokenizer
 from .hfpt_tokenizer import HFPTTokenizer
 from .simple_tokenizer import SimpleTokenizer
 from .clip_model import CLIPTransformer
+from .feature_cache import LanguageFeatureCache
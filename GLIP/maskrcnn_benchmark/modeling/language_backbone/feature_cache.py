@@ -0,0 +1,74 @@
+"""
+LRU cache of language backbone outputs for repeated prompts.
+"""
+from collections import OrderedDict
+
+import torch
+
+
+class LanguageFeatureCache(object):
+    """
+    Caches the output dict of the language backbone, keyed by the token ids and
+    attention mask of the prompt and by a version of the language backbone weights,
+    so that a fixed prompt (e.g. the class names of a detection dataset) is encoded
+    only once. A batch whose rows are all the same prompt is stored as a single row
+    and broadcast back to the batch size on lookup.
+    """
+
+    def __init__(self, max_size=64):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._weights_version = None
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        self._entries.clear()
+        self._weights_version = None
+
+    @staticmethod
+    def weights_version(module):
+        # in-place updates (optimizer steps, load_state_dict) bump the tensor version,
+        # .to() / .half() swap the storage
+        return hash(tuple((p.data_ptr(), p._version) for p in module.parameters()))
+
+    def __call__(self, language_backbone, tokenizer_input):
+        """
+        Returns the language backbone output for tokenizer_input, computing it only
+        on a cache miss. The returned dict and tensors can be modified by the caller.
+        """
+        version = self.weights_version(language_backbone)
+        if version != self._weights_version:
+            self._entries.clear()
+            self._weights_version = version
+
+        input_ids = tokenizer_input["input_ids"]
+        attention_mask = tokenizer_input["attention_mask"]
+        batch_size = input_ids.shape[0]
+        broadcast = batch_size > 1 and bool((input_ids == input_ids[:1]).all()) \
+            and bool((attention_mask == attention_mask[:1]).all())
+        if broadcast:
+            input_ids = input_ids[:1]
+            attention_mask = attention_mask[:1]
+
+        key = (tuple(input_ids.shape),
+               input_ids.cpu().numpy().tobytes(),
+               attention_mask.cpu().numpy().tobytes())
+        features = self._entries.get(key)
+        if features is None:
+            self.misses += 1
+            features = language_backbone({"input_ids": input_ids, "attention_mask": attention_mask})
+            features = {k: v.detach() if torch.is_tensor(v) else v for k, v in features.items()}
+            self._entries[key] = features
+            if len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        else:
+            self.hits += 1
+            self._entries.move_to_end(key)
+
+        repeat = batch_size if broadcast else 1
+        return {k: v.repeat(repeat, *([1] * (v.dim() - 1))) if torch.is_tensor(v) else v
+                for k, v in features.items()}
@@ -1,5 +1,6 @@
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
 import math
+from collections import OrderedDict
 
 import numpy as np
 import torch
@@ -44,6 +45,7 @@ class AnchorGenerator(nn.Module):
         aspect_ratios=(0.5, 1.0, 2.0),
         anchor_strides=(8, 16, 32),
         straddle_thresh=0,
+        cache_size=0,
     ):
         super(AnchorGenerator, self).__init__()
 
@@ -67,6 +69,21 @@ class AnchorGenerator(nn.Module):
         self.cell_anchors = BufferList(cell_anchors)
         self.straddle_thresh = straddle_thresh
 
+        # LRU cache of the anchors (with visibility) of an image, keyed by
+        # (feature map sizes, image size, device), emptied when the module is moved or cast
+        self.cache_size = cache_size
+        self._anchor_cache = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def clear_cache(self):
+        self._anchor_cache.clear()
+
+    def _apply(self, fn):
+        # .to(), .cuda(), .half() etc. change the cell anchors the cached anchors were built from
+        self.clear_cache()
+        return super(AnchorGenerator, self)._apply(fn)
+
     def num_anchors_per_location(self):
         return [len(cell_anchors) for cell_anchors in self.cell_anchors]
 
@@ -111,28 +128,40 @@ class AnchorGenerator(nn.Module):
 
     def forward(self, image_list, feature_maps):
         grid_sizes = [feature_map.shape[-2:] for feature_map in feature_maps]
-        anchors_over_all_feature_maps = self.grid_anchors(grid_sizes)
-        anchors = []
         if isinstance(image_list, ImageList):
-            for i, (image_height, image_width) in enumerate(image_list.image_sizes):
+            image_sizes = [(int(image_width), int(image_height))
+                           for image_height, image_width in image_list.image_sizes]
+        else:
+            image_height, image_width = [int(x) for x in image_list.size()[-2:]]
+            image_sizes = [(image_width, image_height)]
+
+        grid_key = tuple(tuple(int(s) for s in size) for size in grid_sizes)
+        device = next(iter(self.cell_anchors)).device
+        anchors_over_all_feature_maps = None
+        anchors = []
+        for image_size in image_sizes:
+            key = (grid_key, image_size, device)
+            anchors_in_image = self._anchor_cache.get(key)
+            if anchors_in_image is not None:
+                self.cache_hits += 1
+                self._anchor_cache.move_to_end(key)
+            else:
+                self.cache_misses += 1
+                if anchors_over_all_feature_maps is None:
+                    anchors_over_all_feature_maps = self.grid_anchors(grid_sizes)
                 anchors_in_image = []
                 for anchors_per_feature_map in anchors_over_all_feature_maps:
                     boxlist = BoxList(
-                        anchors_per_feature_map, (image_width, image_height), mode="xyxy"
+                        anchors_per_feature_map, image_size, mode="xyxy"
                     )
                     self.add_visibility_to(boxlist)
                     anchors_in_image.append(boxlist)
-                anchors.append(anchors_in_image)
-        else:
-            image_height, image_width = [int(x) for x in image_list.size()[-2:]]
-            anchors_in_image = []
-            for anchors_per_feature_map in anchors_over_all_feature_maps:
-                boxlist = BoxList(
-                    anchors_per_feature_map, (image_width, image_height), mode="xyxy"
-                )
-                self.add_visibility_to(boxlist)
-                anchors_in_image.append(boxlist)
-            anchors.append(anchors_in_image)
+                if self.cache_size > 0:
+                    self._anchor_cache[key] = anchors_in_image
+                    if len(self._anchor_cache) > self.cache_size:
+                        self._anchor_cache.popitem(last=False)
+            # callers get their own BoxLists, the cached tensors are shared
+            anchors.append([boxlist.copy_with_fields("visibility") for boxlist in anchors_in_image])
         return anchors
 
 
@@ -149,7 +178,8 @@ def make_anchor_generator(config):
     else:
         assert len(anchor_stride) == 1, "Non-FPN should have a single ANCHOR_STRIDE"
     anchor_generator = AnchorGenerator(
-        anchor_sizes, aspect_ratios, anchor_stride, straddle_thresh
+        anchor_sizes, aspect_ratios, anchor_stride, straddle_thresh,
+        cache_size=config.MODEL.RPN.ANCHOR_CACHE_SIZE
     )
     return anchor_generator
 
@@ -176,7 +206,8 @@ def make_anchor_generator_complex(config):
         new_anchor_sizes = anchor_sizes
 
     anchor_generator = AnchorGenerator(
-        tuple(new_anchor_sizes), aspect_ratios, anchor_strides, straddle_thresh
+        tuple(new_anchor_sizes), aspect_ratios, anchor_strides, straddle_thresh,
+        cache_size=config.MODEL.RPN.ANCHOR_CACHE_SIZE
     )
     return anchor_generator
 
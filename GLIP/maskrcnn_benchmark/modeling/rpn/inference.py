@@ -2,6 +2,7 @@
 import logging
 
 import torch
+import torch.nn.functional as F
 
 from maskrcnn_benchmark.modeling.box_coder import BoxCoder
 from maskrcnn_benchmark.structures.bounding_box import BoxList, _onnx_clip_boxes_to_image
@@ -645,8 +646,8 @@ class ATSSPostProcessor(torch.nn.Module):
             token_logits = permute_and_flatten(token_logits, N, A, T, H, W)
             token_logits = token_logits.sigmoid()
             # turn back to original classes
-            scores = convert_grounding_to_od_logits(logits=token_logits, box_cls=box_cls, positive_map=positive_map,
-                                                    score_agg=self.score_agg)
+            scores = _convert_per_image(convert_grounding_to_od_logits, token_logits, positive_map,
+                                        box_cls=box_cls, score_agg=self.score_agg)
             box_cls = scores
 
         # binary dot product focal version
@@ -654,16 +655,13 @@ class ATSSPostProcessor(torch.nn.Module):
             #print('Dot Product.')
             dot_product_logits = dot_product_logits.sigmoid()
             if self.mdetr_style_aggregate_class_num != -1:
-                scores = convert_grounding_to_od_logits_v2(
-                    logits=dot_product_logits,
-                    num_class=self.mdetr_style_aggregate_class_num,
-                    positive_map=positive_map,
-                    score_agg=self.score_agg,
-                    disable_minus_one=False)
+                scores = _convert_per_image(convert_grounding_to_od_logits_v2, dot_product_logits, positive_map,
+                                            num_class=self.mdetr_style_aggregate_class_num,
+                                            score_agg=self.score_agg,
+                                            disable_minus_one=False)
             else:
-                scores = convert_grounding_to_od_logits(logits=dot_product_logits, box_cls=box_cls,
-                                                        positive_map=positive_map,
-                                                        score_agg=self.score_agg)
+                scores = _convert_per_image(convert_grounding_to_od_logits, dot_product_logits, positive_map,
+                                            box_cls=box_cls, score_agg=self.score_agg)
             box_cls = scores
 
         box_regression = permute_and_flatten(box_regression, N, A, 4, H, W)
@@ -717,6 +715,16 @@ class ATSSPostProcessor(torch.nn.Module):
                 ):
         sampled_boxes = []
         anchors = list(zip(*anchors))
+        if positive_map is not None and self.score_agg != "ONEHOT" \
+                and (token_logits is not None or dot_product_logits is not None):
+            # built once per query, reused by every FPN level
+            device = box_regression[0].device
+            if isinstance(positive_map, (list, tuple)):
+                # one map per image: each image is only scored against its own labels
+                positive_map = [p if isinstance(p, LabelToTokenMap) else LabelToTokenMap(p, device=device)
+                                for p in positive_map]
+            elif not isinstance(positive_map, LabelToTokenMap):
+                positive_map = LabelToTokenMap(positive_map, device=device)
         for idx, (b, c, a) in enumerate(zip(box_regression, centerness, anchors)):
             o = None
             t = None
@@ -767,69 +775,125 @@ class ATSSPostProcessor(torch.nn.Module):
         return results
 
 
-def convert_grounding_to_od_logits(logits, box_cls, positive_map, score_agg=None):
-    scores = torch.zeros(logits.shape[0], logits.shape[1], box_cls.shape[2]).to(logits.device)
-    # 256 -> 80, average for each class
-    hurdle = 80
-    if positive_map is not None:
-        # score aggregation method
-        if score_agg == "MEAN":
-            for label_j, p_map in enumerate(positive_map):
-                if label_j >= hurdle:
-                    break
-                # print("torch.LongTensor(positive_map[label_j]):", torch.LongTensor(positive_map[label_j]))
-                try:
-                    scores[:, :, label_j] = logits[:, :, p_map].mean(-1)
-                except Exception as e:
-                    print("logits shape:", logits.shape)
-                    print("label_j:", label_j)
-                    print("p_map shape:", p_map.shape)
-
-        elif score_agg == "MAX":
-            # torch.max() returns (values, indices)
-            for label_j in positive_map:
-                scores[:, :, label_j - 1] = logits[:, :, torch.LongTensor(positive_map[label_j])].max(-1)[
-                    0]
-        elif score_agg == "ONEHOT":
-            # one hot
-            scores = logits[:, :, :len(positive_map)]
+class LabelToTokenMap(object):
+    """
+    Packed form of a label-to-token map, built once per query and shared by all FPN levels,
+    so that the token-to-label score aggregation runs as a few tensor ops for all labels.
+
+    positive_map is either a dict {label: token ids}, whose label goes to score column
+    label - 1 (label if disable_minus_one), or a (num_labels, T) tensor whose row j marks
+    the tokens of score column j.
+    """
+
+    def __init__(self, positive_map, disable_minus_one=False, device=None):
+        if torch.is_tensor(positive_map):
+            matrix = (positive_map != 0).float()
         else:
-            raise NotImplementedError
+            offset = 0 if disable_minus_one else 1
+            rows, cols = [], []
+            for label_j, tokens in positive_map.items():
+                if isinstance(tokens, int):
+                    tokens = [tokens]
+                rows += [label_j - offset] * len(tokens)
+                cols += list(tokens)
+            num_columns = max(positive_map.keys()) - offset + 1 if len(positive_map) > 0 else 0
+            num_tokens = max(cols) + 1 if len(cols) > 0 else 0
+            matrix = torch.zeros(num_columns, num_tokens)
+            matrix[torch.as_tensor(rows, dtype=torch.long), torch.as_tensor(cols, dtype=torch.long)] = 1
+        matrix = matrix.to(device)
+        # (num_columns, T) 0/1 membership and (num_columns,) token counts
+        self.matrix = matrix
+        self.counts = matrix.sum(-1)
+        # (num_columns, K) token ids padded to the longest label, with validity mask, for MAX / POWER
+        max_tokens = max(int(self.counts.max().item()), 1) if len(matrix) > 0 else 1
+        order = torch.sort(matrix, dim=-1, descending=True, stable=True)[1] if matrix.shape[1] > 0 \
+            else torch.zeros(len(matrix), 1, dtype=torch.long, device=matrix.device)
+        self.index = order[:, :max_tokens]
+        self.valid = torch.arange(max_tokens, device=matrix.device)[None, :] < self.counts[:, None]
+
+    def __len__(self):
+        return len(self.matrix)
+
+    def aggregate(self, logits, score_agg):
+        """(N, A, T) token scores -> (N, A, num_columns) label scores."""
+        num_tokens = min(logits.shape[-1], self.matrix.shape[1])
+        logits = logits[:, :, :num_tokens]
+        if score_agg == "MEAN":
+            weights = self.matrix[:, :num_tokens] / self.counts.clamp(min=1)[:, None]
+            return torch.matmul(logits, weights.t().to(logits.dtype))
+        index = self.index.clamp(max=max(num_tokens - 1, 0))
+        if score_agg == "MAX":
+            # scores are sigmoid outputs, so padding with 0 leaves the max unchanged
+            scores = logits.new_zeros(logits.shape[0], logits.shape[1], len(self))
+            for k in range(index.shape[1]):
+                scores = torch.max(scores, logits[:, :, index[:, k]] * self.valid[:, k].to(logits.dtype))
+            return scores
+        if score_agg == "POWER":
+            # geometric mean of the label's token scores, padding with 1 leaves the product unchanged
+            scores = logits.new_ones(logits.shape[0], logits.shape[1], len(self))
+            for k in range(index.shape[1]):
+                scores = scores * torch.where(self.valid[:, k], logits[:, :, index[:, k]], torch.ones_like(scores))
+            scores = torch.pow(scores, 1 / self.counts.clamp(min=1).to(logits.dtype))
+            return scores * (self.counts > 0).to(logits.dtype)
+        raise NotImplementedError
+
+
+def _fill_od_scores(logits, num_class, label_to_token, score_agg):
+    label_scores = label_to_token.aggregate(logits, score_agg)
+    # labels past num_class are kept instead of being dropped
+    num_class = max(num_class, label_scores.shape[-1])
+    scores = torch.zeros(logits.shape[0], logits.shape[1], num_class, dtype=logits.dtype, device=logits.device)
+    scores[:, :, :label_scores.shape[-1]] = label_scores
     return scores
 
 
+def _convert_per_image(convert_fn, logits, positive_map, box_cls=None, **kwargs):
+    """
+    Run convert_fn over the batch, or image by image when positive_map is a list with one
+    label-to-token map per image. Per-image scores are zero padded to a common width, so the
+    padded labels never pass the candidate threshold.
+    """
+    if not isinstance(positive_map, (list, tuple)):
+        if box_cls is not None:
+            kwargs["box_cls"] = box_cls
+        return convert_fn(logits=logits, positive_map=positive_map, **kwargs)
+    assert len(positive_map) == logits.shape[0], "expect one positive map per image"
+    scores = []
+    for i, per_image_map in enumerate(positive_map):
+        if box_cls is not None:
+            kwargs["box_cls"] = box_cls[i:i + 1]
+        scores.append(convert_fn(logits=logits[i:i + 1], positive_map=per_image_map, **kwargs))
+    num_class = max(score.shape[-1] for score in scores)
+    return torch.cat([F.pad(score, (0, num_class - score.shape[-1])) for score in scores], dim=0)
+
+
+def convert_grounding_to_od_logits(logits, box_cls=None, positive_map=None, score_agg=None):
+    num_class = box_cls.shape[2] if box_cls is not None else 0
+    if positive_map is None:
+        return torch.zeros(logits.shape[0], logits.shape[1], num_class).to(logits.device)
+    # score aggregation method
+    if score_agg == "ONEHOT":
+        # one hot
+        return logits[:, :, :len(positive_map)]
+    if score_agg not in ("MEAN", "MAX"):
+        raise NotImplementedError
+    if not isinstance(positive_map, LabelToTokenMap):
+        positive_map = LabelToTokenMap(positive_map, device=logits.device)
+    return _fill_od_scores(logits, num_class, positive_map, score_agg)
+
+
 def convert_grounding_to_od_logits_v2(logits, num_class, positive_map, score_agg=None, disable_minus_one = True):
-    
-    scores = torch.zeros(logits.shape[0], logits.shape[1], num_class).to(logits.device)
-    # 256 -> 80, average for each class
-    if positive_map is not None:
-        # score aggregation method
-        if score_agg == "MEAN":
-            for label_j in positive_map:
-                locations_label_j = positive_map[label_j]
-                if isinstance(locations_label_j, int):
-                    locations_label_j = [locations_label_j]
-                scores[:, :, label_j if disable_minus_one else label_j - 1] = logits[:, :, torch.LongTensor(locations_label_j)].mean(-1)
-        elif score_agg == "POWER":
-            for label_j in positive_map:
-                locations_label_j = positive_map[label_j]
-                if isinstance(locations_label_j, int):
-                    locations_label_j = [locations_label_j]
-
-                probability = torch.prod(logits[:, :, torch.LongTensor(locations_label_j)], dim=-1).squeeze(-1)
-                probability = torch.pow(probability, 1/len(locations_label_j))
-                scores[:, :, label_j if disable_minus_one else label_j - 1] = probability
-        elif score_agg == "MAX":
-            # torch.max() returns (values, indices)
-            for label_j in positive_map:
-                scores[:, :, label_j if disable_minus_one else label_j - 1] = logits[:, :, torch.LongTensor(positive_map[label_j])].max(-1)[
-                    0]
-        elif score_agg == "ONEHOT":
-            # one hot
-            scores = logits[:, :, :len(positive_map)]
-        else:
-            raise NotImplementedError
-    return scores
+    if positive_map is None:
+        return torch.zeros(logits.shape[0], logits.shape[1], num_class).to(logits.device)
+    # score aggregation method
+    if score_agg == "ONEHOT":
+        # one hot
+        return logits[:, :, :len(positive_map)]
+    if score_agg not in ("MEAN", "POWER", "MAX"):
+        raise NotImplementedError
+    if not isinstance(positive_map, LabelToTokenMap):
+        positive_map = LabelToTokenMap(positive_map, disable_minus_one=disable_minus_one, device=logits.device)
+    return _fill_od_scores(logits, num_class, positive_map, score_agg)
 
 def make_atss_postprocessor(config, box_coder, is_train=False):
     pre_nms_thresh = config.MODEL.ATSS.INFERENCE_TH
@@ -13,11 +13,13 @@ from ..utils import cat, concat_box_prediction_layers
 
 from maskrcnn_benchmark.layers import smooth_l1_loss
 from maskrcnn_benchmark.modeling.matcher import Matcher
-from maskrcnn_benchmark.structures.boxlist_ops import boxlist_iou
+from maskrcnn_benchmark.structures.boxlist_ops import boxlist_iou, _box_iou
 from maskrcnn_benchmark.structures.boxlist_ops import cat_boxlist
+from maskrcnn_benchmark.structures.bounding_box import BoxList
 from maskrcnn_benchmark.layers import SigmoidFocalLoss, IOULoss, TokenSigmoidFocalLoss
 from maskrcnn_benchmark.utils.comm import get_world_size, reduce_sum
 from maskrcnn_benchmark.utils.amp import custom_fwd, custom_bwd
+from maskrcnn_benchmark.utils.positive_map import span_maps
 from maskrcnn_benchmark.utils.shallow_contrastive_loss_helper import *
 
 from transformers import AutoTokenizer
@@ -650,184 +652,131 @@ class ATSSLossComputation(torch.nn.Module):
             assert losses.numel() != 0
             return losses.sum()
 
+    @staticmethod
+    def token_span_maps(targets, tokenized, num_tokens):
+        """
+        Token map of every gt box, a [num_gt, num_tokens] bool tensor per image, built for all
+        the char spans of the batch at once from the tokenizer offset mapping.
+        """
+        batch_tokens_positive = []
+        for targets_per_im in targets:
+            if "tokens_positive" in targets_per_im.fields():
+                batch_tokens_positive.append(targets_per_im.get_field("tokens_positive"))
+            else:
+                batch_tokens_positive.append(targets_per_im.get_field("tokens"))
+        return span_maps(tokenized, batch_tokens_positive, num_tokens)
+
     def prepare_targets(self, targets, anchors, tokenized=None, positive_map=None, proj_tokens=None):
-        cls_labels = []
-        reg_targets = []
+        """
+        ATSS assignment of the whole batch at once: the gt boxes of every image are padded to
+        the largest gt count, and padded gts are never selected as positives. The concatenated
+        anchors, [num_images, num_anchors, 4], are returned last for reuse by the loss.
+        """
+        num_images = len(targets)
+        device = targets[0].bbox.device
+        for targets_per_im in targets:
+            assert targets_per_im.mode == "xyxy"
+        num_gts = [len(targets_per_im.bbox) for targets_per_im in targets]
+        max_gt = max(max(num_gts), 1)
+        gt_valid = torch.arange(max_gt, device=device)[None, :] < torch.as_tensor(num_gts, device=device)[:, None]
+
+        def pad_gt(tensors, fill=0):
+            # [num_gt, ...] per image -> [num_images, max_gt, ...]
+            padded = tensors[0].new_full((num_images, max_gt) + tuple(tensors[0].shape[1:]), fill)
+            for im_i, tensor in enumerate(tensors):
+                padded[im_i, :len(tensor)] = tensor
+            return padded
+
+        def gather_gt(padded, index):
+            # padded: [num_images, max_gt, ...], index: [num_images, num_anchors]
+            index = index.view(index.shape + (1,) * (padded.dim() - 2))
+            return padded.gather(1, index.expand(index.shape[:2] + padded.shape[2:]))
+
+        bboxes = pad_gt([targets_per_im.bbox for targets_per_im in targets])
+        labels = pad_gt([targets_per_im.get_field("labels") for targets_per_im in targets])
+
+        anchors_bbox = torch.stack([torch.cat([anchors_per_level.bbox for anchors_per_level in anchors_per_im])
+                                    for anchors_per_im in anchors])
+        num_anchors_per_loc = len(self.cfg.MODEL.RPN.ASPECT_RATIOS) * self.cfg.MODEL.RPN.SCALES_PER_OCTAVE
+        num_anchors_per_level = [len(anchors_per_level.bbox) for anchors_per_level in anchors[0]]
+        ious = _box_iou(anchors_bbox, bboxes)
+
+        gt_points = (bboxes[..., 2:] + bboxes[..., :2]) / 2.0
+        anchor_points = (anchors_bbox[..., 2:] + anchors_bbox[..., :2]) / 2.0
+        distances = (anchor_points[:, :, None, :] - gt_points[:, None, :, :]).pow(2).sum(-1).sqrt()
+
+        # Selecting candidates based on the center distance between anchor box and object
+        candidate_idxs = []
+        star_idx = 0
+        for level in range(len(num_anchors_per_level)):
+            end_idx = star_idx + num_anchors_per_level[level]
+            distances_per_level = distances[:, star_idx:end_idx, :]
+            topk = min(self.cfg.MODEL.ATSS.TOPK * num_anchors_per_loc, num_anchors_per_level[level])
+            _, topk_idxs_per_level = distances_per_level.topk(topk, dim=1, largest=False)
+            candidate_idxs.append(topk_idxs_per_level + star_idx)
+            star_idx = end_idx
+        candidate_idxs = torch.cat(candidate_idxs, dim=1)
+
+        # Using the sum of mean and standard deviation as the IoU threshold to select final positive samples
+        candidate_ious = ious.gather(1, candidate_idxs)
+        iou_thresh_per_gt = candidate_ious.mean(1) + candidate_ious.std(1)
+        is_pos = candidate_ious >= iou_thresh_per_gt[:, None, :]
+
+        # Limiting the final positive samples’ center to object
+        candidate_cx = anchor_points[..., 0].gather(1, candidate_idxs.view(num_images, -1)).view_as(candidate_idxs)
+        candidate_cy = anchor_points[..., 1].gather(1, candidate_idxs.view(num_images, -1)).view_as(candidate_idxs)
+        l = candidate_cx - bboxes[:, None, :, 0]
+        t = candidate_cy - bboxes[:, None, :, 1]
+        r = bboxes[:, None, :, 2] - candidate_cx
+        b = bboxes[:, None, :, 3] - candidate_cy
+        is_in_gts = torch.stack([l, t, r, b], dim=-1).min(dim=-1)[0] > 0.01
+        is_pos = is_pos & is_in_gts & gt_valid[:, None, :]
+
+        # if an anchor box is assigned to multiple gts, the one with the highest IoU will be selected.
+        pos_mask = torch.zeros_like(ious, dtype=torch.bool).scatter_(1, candidate_idxs, is_pos)
+        ious_inf = torch.where(pos_mask, ious, torch.full_like(ious, -INF))
+        anchors_to_gt_values, anchors_to_gt_indexs = ious_inf.max(dim=2)
+        unmatched = anchors_to_gt_values == -INF
+
+        cls_labels = labels.gather(1, anchors_to_gt_indexs)
+        cls_labels[unmatched] = 0
+
+        matched_gts = gather_gt(bboxes, anchors_to_gt_indexs)
+        reg_targets = self.box_coder.encode(matched_gts.view(-1, 4), anchors_bbox.view(-1, 4)).view(num_images, -1, 4)
+
         token_labels = []
-        map_labels = []
+        if positive_map is not None:
+            token_labels = gather_gt(pad_gt(list(positive_map.split(num_gts))).to(device), anchors_to_gt_indexs)
+            unmatched_labels = torch.zeros(token_labels.shape[-1], dtype=token_labels.dtype, device=device)
+            # TODO: temporarially disable the [NoObj] token logic, and only restrict to binary loss
+            unmatched_labels[-1] = 1  # token: none object - > 256
+            token_labels[unmatched] = unmatched_labels
+            token_labels = list(token_labels)
 
+        map_labels = []
         gold_box_od_labels = []
         od_label_of_tokens_labels = []
         positive_indices = []
-
-        offset = 0
-
-        for im_i in range(len(targets)):
-            targets_per_im = targets[im_i]
-            assert targets_per_im.mode == "xyxy"
-            # bboxes_per_im = targets_per_im.get_field("boxes")
-            bboxes_per_im = targets_per_im.bbox
-            labels_per_im = targets_per_im.get_field("labels")
-            num_gt = len(bboxes_per_im)
-
-            if positive_map is not None:
-                token_per_im = positive_map[offset:offset + num_gt, :]
-                offset += num_gt
-
-            # Recheck if the label matches with the positive map
-            # print(labels_per_im)
-            # print(token_per_im.nonzero())
+        if positive_map is not None and proj_tokens is not None:
+            maps = self.token_span_maps(targets, tokenized, proj_tokens.shape[1])
+            map_labels = gather_gt(pad_gt(maps, False).to(device), anchors_to_gt_indexs)
+            map_labels[unmatched] = False  # map: none False
+            map_labels = list(map_labels)
 
             # shallow contrastive
-            if "original_od_label" in targets_per_im.fields():
-                gold_box_od_label = targets_per_im.get_field("original_od_label")
-            if "positive_map_for_od_labels" in targets_per_im.fields():
-                od_label_of_token_per_im = targets_per_im.get_field("positive_map_for_od_labels")
-
-            # print(gold_box_od_label)
-            # print(od_label_of_token_per_im)
-
-            if positive_map is not None and proj_tokens is not None:
-                if "tokens_positive" in targets_per_im.fields():
-                    cur_tokens = targets_per_im.get_field("tokens_positive")
-                else:
-                    cur_tokens = targets_per_im.get_field("tokens")
-                map = torch.zeros((len(cur_tokens), proj_tokens.shape[1]), dtype=torch.bool)
-                for j, tok_list in enumerate(cur_tokens):
-                    for (beg, end) in tok_list:
-                        beg_pos = tokenized.char_to_token(im_i, beg)
-                        end_pos = tokenized.char_to_token(im_i, end - 1)
-                        if beg_pos is None:
-                            try:
-                                beg_pos = tokenized.char_to_token(im_i, beg + 1)
-                                if beg_pos is None:
-                                    beg_pos = tokenized.char_to_token(im_i, beg + 2)
-                            except:
-                                beg_pos = None
-                        if end_pos is None:
-                            try:
-                                end_pos = tokenized.char_to_token(im_i, end - 2)
-                                if end_pos is None:
-                                    end_pos = tokenized.char_to_token(im_i, end - 3)
-                            except:
-                                end_pos = None
-                        if beg_pos is None or end_pos is None:
-                            continue
-
-                        assert beg_pos is not None and end_pos is not None
-                        map[j, beg_pos: end_pos + 1].fill_(True)
-
-            anchors_per_im = cat_boxlist(anchors[im_i])
-
-            num_anchors_per_loc = len(self.cfg.MODEL.RPN.ASPECT_RATIOS) * self.cfg.MODEL.RPN.SCALES_PER_OCTAVE
-            num_anchors_per_level = [len(anchors_per_level.bbox) for anchors_per_level in anchors[im_i]]
-            ious = boxlist_iou(anchors_per_im, targets_per_im)
-
-            gt_cx = (bboxes_per_im[:, 2] + bboxes_per_im[:, 0]) / 2.0
-            gt_cy = (bboxes_per_im[:, 3] + bboxes_per_im[:, 1]) / 2.0
-            gt_points = torch.stack((gt_cx, gt_cy), dim=1)
-
-            anchors_cx_per_im = (anchors_per_im.bbox[:, 2] + anchors_per_im.bbox[:, 0]) / 2.0
-            anchors_cy_per_im = (anchors_per_im.bbox[:, 3] + anchors_per_im.bbox[:, 1]) / 2.0
-            anchor_points = torch.stack((anchors_cx_per_im, anchors_cy_per_im), dim=1)
-
-            distances = (anchor_points[:, None, :] - gt_points[None, :, :]).pow(2).sum(-1).sqrt()
-
-            # Selecting candidates based on the center distance between anchor box and object
-            candidate_idxs = []
-            star_idx = 0
-            for level, anchors_per_level in enumerate(anchors[im_i]):
-                end_idx = star_idx + num_anchors_per_level[level]
-                distances_per_level = distances[star_idx:end_idx, :]
-                topk = min(self.cfg.MODEL.ATSS.TOPK * num_anchors_per_loc, num_anchors_per_level[level])
-                _, topk_idxs_per_level = distances_per_level.topk(topk, dim=0, largest=False)
-                candidate_idxs.append(topk_idxs_per_level + star_idx)
-                star_idx = end_idx
-            candidate_idxs = torch.cat(candidate_idxs, dim=0)
-
-            # Using the sum of mean and standard deviation as the IoU threshold to select final positive samples
-            candidate_ious = ious[candidate_idxs, torch.arange(num_gt)]
-            iou_mean_per_gt = candidate_ious.mean(0)
-            iou_std_per_gt = candidate_ious.std(0)
-            iou_thresh_per_gt = iou_mean_per_gt + iou_std_per_gt
-            is_pos = candidate_ious >= iou_thresh_per_gt[None, :]
-
-            # Limiting the final positive samples’ center to object
-            anchor_num = anchors_cx_per_im.shape[0]
-            for ng in range(num_gt):
-                candidate_idxs[:, ng] += ng * anchor_num
-            e_anchors_cx = anchors_cx_per_im.view(1, -1).expand(num_gt, anchor_num).contiguous().view(-1)
-            e_anchors_cy = anchors_cy_per_im.view(1, -1).expand(num_gt, anchor_num).contiguous().view(-1)
-            candidate_idxs = candidate_idxs.view(-1)
-            l = e_anchors_cx[candidate_idxs].view(-1, num_gt) - bboxes_per_im[:, 0]
-            t = e_anchors_cy[candidate_idxs].view(-1, num_gt) - bboxes_per_im[:, 1]
-            r = bboxes_per_im[:, 2] - e_anchors_cx[candidate_idxs].view(-1, num_gt)
-            b = bboxes_per_im[:, 3] - e_anchors_cy[candidate_idxs].view(-1, num_gt)
-            is_in_gts = torch.stack([l, t, r, b], dim=1).min(dim=1)[0] > 0.01
-            is_pos = is_pos & is_in_gts
-
-            # if an anchor box is assigned to multiple gts, the one with the highest IoU will be selected.
-            ious_inf = torch.full_like(ious, -INF).t().contiguous().view(-1)
-            index = candidate_idxs.view(-1)[is_pos.view(-1)]
-            ious_inf[index] = ious.t().contiguous().view(-1)[index]
-            ious_inf = ious_inf.view(num_gt, -1).t()
-
-            anchors_to_gt_values, anchors_to_gt_indexs = ious_inf.max(dim=1)
-            # get positive anchors index from ATSS
-            positive_index = [i[0].item() for i in torch.nonzero(anchors_to_gt_indexs)]
-            cls_labels_per_im = labels_per_im[anchors_to_gt_indexs]
-            cls_labels_per_im[anchors_to_gt_values == -INF] = 0
-
-            if positive_map is not None:
-                token_labels_per_im = token_per_im[anchors_to_gt_indexs]
-                unmatched_labels = torch.zeros(token_labels_per_im.shape[1], device=token_labels_per_im.device)
-                # TODO: temporarially disable the [NoObj] token logic, and only restrict to binary loss
-                unmatched_labels[-1] = 1  # token: none object - > 256
-                token_labels_per_im[anchors_to_gt_values == -INF] = unmatched_labels
-                # move from cpu to gpu
-                token_labels_per_im = token_labels_per_im.to(cls_labels_per_im.device)
-
-                # print(token_labels_per_im[anchors_to_gt_values == -INF].shape)
-                # print(cls_labels_per_im[anchors_to_gt_values != -INF][0])
-                # print(token_labels_per_im[anchors_to_gt_values != -INF][0].nonzero())
-
-            if positive_map is not None and proj_tokens is not None:
-                map_labels_per_im = map[anchors_to_gt_indexs]
-                unmatched_labels = torch.zeros(map_labels_per_im.shape[1], dtype=torch.bool,
-                                               device=map_labels_per_im.device)  # map: none False
-                map_labels_per_im[anchors_to_gt_values == -INF] = unmatched_labels
-                # move from cpu to gpu
-                map_labels_per_im = map_labels_per_im.to(cls_labels_per_im.device)
-
-                # print(map_labels_per_im[anchors_to_gt_values == -INF].shape)
-                # print(map_labels_per_im[anchors_to_gt_values != -INF][0])
-
-            if positive_map is not None and proj_tokens is not None:
-                gold_box_od_label_per_im = gold_box_od_label[anchors_to_gt_indexs]
-                gold_box_od_label_per_im[anchors_to_gt_values == -INF] = -100
-                # move from cpu to gpu
-                gold_box_od_label_per_im = gold_box_od_label_per_im.to(cls_labels_per_im.device)
-
-                # print(gold_box_od_label_per_im[anchors_to_gt_values != -INF])
-
-            matched_gts = bboxes_per_im[anchors_to_gt_indexs]
-
-            reg_targets_per_im = self.box_coder.encode(matched_gts, anchors_per_im.bbox)
-            cls_labels.append(cls_labels_per_im)
-            reg_targets.append(reg_targets_per_im)
-
-            if positive_map is not None:
-                token_labels.append(token_labels_per_im)
+            gold_box_od_labels = gather_gt(
+                pad_gt([targets_per_im.get_field("original_od_label") for targets_per_im in targets]).to(device),
+                anchors_to_gt_indexs)
+            gold_box_od_labels[unmatched] = -100
+            gold_box_od_labels = list(gold_box_od_labels)
+            od_label_of_tokens_labels = [targets_per_im.get_field("positive_map_for_od_labels")
+                                         for targets_per_im in targets]
 
-            if positive_map is not None and proj_tokens is not None:
-                map_labels.append(map_labels_per_im)
-                gold_box_od_labels.append(gold_box_od_label_per_im)
-                od_label_of_tokens_labels.append(od_label_of_token_per_im)
-                positive_indices.append(positive_index)
-
-        # print([len(x) for x in positive_indices])
+            # get positive anchors index from ATSS
+            positive_indices = [torch.nonzero(anchors_to_gt_indexs_per_im).view(-1)
+                                for anchors_to_gt_indexs_per_im in anchors_to_gt_indexs]
 
-        return cls_labels, reg_targets, token_labels, map_labels, gold_box_od_labels, od_label_of_tokens_labels, positive_indices
+        return list(cls_labels), list(reg_targets), token_labels, map_labels, gold_box_od_labels, od_label_of_tokens_labels, positive_indices, anchors_bbox
 
     def compute_centerness_targets(self, reg_targets, anchors):
         gts = self.box_coder.decode(reg_targets, anchors)
@@ -864,11 +813,13 @@ class ATSSLossComputation(torch.nn.Module):
                                                              max_length=self.cfg.MODEL.LANGUAGE_BACKBONE.MAX_QUERY_LEN,
                                                              padding='max_length' if self.cfg.MODEL.LANGUAGE_BACKBONE.PAD_MAX else "longest",
                                                              return_tensors='pt',
+                                                             return_offsets_mapping=True,
                                                              truncation=True)
             else:
-                tokenized = self.tokenizer.batch_encode_plus(captions, padding="longest", return_tensors="pt")
+                tokenized = self.tokenizer.batch_encode_plus(captions, padding="longest", return_tensors="pt",
+                                                             return_offsets_mapping=True)
 
-        labels, reg_targets, token_labels, map_labels, gold_box_od_labels, od_label_of_tokens_labels, positive_indices = self.prepare_targets(targets, anchors,
+        labels, reg_targets, token_labels, map_labels, gold_box_od_labels, od_label_of_tokens_labels, positive_indices, anchors_bbox = self.prepare_targets(targets, anchors,
                                                                              tokenized,
                                                                              positive_map,
                                                                              proj_tokens
@@ -895,7 +846,10 @@ class ATSSLossComputation(torch.nn.Module):
 
         labels_flatten = torch.cat(labels, dim=0)
         reg_targets_flatten = torch.cat(reg_targets, dim=0)
-        anchors_flatten = torch.cat([cat_boxlist(anchors_per_image).bbox for anchors_per_image in anchors], dim=0)
+        # the anchors were already concatenated by prepare_targets
+        anchors_per_image_cat = [BoxList(anchors_bbox_per_im, anchors_per_image[0].size, mode="xyxy")
+                                 for anchors_bbox_per_im, anchors_per_image in zip(anchors_bbox, anchors)]
+        anchors_flatten = anchors_bbox.reshape(-1, 4)
 
         if positive_map is not None:
             token_labels_stacked = torch.stack(token_labels, dim=0)
@@ -932,14 +886,9 @@ class ATSSLossComputation(torch.nn.Module):
                     # predicted_box_od_label: B x A
 
                     # check memory limitation: prevent # of positive >= # of max_positive
-                    new_positive_indices = []
-                    # print([len(positive_index) for positive_index in positive_indices])
-                    for positive_index in positive_indices:
-                        if len(positive_index) >= self.cfg.MODEL.DYHEAD.FUSE_CONFIG.SHALLOW_MAX_POSITIVE_ANCHORS:
-                            import random
-                            positive_index = sorted(random.sample(positive_index,
-                                                           self.cfg.MODEL.DYHEAD.FUSE_CONFIG.SHALLOW_MAX_POSITIVE_ANCHORS))
-                        new_positive_indices.append(positive_index)
+                    new_positive_indices = [
+                        subsample_indices(positive_index, self.cfg.MODEL.DYHEAD.FUSE_CONFIG.SHALLOW_MAX_POSITIVE_ANCHORS)
+                        for positive_index in positive_indices]
                     # print([len(positive_index) for positive_index in positive_indices])
 
                     max_len = max([len(positive_index) for positive_index in new_positive_indices])
@@ -954,11 +903,10 @@ class ATSSLossComputation(torch.nn.Module):
                     new_negative_pad_indices = []
                     # if not PAD_ZEROS, select random negative paddings
                     if not self.cfg.MODEL.DYHEAD.FUSE_CONFIG.USE_SHALLOW_ZERO_PADS:
-                        for (positive_index, old_positive_index) in zip(new_positive_indices, positive_indices):
-                            negative_index = [i for i in range(len(cat_boxlist(anchors[0]))) if i not in old_positive_index]
-                            import random
-                            negative_pad_index = sorted(random.sample(negative_index,
-                                                               max_anchor_num - len(positive_index)))
+                        for i, (positive_index, old_positive_index) in enumerate(zip(new_positive_indices, positive_indices)):
+                            negative_pad_index = sample_negative_indices(old_positive_index,
+                                                                         len(anchors_per_image_cat[i]),
+                                                                         max_anchor_num - len(positive_index))
                             new_negative_pad_indices.append(negative_pad_index)
 
                     predicted_box_od_label = []
@@ -1040,7 +988,7 @@ class ATSSLossComputation(torch.nn.Module):
                     pooler = ROIAlignV2((1, 1), 1./16, 0)
                     # get positive features
                     for i in range(bs):
-                        rois = convert_to_roi_format(cat_boxlist(anchors[i])[new_positive_indices[i]])
+                        rois = convert_to_roi_format(anchors_per_image_cat[i][new_positive_indices[i]])
                         roi_feature = pooler(shallow_img_emb_feats[i].unsqueeze(0), rois)
                         roi_feature = roi_feature.squeeze(-1).squeeze(-1)
                         shallow_contrastive_proj_queries = self.shallow_contrastive_projection_image(roi_feature)
@@ -1056,7 +1004,7 @@ class ATSSLossComputation(torch.nn.Module):
                                                             ))
                         else:
                             # pad negatives
-                            negative_rois = convert_to_roi_format(cat_boxlist(anchors[i])[new_negative_pad_indices[i]])
+                            negative_rois = convert_to_roi_format(anchors_per_image_cat[i][new_negative_pad_indices[i]])
                             negative_roi_feature = pooler(shallow_img_emb_feats[i].unsqueeze(0), negative_rois)
                             negative_roi_feature = negative_roi_feature.squeeze(-1).squeeze(-1)
                             negative_shallow_contrastive_proj_queries = self.shallow_contrastive_projection_image(negative_roi_feature)
@@ -23,6 +23,7 @@ import torch.utils.checkpoint as checkpoint
 import pdb
 
 from maskrcnn_benchmark.modeling.language_backbone.clip_model import QuickGELU, LayerNorm, DropPath
+from maskrcnn_benchmark.utils.amp import fp32_region
 from timm.models.layers import DropPath, trunc_normal_
 
 class h_sigmoid(nn.Module):
@@ -840,10 +841,12 @@ class VLDyHead(torch.nn.Module):
                 A = dot_product_proj_queries.shape[1]
                 bias = dot_product_proj_tokens_bias.unsqueeze(1).repeat(1, A, 1)
 
-                dot_product_logit = (torch.matmul(dot_product_proj_queries, dot_product_proj_tokens.transpose(-1, -2)) / self.log_scale.exp()) + bias
-                if self.cfg.MODEL.DYHEAD.FUSE_CONFIG.CLAMP_DOT_PRODUCT:
-                    dot_product_logit = torch.clamp(dot_product_logit, max=50000)
-                    dot_product_logit = torch.clamp(dot_product_logit, min=-50000)
+                # the logits can exceed the fp16 range before the clamp, always compute them in fp32
+                with fp32_region(x.device):
+                    dot_product_logit = (torch.matmul(dot_product_proj_queries.float(), dot_product_proj_tokens.float().transpose(-1, -2)) / self.log_scale.exp()) + bias.float()
+                    if self.cfg.MODEL.DYHEAD.FUSE_CONFIG.CLAMP_DOT_PRODUCT:
+                        dot_product_logit = torch.clamp(dot_product_logit, max=50000)
+                        dot_product_logit = torch.clamp(dot_product_logit, min=-50000)
                 dot_product_logits.append(dot_product_logit)
 
             if self.cfg.MODEL.DYHEAD.FUSE_CONFIG.USE_SHALLOW_CONTRASTIVE_LOSS:
@@ -896,25 +899,12 @@ class VLDyHeadModule(torch.nn.Module):
                 swint_feature_c4=None
                 ):
 
-        if self.cfg.MODEL.DYHEAD.FUSE_CONFIG.USE_CONTRASTIVE_ALIGN_LOSS:
-            # resizer needed
-            embedding = language_dict_features['embedded']
-            embedding = self.resizer(embedding)
-        elif self.cfg.MODEL.DYHEAD.FUSE_CONFIG.USE_DOT_PRODUCT_TOKEN_LOSS:
-            # no resizer needed
-            embedding = language_dict_features['embedded']
-        else:
-            embedding = None
+        embedding = self.language_embedding(language_dict_features)
 
         if "masks" in language_dict_features:
             text_masks = language_dict_features["masks"]
         else:
             text_masks = None
-        
-        if self.cfg.MODEL.DYHEAD.FUSE_CONFIG.ADD_LINEAR_LAYER:
-            embedding = self.tunable_linear.weight[:embedding.size(1), :].unsqueeze(0) + embedding
-            language_dict_features['embedded'] = embedding
-            language_dict_features['hidden'] = self.tunable_linear.weight[:embedding.size(1), :].unsqueeze(0) + language_dict_features['hidden']
 
         box_cls, box_regression, centerness, token_logits, \
         proj_tokens, contrastive_logits, dot_product_logits, mlm_logits, shallow_img_emb_feats, fused_visual_features = self.head(features,
@@ -947,6 +937,27 @@ class VLDyHeadModule(torch.nn.Module):
                                       fused_visual_features=fused_visual_features
                                       )
 
+    def language_embedding(self, language_dict_features):
+        """
+        The token embedding the head scores against, updates language_dict_features
+        in place when ADD_LINEAR_LAYER is set.
+        """
+        if self.cfg.MODEL.DYHEAD.FUSE_CONFIG.USE_CONTRASTIVE_ALIGN_LOSS:
+            # resizer needed
+            embedding = language_dict_features['embedded']
+            embedding = self.resizer(embedding)
+        elif self.cfg.MODEL.DYHEAD.FUSE_CONFIG.USE_DOT_PRODUCT_TOKEN_LOSS:
+            # no resizer needed
+            embedding = language_dict_features['embedded']
+        else:
+            embedding = None
+
+        if self.cfg.MODEL.DYHEAD.FUSE_CONFIG.ADD_LINEAR_LAYER:
+            embedding = self.tunable_linear.weight[:embedding.size(1), :].unsqueeze(0) + embedding
+            language_dict_features['embedded'] = embedding
+            language_dict_features['hidden'] = self.tunable_linear.weight[:embedding.size(1), :].unsqueeze(0) + language_dict_features['hidden']
+        return embedding
+
     def _forward_train(self, box_cls, box_regression, centerness, targets, anchors,
                        captions=None,
                        positive_map=None,
@@ -1026,11 +1037,18 @@ class VLDyHeadModule(torch.nn.Module):
                       positive_map=None,
                       fused_visual_features=None
                       ):
-
-        boxes = self.box_selector_test(box_regression, centerness, anchors,
-                                       box_cls,
-                                       token_logits,
-                                       dot_product_logits,
-                                       positive_map,
-                                       )
+        # positive_map is either one label-to-token map shared by the batch,
+        # or a list with one map per image (each image then only scores its own labels)
+        # box decoding and convert_grounding_to_od_logits run in fp32 also under autocast,
+        # the label-to-token aggregation is a matmul that autocast would cast back down
+        box_regression, centerness, box_cls, token_logits, dot_product_logits = [
+            [o.float() for o in outputs] if outputs is not None else None
+            for outputs in (box_regression, centerness, box_cls, token_logits, dot_product_logits)]
+        with fp32_region(box_regression[0].device):
+            boxes = self.box_selector_test(box_regression, centerness, anchors,
+                                           box_cls,
+                                           token_logits,
+                                           dot_product_logits,
+                                           positive_map,
+                                           )
         return boxes, {}, fused_visual_features
@@ -1,5 +1,6 @@
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
 import torch
+import numpy as np
 
 from .bounding_box import BoxList
 
@@ -32,6 +33,21 @@ def boxlist_nms(boxlist, nms_thresh, max_proposals=-1, score_field="score"):
     return boxlist.convert(mode)
 
 
+def _batched_nms(boxes, scores, labels, nms_thresh):
+    """
+    Multi-class nms in a single nms call: boxes of different labels are shifted
+    apart so that they never overlap. Like ml_nms, returns the kept indices
+    sorted by decreasing score.
+    """
+    if boxes.numel() == 0:
+        return torch.empty((0,), dtype=torch.int64, device=boxes.device)
+    # float64 so that large label offsets do not eat into the box precision
+    boxes = boxes.double()
+    span = boxes.max() - boxes.min() + 1
+    offsets = labels.to(boxes) * span
+    return _box_nms(boxes + offsets[:, None], scores.double(), nms_thresh)
+
+
 def boxlist_ml_nms(boxlist, nms_thresh, max_proposals=-1,
                    score_field="scores", label_field="labels"):
     """
@@ -54,17 +70,7 @@ def boxlist_ml_nms(boxlist, nms_thresh, max_proposals=-1,
     labels = boxlist.get_field(label_field)
 
     if boxes.device==torch.device("cpu"):
-        keep = []
-        unique_labels = torch.unique(labels)
-        print(unique_labels)
-        for j in unique_labels:
-            inds = (labels == j).nonzero().view(-1)
-
-            scores_j = scores[inds]
-            boxes_j = boxes[inds, :].view(-1, 4)
-            keep_j = _box_nms(boxes_j, scores_j, nms_thresh)
-
-            keep += keep_j
+        keep = _batched_nms(boxes, scores, labels, nms_thresh)
     else:
         keep = _box_ml_nms(boxes, scores, labels.float(), nms_thresh)
         
@@ -112,26 +118,75 @@ def boxlist_iou(boxlist1, boxlist2):
         raise RuntimeError(
                 "boxlists should have same image size, got {}, {}".format(boxlist1, boxlist2))
 
-    N = len(boxlist1)
-    M = len(boxlist2)
-
-    area1 = boxlist1.area()
-    area2 = boxlist2.area()
+    return _box_iou(boxlist1.bbox, boxlist2.bbox)
 
-    box1, box2 = boxlist1.bbox, boxlist2.bbox
 
-    lt = torch.max(box1[:, None, :2], box2[:, :2])  # [N,M,2]
-    rb = torch.min(box1[:, None, 2:], box2[:, 2:])  # [N,M,2]
+def _box_iou(box1, box2, to_remove=1):
+    """
+    IoU between two [..., N,4] / [..., M,4] xyxy tensors, leading dims are batch dims.
+    `to_remove` is the pixel offset added to widths and heights (1 for the usual
+    inclusive convention).
+    """
+    area1 = (box1[..., 2] - box1[..., 0] + to_remove) * (box1[..., 3] - box1[..., 1] + to_remove)
+    area2 = (box2[..., 2] - box2[..., 0] + to_remove) * (box2[..., 3] - box2[..., 1] + to_remove)
 
-    TO_REMOVE = 1
+    lt = torch.max(box1[..., :, None, :2], box2[..., None, :, :2])  # [...,N,M,2]
+    rb = torch.min(box1[..., :, None, 2:], box2[..., None, :, 2:])  # [...,N,M,2]
 
-    wh = (rb - lt + TO_REMOVE).clamp(min=0)  # [N,M,2]
-    inter = wh[:, :, 0] * wh[:, :, 1]  # [N,M]
+    wh = (rb - lt + to_remove).clamp(min=0)  # [...,N,M,2]
+    inter = wh[..., 0] * wh[..., 1]  # [...,N,M]
 
-    iou = inter / (area1[:, None] + area2 - inter)
+    iou = inter / (area1[..., :, None] + area2[..., None, :] - inter)
     return iou
 
 
+def _greedy_iou_keep(boxes, iou_thresh, to_remove=0):
+    """Greedy keep pass over [N,4] xyxy boxes sorted by descending score, returns a bool numpy mask"""
+    keep = np.ones(len(boxes), dtype=bool)
+    if len(boxes) < 2:
+        return keep
+    # only earlier (higher scored) boxes may suppress later ones
+    suppress = (_box_iou(boxes, boxes, to_remove) > iou_thresh).triu(diagonal=1).cpu().numpy()
+    for i in range(len(boxes)):
+        if keep[i]:
+            keep[i + 1:] &= ~suppress[i, i + 1:]
+    return keep
+
+
+def boxlist_iou_filter(boxlists, iou_thresh, label_field=None, to_remove=0):
+    """
+    Greedy IoU de-duplication over a batch of BoxLists. Within each BoxList,
+    a box is kept iff its IoU with every previously kept box is <= iou_thresh,
+    so the boxes should already be sorted by descending score.
+    Each image (and each label of it, if label_field is given) gets its own IoU
+    matrix, boxes of different blocks never suppress each other.
+
+    Arguments:
+        boxlists (list[BoxList])
+        iou_thresh (float)
+        label_field (str): if set, only boxes sharing this label are compared
+        to_remove (int): pixel offset of the IoU, 0 matches utils.dist.get_iou
+
+    Returns:
+        list[BoxList]
+    """
+    results = []
+    for boxlist in boxlists:
+        boxes = boxlist.convert("xyxy").bbox
+        if label_field is None:
+            keep = _greedy_iou_keep(boxes, iou_thresh, to_remove)
+        else:
+            labels = boxlist.get_field(label_field)
+            keep = np.zeros(len(boxes), dtype=bool)
+            for label in torch.unique(labels):
+                # increasing indices, so the block keeps the score order
+                inds = torch.nonzero(labels == label).squeeze(1)
+                keep[inds.cpu().numpy()] = _greedy_iou_keep(boxes[inds], iou_thresh, to_remove)
+        inds = torch.as_tensor(np.nonzero(keep)[0], dtype=torch.int64, device=boxes.device)
+        results.append(boxlist[inds])
+    return results
+
+
 # TODO redundant, remove
 def _cat(tensors, dim=0):
     """
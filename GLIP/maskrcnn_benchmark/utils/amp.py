@@ -1,5 +1,7 @@
 from contextlib import contextmanager
 
+import torch
+
 @contextmanager
 def nullcontext(enter_result=None, **kwargs):
     yield enter_result
@@ -11,4 +13,28 @@ except:
     GradScaler = nullcontext
     autocast = nullcontext
     custom_fwd = nullcontext
-    custom_bwd = nullcontext
\ No newline at end of file
+    custom_bwd = nullcontext
+
+
+# TEST.PRECISION -> autocast dtype, None runs in full fp32
+INFERENCE_DTYPES = {"fp32": None, "fp16": torch.float16, "bf16": torch.bfloat16}
+
+
+def inference_autocast(device, precision="fp32"):
+    """Context manager running inference in the reduced precision of TEST.PRECISION."""
+    if precision not in INFERENCE_DTYPES:
+        raise ValueError("unknown precision {}, expected one of {}".format(precision, list(INFERENCE_DTYPES)))
+    dtype = INFERENCE_DTYPES[precision]
+    if dtype is None:
+        return nullcontext()
+    return torch.autocast(device_type=torch.device(device).type, dtype=dtype)
+
+
+def fp32_region(device):
+    """
+    Context manager turning autocast off for overflow-sensitive ops, their inputs
+    must be cast with .float() by the caller.
+    """
+    if not hasattr(torch, "autocast"):
+        return nullcontext()
+    return torch.autocast(device_type=torch.device(device).type, enabled=False)
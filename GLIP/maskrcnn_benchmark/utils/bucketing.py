@@ -0,0 +1,31 @@
+from collections import OrderedDict
+
+
+def bucket_by_key(items, key_fn, batch_size, window):
+    """
+    Groups a stream of items into batches whose items share the same key.
+
+    At most ``window`` items are held back: a bucket is emitted as soon as it
+    holds ``batch_size`` items, and when the window is full the bucket holding
+    the oldest item is emitted even if it is not full, so no item is delayed by
+    more than ``window`` positions.
+    """
+    window = max(window, batch_size)
+    buckets = OrderedDict()
+    num_buffered = 0
+    for item in items:
+        key = key_fn(item)
+        bucket = buckets.setdefault(key, [])
+        bucket.append(item)
+        num_buffered += 1
+        if len(bucket) == batch_size:
+            del buckets[key]
+            num_buffered -= batch_size
+            yield bucket
+        elif num_buffered >= window:
+            # buckets are ordered by their first (oldest) item
+            _, oldest = buckets.popitem(last=False)
+            num_buffered -= len(oldest)
+            yield oldest
+    for bucket in buckets.values():
+        yield bucket
@@ -7,6 +7,7 @@ from maskrcnn_benchmark.modeling.utils import cat, concat_box_prediction_layers,
 from timm.models.layers import DropPath
 
 from transformers.activations import ACT2FN
+from maskrcnn_benchmark.utils.amp import fp32_region
 class BertPredictionHeadTransform(nn.Module):
     def __init__(self, config):
         super().__init__()
@@ -195,6 +196,9 @@ class BiMultiHeadAttention(nn.Module):
         self.stable_softmax_2d = cfg.MODEL.DYHEAD.FUSE_CONFIG.STABLE_SOFTMAX_2D
         self.clamp_min_for_underflow = cfg.MODEL.DYHEAD.FUSE_CONFIG.CLAMP_MIN_FOR_UNDERFLOW
         self.clamp_max_for_overflow = cfg.MODEL.DYHEAD.FUSE_CONFIG.CLAMP_MAX_FOR_OVERFLOW
+        self.use_fused_attn = cfg.MODEL.DYHEAD.FUSE_CONFIG.USE_FUSED_ATTN and \
+                              hasattr(F, "scaled_dot_product_attention")
+        self.chunk_size = cfg.MODEL.DYHEAD.FUSE_CONFIG.ATTN_CHUNK_SIZE
 
         self._reset_parameters()
 
@@ -216,6 +220,11 @@ class BiMultiHeadAttention(nn.Module):
         self.out_l_proj.bias.data.fill_(0)
 
     def forward(self, v, l, attention_mask_l=None):
+        if self.chunk_size > 0 and v.size(1) > self.chunk_size:
+            return self._chunked_forward(v, l, attention_mask_l)
+        if self.use_fused_attn:
+            return self._fused_forward(v, l, attention_mask_l)
+
         bsz, tgt_len, embed_dim = v.size()
 
         query_states = self.v_proj(v) * self.scale
@@ -230,7 +239,12 @@ class BiMultiHeadAttention(nn.Module):
         value_l_states = value_l_states.view(*proj_shape)
 
         src_len = key_states.size(1)
-        attn_weights = torch.bmm(query_states, key_states.transpose(1, 2))
+        if self.stable_softmax_2d or self.clamp_min_for_underflow or self.clamp_max_for_overflow:
+            # these paths exist because the weights overflow in fp16, keep them in fp32 under autocast
+            with fp32_region(v.device):
+                attn_weights = torch.bmm(query_states.float(), key_states.float().transpose(1, 2))
+        else:
+            attn_weights = torch.bmm(query_states, key_states.transpose(1, 2))
 
         if attn_weights.size() != (bsz * self.num_heads, tgt_len, src_len):
             raise ValueError(
@@ -302,6 +316,144 @@ class BiMultiHeadAttention(nn.Module):
 
         return attn_output_v, attn_output_l
 
+    def _fused_forward(self, v, l, attention_mask_l=None):
+        # Both directions through scaled_dot_product_attention, so the (bsz * num_heads, tgt_len, src_len)
+        # weights over all image tokens are never materialized. The max subtraction and clamping of forward
+        # guard the fp16 softmax against overflow, when they are enabled the attention runs in fp32 instead.
+        bsz, tgt_len, embed_dim = v.size()
+
+        query_states = self._shape(self.v_proj(v), tgt_len, bsz)
+        key_states = self._shape(self.l_proj(l), -1, bsz)
+        value_v_states = self._shape(self.values_v_proj(v), -1, bsz)
+        value_l_states = self._shape(self.values_l_proj(l), -1, bsz)
+        src_len = key_states.size(2)
+
+        if self.stable_softmax_2d or self.clamp_min_for_underflow or self.clamp_max_for_overflow:
+            # like forward, also under autocast
+            with fp32_region(v.device):
+                attn_output_v, attn_output_l = self._sdpa(
+                    query_states.float(), key_states.float(), value_v_states.float(), value_l_states.float(),
+                    attention_mask_l)
+            attn_output_v = attn_output_v.to(value_l_states.dtype)
+            attn_output_l = attn_output_l.to(value_v_states.dtype)
+        else:
+            attn_output_v, attn_output_l = self._sdpa(
+                query_states, key_states, value_v_states, value_l_states, attention_mask_l)
+
+        attn_output_v = attn_output_v.transpose(1, 2).reshape(bsz, tgt_len, self.embed_dim)
+        attn_output_l = attn_output_l.transpose(1, 2).reshape(bsz, src_len, self.embed_dim)
+
+        attn_output_v = self.out_v_proj(attn_output_v)
+        attn_output_l = self.out_l_proj(attn_output_l)
+
+        return attn_output_v, attn_output_l
+
+    def _sdpa(self, query_states, key_states, value_v_states, value_l_states, attention_mask_l=None):
+        bsz, src_len = key_states.size(0), key_states.size(2)
+        attention_mask = None
+        if attention_mask_l is not None:
+            assert (attention_mask_l.dim() == 2)
+            # additive like forward, a fully masked row gets uniform weights where a bool mask gives NaN
+            attention_mask = query_states.new_zeros(bsz, 1, 1, src_len)
+            attention_mask = attention_mask.masked_fill(attention_mask_l.view(bsz, 1, 1, src_len) == 0, -9e15)
+
+        dropout_p = self.dropout if self.training else 0.
+        # image -> text, padded tokens are masked out
+        attn_output_v = F.scaled_dot_product_attention(
+            query_states, key_states, value_l_states, attn_mask=attention_mask, dropout_p=dropout_p)
+        # text -> image, every image token is attended
+        attn_output_l = F.scaled_dot_product_attention(
+            key_states, query_states, value_v_states, dropout_p=dropout_p)
+        return attn_output_v, attn_output_l
+
+    def _chunked_forward(self, v, l, attention_mask_l=None):
+        # Same result as forward, visiting chunk_size image tokens at a time. The image side softmax is
+        # per image token and is finished chunk by chunk; the text side softmax runs over all image tokens
+        # and is accumulated online: running max, rescaled exp-sum and rescaled weighted values.
+        bsz, tgt_len, embed_dim = v.size()
+
+        query_states = self._shape(self.v_proj(v) * self.scale, tgt_len, bsz)
+        key_states = self._shape(self.l_proj(l), -1, bsz)
+        value_v_states = self._shape(self.values_v_proj(v), -1, bsz)
+        value_l_states = self._shape(self.values_l_proj(l), -1, bsz)
+
+        proj_shape = (bsz * self.num_heads, -1, self.head_dim)
+        query_states = query_states.view(*proj_shape)
+        key_states = key_states.view(*proj_shape)
+        value_v_states = value_v_states.view(*proj_shape)
+        value_l_states = value_l_states.view(*proj_shape)
+        src_len = key_states.size(1)
+        key_states_T = key_states.transpose(1, 2)
+
+        # the max of stable_softmax_2d is over the whole tensor, both softmaxes are shift invariant so it
+        # only changes the result through the clamps, that is the only case that pays for an extra pass
+        global_max = None
+        if self.stable_softmax_2d and (self.clamp_min_for_underflow or self.clamp_max_for_overflow):
+            with fp32_region(v.device):
+                global_max = torch.stack([torch.bmm(q.float(), key_states_T.float()).max()
+                                          for q in query_states.split(self.chunk_size, dim=1)]).max()
+
+        attention_mask = None
+        if attention_mask_l is not None:
+            assert (attention_mask_l.dim() == 2)
+            attention_mask = attention_mask_l.view(bsz, 1, 1, src_len)
+            attention_mask = attention_mask.masked_fill(attention_mask == 0, -9e15)
+
+        attn_output_v = []
+        max_l = None
+        # the online softmax statistics are accumulated in fp32 also under autocast
+        sum_l = query_states.new_zeros(bsz * self.num_heads, src_len, dtype=torch.float32)
+        attn_output_l = query_states.new_zeros(bsz * self.num_heads, src_len, self.head_dim, dtype=torch.float32)
+        for query_chunk, value_chunk in zip(query_states.split(self.chunk_size, dim=1),
+                                            value_v_states.split(self.chunk_size, dim=1)):
+            chunk_len = query_chunk.size(1)
+            with fp32_region(v.device):
+                attn_weights = torch.bmm(query_chunk.float(), key_states_T.float())
+            if global_max is not None:
+                attn_weights = attn_weights - global_max
+            if self.clamp_min_for_underflow:
+                attn_weights = torch.clamp(attn_weights, min=-50000)
+            if self.clamp_max_for_overflow:
+                attn_weights = torch.clamp(attn_weights, max=50000)
+
+            # text side, the clamps of forward only touch values whose exp is 0 anyway
+            chunk_max = attn_weights.max(dim=1)[0]
+            new_max = chunk_max if max_l is None else torch.max(max_l, chunk_max)
+            exp_l = torch.exp(attn_weights - new_max.unsqueeze(1))
+            if max_l is not None:
+                correction = torch.exp(max_l - new_max)
+                sum_l = sum_l * correction
+                attn_output_l = attn_output_l * correction.unsqueeze(-1)
+            max_l = new_max
+            sum_l = sum_l + exp_l.sum(dim=1)
+            # dropout on the unnormalized weights, normalizing is a per row constant
+            probs_l = F.dropout(exp_l, p=self.dropout, training=self.training)
+            attn_output_l = attn_output_l + torch.bmm(probs_l.transpose(1, 2), value_chunk)
+
+            # image side
+            if attention_mask is not None:
+                attn_weights = attn_weights.view(bsz, self.num_heads, chunk_len, src_len) + attention_mask
+                attn_weights = attn_weights.view(bsz * self.num_heads, chunk_len, src_len)
+            attn_weights_v = nn.functional.softmax(attn_weights, dim=-1)
+            attn_probs_v = F.dropout(attn_weights_v, p=self.dropout, training=self.training)
+            attn_output_v.append(torch.bmm(attn_probs_v, value_l_states))
+
+        attn_output_v = torch.cat(attn_output_v, dim=1)
+        attn_output_l = attn_output_l / sum_l.unsqueeze(-1)
+
+        attn_output_v = attn_output_v.view(bsz, self.num_heads, tgt_len, self.head_dim)
+        attn_output_v = attn_output_v.transpose(1, 2)
+        attn_output_v = attn_output_v.reshape(bsz, tgt_len, self.embed_dim)
+
+        attn_output_l = attn_output_l.view(bsz, self.num_heads, src_len, self.head_dim)
+        attn_output_l = attn_output_l.transpose(1, 2)
+        attn_output_l = attn_output_l.reshape(bsz, src_len, self.embed_dim)
+
+        attn_output_v = self.out_v_proj(attn_output_v)
+        attn_output_l = self.out_l_proj(attn_output_l)
+
+        return attn_output_v, attn_output_l
+
 
 # Bi-Direction MHA (text->image, image->text)
 class BiAttentionBlock(nn.Module):
@@ -0,0 +1,70 @@
+"""
+Helpers for LAION webdataset tars and their noun chunk sidecars, shared by the Laion datasets and the
+preprocessing scripts (nounChunkExtractor.py). Standard library only, so the scripts do not import the
+data package.
+"""
+import json
+import os
+import re
+import tarfile
+
+CAPTION_FILTER = "[+=^*<>{}「」【】()（）/\[\]]"
+NOUN_CHUNK_SUFFIX = ".nouns.jsonl"
+
+
+def clean_caption(caption):
+    return re.sub(CAPTION_FILTER, ' ', caption)
+
+
+def doc_noun_chunks(doc):
+    """[lower-cased text, start char] of every noun chunk of a spacy doc."""
+    return [[chunk.text.lower(), chunk[0].idx] for chunk in doc.noun_chunks]
+
+
+def noun_chunk_path(root, index):
+    return os.path.join(root, "{}{}".format(index, NOUN_CHUNK_SUFFIX))
+
+
+def load_noun_chunks(path):
+    """Read a noun chunk sidecar file (see nounChunkExtractor.py) into {sample id: noun chunks}."""
+    noun_chunks = {}
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            record = json.loads(line)
+            noun_chunks[record['id']] = record['noun_chunks']
+    return noun_chunks
+
+
+def sample_id(d):
+    return d['id'].decode() if 'id' in d else d['__key__']
+
+
+def iter_tar_samples(tar_path, shard_id=0, num_shards=1, keys=("id", "jpg", "txt")):
+    """Lazily yield webdataset samples from a tar as dicts of raw bytes.
+
+    Members are grouped into samples by their basename prefix, the same way
+    webdataset does. Only every ``num_shards``-th sample (offset ``shard_id``)
+    has its payload read; the others are skipped without touching their data.
+    """
+    with tarfile.open(tar_path, "r:") as tar:
+        sample_index = -1
+        cur_key = None
+        sample = None
+        for member in tar:
+            if not member.isfile():
+                continue
+            dirname, basename = os.path.split(member.name)
+            if "." not in basename:
+                continue
+            prefix, suffix = basename.split(".", 1)
+            key = os.path.join(dirname, prefix)
+            if key != cur_key:
+                if sample is not None:
+                    yield sample
+                cur_key = key
+                sample_index += 1
+                sample = {"__key__": key} if sample_index % num_shards == shard_id else None
+            if sample is not None and suffix in keys:
+                sample[suffix] = tar.extractfile(member).read()
+        if sample is not None:
+            yield sample
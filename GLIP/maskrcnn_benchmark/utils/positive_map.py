@@ -0,0 +1,110 @@
+"""
+Char span -> token map construction shared by the datasets, the demo and the losses.
+
+All spans of a batch of captions are resolved at once from the offset mapping of a fast tokenizer
+with searchsorted, instead of up to six BatchEncoding.char_to_token calls per span.
+"""
+import torch
+
+
+def token_offsets(tokenized):
+    """
+    Returns:
+        LongTensor[batch, num_tokens, 2]: char offsets of the tokens, (0, 0) for special and
+            padding tokens. Uses "offset_mapping" when the tokenizer was asked for it
+            (return_offsets_mapping=True), the offsets of the fast tokenizer encodings otherwise.
+    """
+    if "offset_mapping" in tokenized:
+        return torch.as_tensor(tokenized["offset_mapping"], dtype=torch.long)
+    return torch.as_tensor([encoding.offsets for encoding in tokenized.encodings], dtype=torch.long)
+
+
+def char_to_token(offsets, caption_index, chars, shifts=(0,)):
+    """
+    Vectorized BatchEncoding.char_to_token.
+
+    Arguments:
+        offsets (LongTensor[batch, num_tokens, 2]): see token_offsets
+        caption_index (LongTensor[N]): caption of each char
+        chars (LongTensor[N]): char positions
+        shifts (tuple[int]): tried in order, chars + shift is looked up until one hits a token
+
+    Returns:
+        LongTensor[N]: token index of each char, -1 when no shift hits a token
+    """
+    starts, ends = offsets[..., 0], offsets[..., 1]
+    # special and padding tokens are empty, with them masked out the token ends are non decreasing
+    sorted_ends = torch.where(ends > starts, ends, torch.zeros_like(ends)).cummax(dim=-1)[0]
+    sorted_ends, starts = sorted_ends[caption_index], starts[caption_index]
+    num_tokens = sorted_ends.shape[1]
+
+    query = chars[:, None] + torch.as_tensor(shifts, dtype=torch.long)[None, :]
+    # first token ending after the char, it contains the char unless the char is a space
+    pos = torch.searchsorted(sorted_ends.contiguous(), query.contiguous(), right=True)
+    clamped = pos.clamp(max=num_tokens - 1)
+    hit = (pos < num_tokens) & (starts.gather(1, clamped) <= query)
+
+    token = clamped.gather(1, hit.int().argmax(dim=1, keepdim=True))[:, 0]
+    return torch.where(hit.any(dim=1), token, torch.full_like(token, -1))
+
+
+def span_token_masks(offsets, caption_index, beg, end, num_tokens):
+    """
+    Tokens covered by the char spans [beg, end). Like the char_to_token lookups it replaces,
+    a span start that falls on a space tries the next two chars and a span end the two
+    previous ones, spans that still do not resolve cover no token.
+
+    Returns:
+        BoolTensor[N, num_tokens]
+    """
+    beg_pos = char_to_token(offsets, caption_index, beg, (0, 1, 2))
+    end_pos = char_to_token(offsets, caption_index, end, (-1, -2, -3))
+    token_range = torch.arange(num_tokens)
+    valid = (beg_pos >= 0) & (end_pos >= 0)
+    return (token_range[None, :] >= beg_pos[:, None]) & (token_range[None, :] <= end_pos[:, None]) & valid[:, None]
+
+
+def span_maps(tokenized, batch_tokens_positive, num_tokens=256):
+    """
+    Arguments:
+        tokenized (BatchEncoding): one caption per entry of batch_tokens_positive
+        batch_tokens_positive (list[list[list[tuple[int, int]]]]): per caption, per box, its char spans
+        num_tokens (int): width of the maps
+
+    Returns:
+        list[BoolTensor[num_boxes, num_tokens]]: map[i, j] iff box i is associated to token j
+    """
+    offsets = token_offsets(tokenized)
+    rows_per_caption = [len(tokens_positive) for tokens_positive in batch_tokens_positive]
+    span_caption, span_row, span_beg, span_end = [], [], [], []
+    row = 0
+    for caption_i, tokens_positive in enumerate(batch_tokens_positive):
+        for tok_list in tokens_positive:
+            for (beg, end) in tok_list:
+                span_caption.append(caption_i)
+                span_row.append(row)
+                span_beg.append(beg)
+                span_end.append(end)
+            row += 1
+
+    maps = torch.zeros((row, num_tokens), dtype=torch.int32)
+    if span_row:
+        masks = span_token_masks(offsets, torch.as_tensor(span_caption), torch.as_tensor(span_beg),
+                                 torch.as_tensor(span_end), num_tokens)
+        # a box with several spans gets the union of their tokens
+        maps.index_add_(0, torch.as_tensor(span_row), masks.int())
+    return list((maps > 0).split(rows_per_caption))
+
+
+def create_positive_maps(tokenized, batch_tokens_positive, num_tokens=256):
+    """positive_map of each caption of a batch, rows normalized to sum to 1"""
+    positive_maps = []
+    for positive_map in span_maps(tokenized, batch_tokens_positive, num_tokens):
+        positive_map = positive_map.float()
+        positive_maps.append(positive_map / (positive_map.sum(-1)[:, None] + 1e-6))
+    return positive_maps
+
+
+def create_positive_map(tokenized, tokens_positive):
+    """construct a map such that positive_map[i,j] = True iff box i is associated to token j"""
+    return create_positive_maps(tokenized, [tokens_positive])[0]
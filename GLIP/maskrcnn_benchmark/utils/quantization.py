@@ -0,0 +1,49 @@
+"""
+Dynamic int8 quantization of the language backbone and the vision-language fusion for CPU inference.
+
+Only nn.Linear layers are quantized, their weights are stored in int8 and the activations are
+quantized on the fly, so no calibration data is needed. The visual backbone and the convolutional
+heads stay in fp32: dynamic quantization has no convolution kernels.
+"""
+import torch
+from torch import nn
+
+
+def quantizable_vl_modules(model):
+    """
+    Arguments:
+        model (GeneralizedVLRCNN)
+
+    Returns:
+        list[str]: names of the submodules whose nn.Linear layers are quantized, the
+            transformer of the language backbone, the VLFuse layers of the head tower and
+            the dot product text projection
+    """
+    from maskrcnn_benchmark.modeling.rpn.vldyhead import VLFuse
+
+    names = []
+    for name, module in model.named_modules():
+        # BertEncoder / RobertaModel of the language backbone, its embeddings stay fp32
+        if name == "language_backbone.body.model":
+            names.append(name)
+        elif isinstance(module, VLFuse):
+            names.append(name)
+        elif name.endswith("dot_product_projection_text") and isinstance(module, nn.Linear):
+            names.append(name)
+    return names
+
+
+def quantize_dynamic_vl(model):
+    """
+    Replace, in place, the nn.Linear layers of quantizable_vl_modules(model) by dynamically
+    quantized int8 ones. The model must be on cpu and is not trainable afterwards.
+
+    Returns:
+        list[str]: names of the quantized submodules
+    """
+    names = quantizable_vl_modules(model)
+    qconfig = torch.quantization.default_dynamic_qconfig
+    # only linear layers, the default mapping would also pick up the word embeddings
+    mapping = {nn.Linear: torch.nn.quantized.dynamic.Linear}
+    torch.quantization.quantize_dynamic(model, {name: qconfig for name in names}, mapping=mapping, inplace=True)
+    return names
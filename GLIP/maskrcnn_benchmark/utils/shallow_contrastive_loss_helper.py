@@ -25,6 +25,28 @@ def pad_random_negative_tensor_given_length(positive_tensor, negative_padding_te
     return torch.cat((positive_tensor, negative_padding_tensor), dim=0)
 
 
+def subsample_indices(indices, num_samples):
+    """
+    Random subset of num_samples entries of an index tensor, kept in increasing order.
+    """
+    if len(indices) <= num_samples:
+        return indices
+    keep = torch.randperm(len(indices), device=indices.device)[:num_samples]
+    return indices[keep].sort()[0]
+
+
+def sample_negative_indices(positive_index, num_anchors, num_samples):
+    """
+    Random sorted sample of num_samples anchor indices in [0, num_anchors) that are not in
+    positive_index, drawn from a mask of the anchors instead of a list of the negatives.
+    """
+    if num_samples == 0:
+        return positive_index.new_zeros(0)
+    weights = torch.ones(num_anchors, device=positive_index.device)
+    weights[positive_index] = 0
+    return torch.multinomial(weights, num_samples, replacement=False).sort()[0]
+
+
 def gather_tensors(tensor):
     """
     Performs all_gather operation on the provided tensors.
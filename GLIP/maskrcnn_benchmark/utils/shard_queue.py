@@ -0,0 +1,162 @@
+"""
+A work queue handing out shards (e.g. the tars of a Laion part) to the ranks of a
+multi-node job, backed by a directory on the shared file system and a file lock.
+"""
+import fcntl
+import json
+import os
+import socket
+import time
+from contextlib import contextmanager
+
+
+def atomic_write(path, text):
+    """Write text to path so that readers see either the old or the complete new file."""
+    tmp_path = "{}.tmp.{}".format(path, os.getpid())
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class ClaimLost(Exception):
+    """Raised by workers to abandon a shard whose claim ``renew`` could not keep."""
+
+
+class ShardQueue(object):
+    """
+    Dynamically hands out shard ids to workers.
+
+    For every shard the queue directory holds at most a ``<id>.claim`` file (the
+    worker processing it, refreshed with ``renew``) and a ``<id>.done`` file.
+    Claiming happens under an exclusive lock on ``.lock``, so workers on all nodes
+    can pull from the same queue. A worker first gets back the shards it had claimed
+    before a restart, then free shards, then shards whose claim was not renewed
+    for ``lease`` seconds (crashed or preempted workers).
+
+    Arguments:
+        queue_dir (str): directory on a file system shared by all workers
+        shard_ids (list[str]): all the shards to process
+        worker (str): stable name of this worker, e.g. its rank, so that a restarted
+            job resumes its own shards
+        lease (float): seconds after which a claim that was not renewed can be stolen
+    """
+
+    def __init__(self, queue_dir, shard_ids, worker, lease=1800):
+        self.queue_dir = queue_dir
+        self.shard_ids = [str(i) for i in shard_ids]
+        self.worker = str(worker)
+        self.lease = lease
+        if not os.path.exists(queue_dir):
+            os.makedirs(queue_dir, exist_ok=True)
+
+    def _path(self, shard_id, suffix):
+        return os.path.join(self.queue_dir, "{}.{}".format(shard_id, suffix))
+
+    @contextmanager
+    def _locked(self):
+        with open(os.path.join(self.queue_dir, ".lock"), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _read_claim(self, shard_id):
+        try:
+            with open(self._path(shard_id, "claim"), 'r', encoding='utf-8') as f:
+                claim = json.load(f)
+            claim["mtime"] = os.path.getmtime(self._path(shard_id, "claim"))
+            return claim
+        except (OSError, ValueError):
+            return None
+
+    def _write_claim(self, shard_id):
+        atomic_write(self._path(shard_id, "claim"), json.dumps(
+            {"worker": self.worker, "host": socket.gethostname(), "pid": os.getpid(), "time": time.time()}))
+
+    def is_done(self, shard_id):
+        return os.path.exists(self._path(shard_id, "done"))
+
+    def claim(self):
+        """Returns the next shard id for this worker, or None when no shard is left."""
+        with self._locked():
+            now = time.time()
+            own, free, stale = [], [], []
+            for shard_id in self.shard_ids:
+                if self.is_done(shard_id):
+                    continue
+                claim = self._read_claim(shard_id)
+                if claim is None:
+                    free.append(shard_id)
+                elif claim["worker"] == self.worker:
+                    own.append(shard_id)
+                elif now - claim["mtime"] > self.lease:
+                    stale.append(shard_id)
+            for candidates in (own, free, stale):
+                if candidates:
+                    self._write_claim(candidates[0])
+                    return candidates[0]
+        return None
+
+    def renew(self, shard_id):
+        """
+        Keep the claim on shard_id alive, call it regularly while processing the shard.
+        Returns False when the claim was stolen or removed in the meantime, the caller
+        must then stop working on the shard (and stop writing its outputs).
+        """
+        with self._locked():
+            claim = self._read_claim(shard_id)
+            if claim is None or claim["worker"] != self.worker:
+                return False
+            os.utime(self._path(shard_id, "claim"), None)
+        return True
+
+    def complete(self, shard_id, info=None):
+        """Mark shard_id as finished, once its output has been written."""
+        with self._locked():
+            atomic_write(self._path(shard_id, "done"), json.dumps(
+                {"worker": self.worker, "time": time.time(), "info": info}))
+            if os.path.exists(self._path(shard_id, "claim")):
+                os.remove(self._path(shard_id, "claim"))
+
+    def __iter__(self):
+        while True:
+            shard_id = self.claim()
+            if shard_id is None:
+                return
+            yield shard_id
+
+    def progress(self):
+        num_done = sum(self.is_done(shard_id) for shard_id in self.shard_ids)
+        return num_done, len(self.shard_ids)
+
+
+def load_partial_groundings(path):
+    """
+    Groundings saved batch by batch before a restart. A crash may leave a truncated last line,
+    the file is cut back to the end of the last complete line so that appended records start
+    on a line of their own.
+    """
+    groundings = []
+    if not os.path.exists(path):
+        return groundings
+    valid_end = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            try:
+                grounding = json.loads(line.decode('utf-8'))
+            except ValueError:
+                break
+            # json turned the int char positions into str keys
+            grounding['groundings'] = {entity: {int(pos): locs for pos, locs in g.items()}
+                                       for entity, g in grounding['groundings'].items()}
+            groundings.append(grounding)
+            valid_end += len(line)
+    if valid_end < os.path.getsize(path):
+        with open(path, 'r+b') as f:
+            f.truncate(valid_end)
+    return groundings
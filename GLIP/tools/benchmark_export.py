@@ -0,0 +1,85 @@
+# Set up custom environment before nearly anything else is imported
+# NOTE: this should be the first import (no not reorder)
+from maskrcnn_benchmark.utils.env import setup_environment  # noqa F401 isort:skip
+
+import argparse
+import time
+
+import torch
+from maskrcnn_benchmark.config import cfg
+from maskrcnn_benchmark.engine.export import export_for_inference
+from maskrcnn_benchmark.engine.inference import create_positive_map_label_to_token_from_positive_map
+from maskrcnn_benchmark.modeling.detector import build_detection_model
+from maskrcnn_benchmark.structures.image_list import to_image_list
+from maskrcnn_benchmark.utils.checkpoint import DetectronCheckpointer
+
+
+def time_model(model, images, captions, positive_map, warmup, iters):
+    with torch.no_grad():
+        for _ in range(warmup):
+            model(images, captions=captions, positive_map=positive_map)
+        start = time.perf_counter()
+        for _ in range(iters):
+            predictions = model(images, captions=captions, positive_map=positive_map)
+    return (time.perf_counter() - start) / iters, predictions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Eager vs exported GLIP inference latency")
+    parser.add_argument("--config-file", default="configs/pretrain/glip_Swin_T_O365_GoldG.yaml", metavar="FILE")
+    parser.add_argument("--weight", default=None, metavar="FILE")
+    parser.add_argument("--mode", default="compile", choices=["compile", "trace"])
+    parser.add_argument("--height", type=int, default=800)
+    parser.add_argument("--width", type=int, default=1333)
+    parser.add_argument("--caption", default="a person riding a horse next to a dog.")
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--iters", type=int, default=10)
+    parser.add_argument("--threads", type=int, default=0, help="torch cpu threads, 0 keeps the default")
+    parser.add_argument(
+        "opts",
+        help="Modify config options using the command-line",
+        default=None,
+        nargs=argparse.REMAINDER,
+    )
+    args = parser.parse_args()
+
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(["MODEL.DEVICE", "cpu"])
+    cfg.merge_from_list(args.opts)
+    cfg.freeze()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    model = build_detection_model(cfg)
+    model.to(cfg.MODEL.DEVICE)
+    checkpointer = DetectronCheckpointer(cfg, model)
+    _ = checkpointer.load(args.weight or cfg.MODEL.WEIGHT)
+    model.eval()
+
+    images = to_image_list([torch.rand(3, args.height, args.width)], cfg.DATALOADER.SIZE_DIVISIBILITY)
+    captions = [args.caption]
+    # every token is its own label, enough to exercise the box selection
+    num_tokens = len(model.tokenizer(args.caption).input_ids)
+    positive_map = create_positive_map_label_to_token_from_positive_map(torch.eye(num_tokens, 256), plus=1)
+
+    eager_time, eager_predictions = time_model(model, images, captions, positive_map, args.warmup, args.iters)
+    print("eager: {:.1f} ms / image".format(eager_time * 1000))
+
+    start = time.perf_counter()
+    exported = export_for_inference(model, mode=args.mode, example_images=images, example_captions=captions)
+    # the first call compiles
+    exported(images, captions=captions, positive_map=positive_map)
+    print("{} export + first call: {:.1f} s".format(args.mode, time.perf_counter() - start))
+
+    exported_time, exported_predictions = time_model(exported, images, captions, positive_map,
+                                                     args.warmup, args.iters)
+    print("{}: {:.1f} ms / image, {:.2f}x".format(args.mode, exported_time * 1000, eager_time / exported_time))
+
+    for eager, compiled in zip(eager_predictions, exported_predictions):
+        same_count = len(eager) == len(compiled)
+        diff = (eager.bbox - compiled.bbox).abs().max().item() if same_count and len(eager) else 0.
+        print("boxes eager / {}: {} / {}, max box diff {:.4f}".format(args.mode, len(eager), len(compiled), diff))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+# Set up custom environment before nearly anything else is imported
+# NOTE: this should be the first import (no not reorder)
+from maskrcnn_benchmark.utils.env import setup_environment  # noqa F401 isort:skip
+
+import argparse
+
+import torch
+from maskrcnn_benchmark.config import cfg
+from maskrcnn_benchmark.data import make_data_loader
+from maskrcnn_benchmark.data.datasets.image_cache import image_cache_sizes, write_image_cache
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write the downscaled image caches of the training datasets")
+    parser.add_argument("--config-file", default="", metavar="FILE")
+    parser.add_argument("--overwrite", action="store_true")
+    parser.add_argument(
+        "opts",
+        help="Modify config options using the command-line",
+        default=None,
+        nargs=argparse.REMAINDER,
+    )
+    args = parser.parse_args()
+
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    cfg.freeze()
+    assert cfg.DATASETS.IMAGE_CACHE_DIR, "set DATASETS.IMAGE_CACHE_DIR"
+
+    data_loaders = make_data_loader(cfg, is_train=True, is_distributed=False)
+    if not isinstance(data_loaders, list):
+        data_loaders = [data_loaders]
+    datasets = []
+    for data_loader in data_loaders:
+        dataset = data_loader.dataset
+        if isinstance(dataset, torch.utils.data.ConcatDataset):
+            datasets.extend(dataset.datasets)
+        else:
+            datasets.append(dataset)
+
+    min_size, max_size = image_cache_sizes(cfg)
+    for dataset in datasets:
+        if not getattr(dataset, "supports_image_cache", False):
+            print("skip {}, it cannot read an image cache".format(type(dataset).__name__))
+            continue
+        cache_dir = dataset.image_cache_dir
+        if dataset.image_cache is not None and not args.overwrite:
+            print("skip {}, {} exists".format(type(dataset).__name__, cache_dir))
+            continue
+        # a duplicated dataset repeats the images of the original one
+        num_images = getattr(dataset, "length", len(dataset))
+        keys = [dataset.image_cache_key(i) for i in range(num_images)]
+        write_image_cache(cache_dir, keys, dataset.get_image, min_size, max_size)
+        print("{}: {} images -> {}".format(type(dataset).__name__, len(set(keys)), cache_dir))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+# Set up custom environment before nearly anything else is imported
+# NOTE: this should be the first import (no not reorder)
+from maskrcnn_benchmark.utils.env import setup_environment  # noqa F401 isort:skip
+
+import argparse
+import copy
+import time
+
+import torch
+from maskrcnn_benchmark.config import cfg
+from maskrcnn_benchmark.data import make_data_loader
+from maskrcnn_benchmark.engine.inference import create_queries_and_maps_from_dataset, \
+    create_positive_map_label_to_token_from_positive_map
+from maskrcnn_benchmark.modeling.detector import build_detection_model
+from maskrcnn_benchmark.structures.bounding_box import BoxList
+from maskrcnn_benchmark.structures.boxlist_ops import boxlist_iou
+from maskrcnn_benchmark.utils.checkpoint import DetectronCheckpointer
+from maskrcnn_benchmark.utils.quantization import quantize_dynamic_vl
+
+
+def top1_per_label(prediction):
+    """label -> (box, score) of the best scoring prediction of each label"""
+    best = {}
+    scores = prediction.get_field("scores")
+    labels = prediction.get_field("labels")
+    for i in torch.argsort(scores, descending=True).tolist():
+        label = labels[i].item()
+        if label not in best:
+            best[label] = (prediction.bbox[i:i + 1], scores[i].item())
+    return best
+
+
+def gt_recall(prediction, target, iou_thresh):
+    """fraction of the ground truth boxes hit by any prediction, class agnostic"""
+    if len(target) == 0:
+        return None
+    if len(prediction) == 0:
+        return 0.
+    return (boxlist_iou(target, prediction).max(dim=1)[0] >= iou_thresh).float().mean().item()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Accuracy delta of dynamic int8 quantization on a test sample")
+    parser.add_argument("--config-file", default="configs/flickr/test.yaml", metavar="FILE")
+    parser.add_argument("--weight", default=None, metavar="FILE")
+    parser.add_argument("--num-images", type=int, default=100)
+    parser.add_argument("--iou-thresh", type=float, default=0.5)
+    parser.add_argument("--threads", type=int, default=0, help="torch cpu threads, 0 keeps the default")
+    parser.add_argument(
+        "opts",
+        help="Modify config options using the command-line",
+        default=None,
+        nargs=argparse.REMAINDER,
+    )
+    args = parser.parse_args()
+
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(["MODEL.DEVICE", "cpu", "TEST.IMS_PER_BATCH", 1])
+    cfg.merge_from_list(args.opts)
+    cfg.freeze()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    model = build_detection_model(cfg)
+    checkpointer = DetectronCheckpointer(cfg, model)
+    _ = checkpointer.load(args.weight or cfg.MODEL.WEIGHT)
+    model.eval()
+    quantized = copy.deepcopy(model)
+    print("quantized:", ", ".join(quantize_dynamic_vl(quantized)))
+
+    data_loader = make_data_loader(cfg, is_train=False, is_distributed=False)[0]
+    dataset = data_loader.dataset
+    grounding = cfg.TEST.EVAL_TASK == "grounding"
+    if not grounding:
+        all_queries, all_maps = create_queries_and_maps_from_dataset(dataset, cfg)
+    plus = 1 if cfg.MODEL.RPN_ARCHITECTURE == "VLDYHEAD" else 0
+
+    times = {"fp32": 0., "int8": 0.}
+    recalls = {"fp32": [], "int8": []}
+    score_deltas, box_ious = [], []
+    num_images = 0
+    with torch.no_grad():
+        for images, targets, image_ids, *_ in data_loader:
+            if num_images >= args.num_images:
+                break
+            num_images += len(targets)
+            if grounding:
+                queries = [([t.get_field("caption") for t in targets],
+                            create_positive_map_label_to_token_from_positive_map(
+                                targets[0].get_field("positive_map_eval"), plus=plus))]
+            else:
+                queries = [([query] * len(targets), positive_map)
+                           for query, positive_map in zip(all_queries, all_maps)]
+
+            outputs = {}
+            for name, detector in (("fp32", model), ("int8", quantized)):
+                start = time.perf_counter()
+                outputs[name] = [detector(images, captions=captions, positive_map=positive_map)[0]
+                                 for captions, positive_map in queries]
+                times[name] += time.perf_counter() - start
+
+            for name in outputs:
+                for prediction in outputs[name]:
+                    recall = gt_recall(prediction, targets[0], args.iou_thresh)
+                    if recall is not None:
+                        recalls[name].append(recall)
+            for reference, prediction in zip(outputs["fp32"], outputs["int8"]):
+                best_reference, best_prediction = top1_per_label(reference), top1_per_label(prediction)
+                for label, (box, score) in best_reference.items():
+                    if label not in best_prediction:
+                        box_ious.append(0.)
+                        continue
+                    other_box, other_score = best_prediction[label]
+                    score_deltas.append(abs(score - other_score))
+                    box_ious.append(boxlist_iou(BoxList(box, reference.size),
+                                                BoxList(other_box, reference.size)).item())
+
+    def mean(values):
+        return sum(values) / max(len(values), 1)
+
+    print("images: {}, labels compared: {}".format(num_images, len(box_ious)))
+    for name in ("fp32", "int8"):
+        print("{}: {:.1f} ms / image, gt recall@{}: {:.4f}".format(
+            name, 1000 * times[name] / max(num_images, 1), args.iou_thresh, mean(recalls[name])))
+    print("recall delta: {:+.4f}".format(mean(recalls["int8"]) - mean(recalls["fp32"])))
+    print("top-1 box agreement (iou >= {}): {:.4f}".format(
+        args.iou_thresh, mean([float(iou >= args.iou_thresh) for iou in box_ious])))
+    print("mean top-1 box iou: {:.4f}, mean top-1 score delta: {:.4f}".format(mean(box_ious), mean(score_deltas)))
+    print("speedup: {:.2f}x".format(times["fp32"] / max(times["int8"], 1e-9)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,24 @@
+import argparse
+import os.path as op
+
+from maskrcnn_benchmark.data.datasets.tsv import create_raw_image_file, raw_image_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write the raw image sidecars of base64 image tsv files")
+    parser.add_argument("tsv_files", nargs="+", metavar="FILE")
+    parser.add_argument("--column", type=int, default=-1, help="base64 image column")
+    parser.add_argument("--overwrite", action="store_true")
+    args = parser.parse_args()
+
+    for tsv_file in args.tsv_files:
+        raw_file = raw_image_path(tsv_file)
+        if op.isfile(raw_file) and not args.overwrite:
+            print("skip {}, {} exists".format(tsv_file, raw_file))
+            continue
+        create_raw_image_file(tsv_file, column=args.column)
+        print("{} -> {}".format(tsv_file, raw_file))
+
+
+if __name__ == "__main__":
+    main()
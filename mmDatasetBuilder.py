@@ -1,8 +1,10 @@
 import argparse
 import torch.utils.data
 from GLIP import *
-from GLIP.maskrcnn_benchmark.data.datasets.laion import Laion
+from GLIP.maskrcnn_benchmark.data.datasets.laion import Laion, LaionStream, noun_chunk_path
 from GLIP.maskrcnn_benchmark.data.collate_batch import BatchGroundingCollator
+from GLIP.maskrcnn_benchmark.data.samplers import PaddingStats
+from GLIP.maskrcnn_benchmark.utils.shard_queue import ShardQueue, ClaimLost, load_partial_groundings
 from GLIP.maskrcnn_benchmark.config import cfg
 from GLIP.maskrcnn_benchmark.engine.predictor_glip import GLIPDemo
 import numpy as np
@@ -17,8 +19,6 @@ import io
 import webdataset as wds
 import time
 from transformers import AutoTokenizer
-from functools import reduce
-from operator import add
 
 
 def get_label_names(predictions, model, new_entities):
@@ -182,10 +182,17 @@ def parse_and_grounding_multi_class(img, caption, idx, nlp, output_path, save_im
     return res
 
 
-def batch_parse_and_grounding_multi_class(laion_dataset, batch_size, output_path, save_img=False):
-    dataloader = torch.utils.data.DataLoader(laion_dataset, shuffle=False, num_workers=2, batch_size=batch_size, collate_fn=BatchGroundingCollator())
+def batch_parse_and_grounding_multi_class(laion_dataset, batch_size, output_path, save_img=False, on_batch=None):
+    if getattr(laion_dataset, "batch_size", None):
+        # the dataset already yields shape-bucketed batches
+        dataloader = torch.utils.data.DataLoader(laion_dataset, shuffle=False, num_workers=2, batch_size=None, collate_fn=BatchGroundingCollator())
+    else:
+        dataloader = torch.utils.data.DataLoader(laion_dataset, shuffle=False, num_workers=2, batch_size=batch_size, collate_fn=BatchGroundingCollator())
+    padding_stats = PaddingStats()
     total_groundings = []
     for i, batch in tqdm(enumerate(dataloader)):
+        padding_stats.update(batch[0].shape, batch[1])
+        num_groundings = len(total_groundings)
         origin_images = batch[7]
         results, preds = glip_demo.run_on_batched_images(*batch[:5], origin_images=origin_images, thresh=0.55, save_img=save_img)
         captions = batch[2]
@@ -193,23 +200,26 @@ def batch_parse_and_grounding_multi_class(laion_dataset, batch_size, output_path
         new_to_old_entities = batch[5]
         new_entity_to_ids = batch[6]
         image_ids = batch[8]
-        entire_entities = reduce(add, new_entities)
+        # positive maps are per image, so labels index each image's own entity list
         if results:
-            for result, pred, caption, new_entity_to_id, new_to_old_entity, index in zip(results, preds, captions, new_entity_to_ids, new_to_old_entities, image_ids):
-                new_labels = get_label_names(pred, glip_demo, entire_entities)
+            for result, pred, caption, entities, new_entity_to_id, new_to_old_entity, index in zip(results, preds, captions, new_entities, new_entity_to_ids, new_to_old_entities, image_ids):
+                new_labels = get_label_names(pred, glip_demo, entities)
                 old_labels = [new_to_old_entity[label] for label in new_labels]
                 if save_img:
-                    result = glip_demo.overlay_entity_names(result, pred, entire_entities, custom_labels=old_labels, text_size=0.8,
+                    result = glip_demo.overlay_entity_names(result, pred, entities, custom_labels=old_labels, text_size=0.8,
                                                             text_offset=-25,
                                                             text_offset_original=-40, text_pixel=2)
                     imsave(result, caption, output_path)
                 groundings = get_grounding_and_label(pred, new_labels, new_entity_to_id, new_to_old_entity)
                 total_groundings.append(output_decorator(groundings, index))
         else:
-            for pred, new_entity_to_id, new_to_old_entity, index in zip(preds, new_entity_to_ids, new_to_old_entities, image_ids):
-                new_labels = get_label_names(pred, glip_demo, entire_entities)
+            for pred, entities, new_entity_to_id, new_to_old_entity, index in zip(preds, new_entities, new_entity_to_ids, new_to_old_entities, image_ids):
+                new_labels = get_label_names(pred, glip_demo, entities)
                 groundings = get_grounding_and_label(pred, new_labels, new_entity_to_id, new_to_old_entity)
                 total_groundings.append(output_decorator(groundings, index))
+        if on_batch is not None:
+            on_batch(total_groundings[num_groundings:])
+    print(padding_stats)
     return total_groundings
 
 
@@ -264,6 +274,10 @@ if __name__ == "__main__":
     parser.add_argument('--rank', type=int, default=0)
     parser.add_argument('--master_addr', type=str, default='')
     parser.add_argument('--master_port', type=int, default=7878)
+    parser.add_argument('--fusion_chunk_size', type=int, default=0,
+                        help="image tokens per chunk of the image-text fusion attention, 0 disables chunking")
+    parser.add_argument('--precision', type=str, default="fp32", choices=["fp32", "fp16", "bf16"],
+                        help="autocast precision of the detector, overflow-sensitive ops stay in fp32")
     args = parser.parse_args()
 
     os.environ['PYTORCH_CUDA_ALLOC_CONF'] = 'max_split_size_mb:128'
@@ -275,6 +289,7 @@ if __name__ == "__main__":
     cfg.merge_from_file(config_file)
     cfg.merge_from_list(["MODEL.WEIGHT", weight_file])
     cfg.merge_from_list(["MODEL.DEVICE", "cuda:{}".format(args.local_rank)])
+    cfg.merge_from_list(["MODEL.DYHEAD.FUSE_CONFIG.ATTN_CHUNK_SIZE", args.fusion_chunk_size])
     torch.cuda.set_device(args.local_rank)
     print("model device:",  cfg.MODEL.DEVICE)
     print("cuda device:", torch.cuda.current_device())
@@ -285,45 +300,67 @@ if __name__ == "__main__":
         cfg,
         confidence_threshold=0.7,
         show_mask_heatmaps=False,
-        min_image_size=800
+        min_image_size=800,
+        precision=args.precision
     )
 
-    nlp = spacy.load("en_core_web_trf")
+    nlp = None
     input_path = "/gpfs/gpfs1/zphz/img_datasets/laion115m/part-00032"
     output_path = "/gpfs/gpfs1/zphz/jjh/test_dataset/part-00032"
     if not os.path.exists(output_path):
         os.mkdir(output_path)
-    total_ids = get_id_list(input_path)
-    part_size = len(total_ids) // max((world_size-1), 1)
-    start = rank*part_size
-    end = min((rank+1)*part_size, len(total_ids))
-    ids = total_ids[start:end]
-    for idx in ids:
-        idx = int(idx)
+    # tars are handed out dynamically to the ranks, finished ones are recorded in the queue directory
+    queue = ShardQueue(os.path.join(output_path, ".queue"), sorted(get_id_list(input_path)), worker=rank)
+    tokenizer = AutoTokenizer.from_pretrained("/gpfs/gpfs1/zphz/official_pretrains/hugging_face/bert-base-uncased")
+    for idx in queue:
         res = {}
         # tar_filename = "{}.tar".format(part_index+idx)
         # tar_dataset = read_tar(os.path.join(input_path, tar_filename))
-        tokenizer = AutoTokenizer.from_pretrained("/gpfs/gpfs1/zphz/official_pretrains/hugging_face/bert-base-uncased")
         batch_size = 5
-        laion_dataset = Laion(str(idx), input_path, nlp, tokenizer, transforms=glip_demo.transforms)
+        # groundings of the batches done before a restart
+        partial_path = os.path.join(output_path, "{}.groundings.partial.jsonl".format(idx))
+        done_groundings = load_partial_groundings(partial_path)
+        # noun chunks precomputed by nounChunkExtractor.py, spacy only runs when they are missing
+        noun_chunk_file = noun_chunk_path(output_path, idx)
+        if not os.path.exists(noun_chunk_file):
+            noun_chunk_file = None
+            if nlp is None:
+                nlp = spacy.load("en_core_web_trf")
+        # batches are bucketed by resize shape to avoid padding, the meta file below restores the original order
+        laion_dataset = LaionStream(str(idx), input_path, nlp, tokenizer, transforms=glip_demo.transforms,
+                                    rank=0, world_size=1, batch_size=batch_size, noun_chunk_file=noun_chunk_file,
+                                    skip_ids={str(grounding['SAMPLE_ID']) for grounding in done_groundings})
         meta_filename = "{}.meta.jsonl".format(idx)
-        print("processing {}".format(idx))
-        groundings = batch_parse_and_grounding_multi_class(laion_dataset, batch_size=batch_size, save_img=False, output_path=output_path)
+        print("processing {}, {} samples already done".format(idx, len(done_groundings)))
+        with open(partial_path, 'a', encoding='utf-8') as partial_file:
+            def save_batch(batch_groundings):
+                # another worker took the shard over after our lease ran out, it owns the partial file now
+                if not queue.renew(idx):
+                    raise ClaimLost(idx)
+                for grounding in batch_groundings:
+                    partial_file.write(json.dumps(grounding, ensure_ascii=False) + '\n')
+                partial_file.flush()
+            try:
+                groundings = batch_parse_and_grounding_multi_class(laion_dataset, batch_size=batch_size, save_img=False,
+                                                                   output_path=output_path, on_batch=save_batch)
+            except ClaimLost:
+                print("lost the claim on {}, moving on".format(idx))
+                continue
+        groundings = done_groundings + groundings
         output_meta_path = os.path.join(output_path, meta_filename)
-        if os.path.exists(output_meta_path):
-            os.remove(output_meta_path)
-        with open(os.path.join(input_path, meta_filename), 'r', encoding='utf-8') as f1, open(output_meta_path, 'a', encoding='utf-8') as f2:
-            grounding_iter = iter(groundings)
+        # written under a temporary name, so a crash never leaves a half written output
+        tmp_meta_path = output_meta_path + ".tmp"
+        with open(os.path.join(input_path, meta_filename), 'r', encoding='utf-8') as f1, open(tmp_meta_path, 'w', encoding='utf-8') as f2:
+            # workers of the streaming dataset interleave their batches, so match groundings by sample id
+            grounding_dict = {str(grounding['SAMPLE_ID']): grounding for grounding in groundings}
             for i, line in tqdm(enumerate(f1)):
                 meta_data = json.loads(line)
-                if meta_data['status'] == "success":
-                    grounding = next(grounding_iter)
+                grounding = grounding_dict.get(str(meta_data['SAMPLE_ID']))
+                if meta_data['status'] == "success" and grounding is None:
+                    print("no grounding for sample_id:{}".format(str(meta_data['SAMPLE_ID'])))
+                if meta_data['status'] == "success" and grounding is not None:
                     # size = (int(meta_data['width']), int(meta_data['height']))
                     # index = data['id'].decode()
-                    image_id = grounding['SAMPLE_ID']
-                    sample_id = meta_data['SAMPLE_ID']
-                    if str(image_id) != str(sample_id):
-                        print("index:{}\n sample_id:{}".format(str(image_id), str(sample_id)))
                     meta_data.update(grounding)
                     meta_data['annot_caption'] = build_training_text(record=meta_data)
                 else:
@@ -332,4 +369,8 @@ if __name__ == "__main__":
                 f2.write(json.dumps(meta_data, ensure_ascii=False) + '\n')
         f1.close()
         f2.close()
+        os.replace(tmp_meta_path, output_meta_path)
+        queue.complete(idx, info={"num_groundings": len(groundings)})
+        os.remove(partial_path)
+        print("{}/{} tars done".format(*queue.progress()))
     print("done")
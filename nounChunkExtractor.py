@@ -0,0 +1,65 @@
+import argparse
+import json
+import os
+from multiprocessing import Pool
+
+import spacy
+from tqdm import tqdm
+
+from GLIP.maskrcnn_benchmark.utils.laion_io import iter_tar_samples, clean_caption, doc_noun_chunks, \
+    noun_chunk_path, sample_id
+
+# one spacy model per pool process, loaded by init_worker
+nlp = None
+
+
+def init_worker(model_name):
+    global nlp
+    nlp = spacy.load(model_name)
+
+
+def extract_tar(args):
+    """Parse the captions of one tar with nlp.pipe and write its noun chunk sidecar."""
+    index, input_path, output_path, batch_size, overwrite = args
+    out_path = noun_chunk_path(output_path, index)
+    if os.path.exists(out_path) and not overwrite:
+        return index, 0
+    # only the id and txt members are read, the images are skipped
+    samples = [d for d in iter_tar_samples(os.path.join(input_path, "{}.tar".format(index)), keys=("id", "txt"))
+               if 'txt' in d]
+    ids = [sample_id(d) for d in samples]
+    captions = [clean_caption(d['txt'].decode()) for d in samples]
+    tmp_path = out_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        for idx, doc in zip(ids, nlp.pipe(captions, batch_size=batch_size)):
+            f.write(json.dumps({"id": idx, "noun_chunks": doc_noun_chunks(doc)}, ensure_ascii=False) + '\n')
+    # a killed run never leaves a truncated sidecar behind
+    os.replace(tmp_path, out_path)
+    return index, len(ids)
+
+
+def get_id_list(path):
+    filenames = os.listdir(path)
+    id_list = [name[:-4] for name in filenames if name.endswith('.tar')]
+    return id_list
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Noun chunk extraction stage of mmDatasetBuilder.py. "
+                                                 "Writes a <index>.nouns.jsonl sidecar next to each tar's output.")
+    parser.add_argument('--input_path', type=str, default="/gpfs/gpfs1/zphz/img_datasets/laion115m/part-00032")
+    parser.add_argument('--output_path', type=str, default="/gpfs/gpfs1/zphz/jjh/test_dataset/part-00032")
+    parser.add_argument('--model', type=str, default="en_core_web_trf")
+    parser.add_argument('--num_workers', type=int, default=4)
+    parser.add_argument('--batch_size', type=int, default=256)
+    parser.add_argument('--overwrite', action='store_true')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.output_path):
+        os.makedirs(args.output_path)
+    ids = get_id_list(args.input_path)
+    tasks = [(idx, args.input_path, args.output_path, args.batch_size, args.overwrite) for idx in ids]
+    with Pool(args.num_workers, initializer=init_worker, initargs=(args.model,)) as pool:
+        for index, num_captions in tqdm(pool.imap_unordered(extract_tar, tasks), total=len(tasks)):
+            print("{}: {} captions".format(index, num_captions))
+    print("done")
@@ -0,0 +1,8 @@
+import os.path as op
+import sys
+
+ROOT = op.dirname(op.dirname(op.abspath(__file__)))
+# maskrcnn_benchmark lives in GLIP/, importable like in tools/ and the training scripts,
+# the root scripts import it as GLIP.maskrcnn_benchmark
+sys.path.insert(0, op.join(ROOT, "GLIP"))
+sys.path.insert(0, ROOT)
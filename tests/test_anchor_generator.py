@@ -0,0 +1,44 @@
+import torch
+
+from maskrcnn_benchmark.modeling.rpn.anchor_generator import AnchorGenerator
+from maskrcnn_benchmark.structures.image_list import ImageList
+
+
+def _forward(generator, dtype=torch.float32):
+    images = ImageList(torch.zeros(2, 3, 64, 96, dtype=dtype), [(64, 96), (60, 80)])
+    features = [torch.zeros(2, 4, 8, 12, dtype=dtype), torch.zeros(2, 4, 4, 6, dtype=dtype)]
+    return generator(images, features)
+
+
+def _uncached(generator, dtype=torch.float32):
+    cache_size = generator.cache_size
+    generator.cache_size = 0
+    generator.clear_cache()
+    try:
+        return _forward(generator, dtype)
+    finally:
+        generator.cache_size = cache_size
+
+
+def test_cached_anchors_match_uncached():
+    generator = AnchorGenerator(sizes=(32, 64), anchor_strides=(8, 16), cache_size=4)
+    expected = _uncached(generator)
+    _forward(generator)
+    actual = _forward(generator)
+    assert generator.cache_hits == 2
+    for anchors_per_im, expected_per_im in zip(actual, expected):
+        for boxlist, expected_boxlist in zip(anchors_per_im, expected_per_im):
+            assert torch.equal(boxlist.bbox, expected_boxlist.bbox)
+            assert torch.equal(boxlist.get_field("visibility"), expected_boxlist.get_field("visibility"))
+
+
+def test_cast_clears_cache():
+    generator = AnchorGenerator(sizes=(32, 64), anchor_strides=(8, 16), cache_size=4)
+    _forward(generator)
+    generator.double()
+    assert len(generator._anchor_cache) == 0
+    anchors = _forward(generator, torch.float64)
+    expected = _uncached(generator, torch.float64)
+    for anchors_per_im, expected_per_im in zip(anchors, expected):
+        for boxlist, expected_boxlist in zip(anchors_per_im, expected_per_im):
+            assert torch.equal(boxlist.bbox, expected_boxlist.bbox)
@@ -0,0 +1,137 @@
+import pytest
+import torch
+
+from maskrcnn_benchmark.config import cfg as _default_cfg
+from maskrcnn_benchmark.modeling.box_coder import BoxCoder
+from maskrcnn_benchmark.modeling.rpn.loss import ATSSLossComputation
+from maskrcnn_benchmark.structures.bounding_box import BoxList
+from maskrcnn_benchmark.structures.boxlist_ops import boxlist_iou, cat_boxlist
+
+INF = 1e8
+
+
+def _loss():
+    cfg = _default_cfg.clone()
+    cfg.MODEL.RPN.ASPECT_RATIOS = (1.0,)
+    cfg.MODEL.RPN.SCALES_PER_OCTAVE = 1
+    cfg.MODEL.ATSS.TOPK = 9
+    # prepare_targets only needs the config and the box coder, skip the tokenizer of __init__
+    loss = ATSSLossComputation.__new__(ATSSLossComputation)
+    torch.nn.Module.__init__(loss)
+    loss.cfg = cfg
+    loss.box_coder = BoxCoder((10., 10., 5., 5.))
+    return loss
+
+
+def _reference(loss, targets, anchors, positive_map):
+    # the per-image ATSS assignment prepare_targets used before batching
+    cls_labels, reg_targets, token_labels, gold_box_od_labels, positive_indices = [], [], [], [], []
+    offset = 0
+    for im_i, targets_per_im in enumerate(targets):
+        bboxes_per_im = targets_per_im.bbox
+        num_gt = len(bboxes_per_im)
+        token_per_im = positive_map[offset:offset + num_gt]
+        offset += num_gt
+        anchors_per_im = cat_boxlist(anchors[im_i])
+        num_anchors_per_level = [len(anchors_per_level) for anchors_per_level in anchors[im_i]]
+        ious = boxlist_iou(anchors_per_im, targets_per_im)
+
+        gt_points = (bboxes_per_im[:, 2:] + bboxes_per_im[:, :2]) / 2.0
+        anchor_points = (anchors_per_im.bbox[:, 2:] + anchors_per_im.bbox[:, :2]) / 2.0
+        distances = (anchor_points[:, None, :] - gt_points[None, :, :]).pow(2).sum(-1).sqrt()
+
+        candidate_idxs = []
+        star_idx = 0
+        for num_anchors in num_anchors_per_level:
+            # one anchor per location
+            topk = min(loss.cfg.MODEL.ATSS.TOPK, num_anchors)
+            _, topk_idxs = distances[star_idx:star_idx + num_anchors].topk(topk, dim=0, largest=False)
+            candidate_idxs.append(topk_idxs + star_idx)
+            star_idx += num_anchors
+        candidate_idxs = torch.cat(candidate_idxs, dim=0)
+
+        candidate_ious = ious[candidate_idxs, torch.arange(num_gt)]
+        is_pos = candidate_ious >= (candidate_ious.mean(0) + candidate_ious.std(0))[None, :]
+        for ng in range(num_gt):
+            cx, cy = anchor_points[candidate_idxs[:, ng]].unbind(1)
+            x1, y1, x2, y2 = bboxes_per_im[ng]
+            is_in_gt = torch.stack([cx - x1, cy - y1, x2 - cx, y2 - cy], dim=1).min(dim=1)[0] > 0.01
+            is_pos[:, ng] &= is_in_gt
+
+        ious_inf = torch.full_like(ious, -INF)
+        for ng in range(num_gt):
+            pos = candidate_idxs[is_pos[:, ng], ng]
+            ious_inf[pos, ng] = ious[pos, ng]
+        anchors_to_gt_values, anchors_to_gt_indexs = ious_inf.max(dim=1)
+        unmatched = anchors_to_gt_values == -INF
+
+        labels = targets_per_im.get_field("labels")[anchors_to_gt_indexs]
+        labels[unmatched] = 0
+        tokens = token_per_im[anchors_to_gt_indexs]
+        tokens[unmatched] = 0
+        tokens[unmatched, -1] = 1
+        od_labels = targets_per_im.get_field("original_od_label")[anchors_to_gt_indexs]
+        od_labels[unmatched] = -100
+
+        cls_labels.append(labels)
+        reg_targets.append(loss.box_coder.encode(bboxes_per_im[anchors_to_gt_indexs], anchors_per_im.bbox))
+        token_labels.append(tokens)
+        gold_box_od_labels.append(od_labels)
+        positive_indices.append(torch.nonzero(anchors_to_gt_indexs).view(-1))
+    return cls_labels, reg_targets, token_labels, gold_box_od_labels, positive_indices
+
+
+def _level(size, stride, image_size):
+    ys, xs = torch.meshgrid(torch.arange(size).float(), torch.arange(size).float(), indexing="ij")
+    centers = torch.stack([xs, ys], dim=-1).view(-1, 2) * stride + stride / 2
+    half = stride * 4
+    return BoxList(torch.cat([centers - half, centers + half], dim=1), image_size, mode="xyxy")
+
+
+def _batch(num_gts, generator):
+    image_size = (128, 128)
+    anchors = [[_level(16, 8, image_size), _level(8, 16, image_size), _level(4, 32, image_size)]
+               for _ in num_gts]
+    targets = []
+    for num_gt in num_gts:
+        xy = torch.rand(num_gt, 2, generator=generator) * 100
+        wh = torch.rand(num_gt, 2, generator=generator) * 40 + 5
+        target = BoxList(torch.cat([xy, xy + wh], dim=1), image_size, mode="xyxy")
+        target.add_field("labels", torch.randint(1, 5, (num_gt,), generator=generator))
+        target.add_field("original_od_label", torch.randint(0, 5, (num_gt,), generator=generator))
+        target.add_field("positive_map_for_od_labels", torch.zeros(10))
+        # one word of the 20 in the caption of _tokenized per gt
+        target.add_field("tokens_positive", [[(4 * int(w), 4 * int(w) + 3)]
+                                             for w in torch.randint(0, 20, (num_gt,), generator=generator)])
+        targets.append(target)
+    positive_map = torch.rand(sum(num_gts), 256, generator=generator)
+    return targets, anchors, positive_map
+
+
+def _tokenized(batch_size):
+    # 20 words of three chars, [CLS] first and [SEP] plus padding last
+    offsets = torch.tensor([[0, 0]] + [[4 * k, 4 * k + 3] for k in range(20)] + [[0, 0]] * 3)
+    return {"offset_mapping": offsets[None].repeat(batch_size, 1, 1)}
+
+
+@pytest.mark.parametrize("num_gts", [[3, 7, 1], [2], [6, 4]])
+def test_matches_per_image_assignment(num_gts):
+    generator = torch.Generator().manual_seed(len(num_gts))
+    loss = _loss()
+    targets, anchors, positive_map = _batch(num_gts, generator)
+    proj_tokens = torch.zeros(len(num_gts), 24, 64)
+
+    labels, reg_targets, token_labels, map_labels, gold_box_od_labels, _, positive_indices, anchors_bbox = \
+        loss.prepare_targets(targets, anchors, _tokenized(len(num_gts)), positive_map, proj_tokens)
+    expected = _reference(loss, targets, anchors, positive_map)
+
+    for actual, reference in zip((labels, reg_targets, token_labels, gold_box_od_labels, positive_indices),
+                                 expected):
+        assert len(actual) == len(reference)
+        for a, r in zip(actual, reference):
+            assert a.shape == r.shape
+            assert torch.allclose(a.float(), r.float(), atol=1e-5)
+    assert [tuple(m.shape) for m in map_labels] == [(len(l), 24) for l in labels]
+    assert sum(len(p) for p in positive_indices) > 0
+    # __call__ reuses the concatenated anchors instead of running cat_boxlist again
+    assert torch.equal(anchors_bbox, torch.stack([cat_boxlist(anchors_per_im).bbox for anchors_per_im in anchors]))
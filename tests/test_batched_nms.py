@@ -0,0 +1,48 @@
+import pytest
+import torch
+
+from maskrcnn_benchmark.structures.bounding_box import BoxList
+from maskrcnn_benchmark.structures.boxlist_ops import _batched_nms, _box_nms, boxlist_ml_nms
+
+
+def _reference_ml_nms(boxes, scores, labels, nms_thresh):
+    # one nms call per label, indices mapped back to the whole list and sorted by score like ml_nms
+    keep = []
+    for label in torch.unique(labels):
+        inds = (labels == label).nonzero().view(-1)
+        keep.append(inds[_box_nms(boxes[inds], scores[inds], nms_thresh)])
+    keep = torch.cat(keep)
+    return keep[scores[keep].argsort(descending=True)]
+
+
+def _random_boxes(num_boxes, num_labels, generator):
+    xy = torch.rand(num_boxes, 2, generator=generator) * 100
+    wh = torch.rand(num_boxes, 2, generator=generator) * 50 + 1
+    boxes = torch.cat([xy, xy + wh], dim=1)
+    scores = torch.rand(num_boxes, generator=generator)
+    labels = torch.randint(1, num_labels + 1, (num_boxes,), generator=generator)
+    return boxes, scores, labels
+
+
+@pytest.mark.parametrize("num_labels", [1, 5, 1000])
+@pytest.mark.parametrize("nms_thresh", [0.3, 0.6])
+def test_matches_per_label_nms(num_labels, nms_thresh):
+    generator = torch.Generator().manual_seed(0)
+    boxes, scores, labels = _random_boxes(300, num_labels, generator)
+    keep = _batched_nms(boxes, scores, labels, nms_thresh)
+    assert torch.equal(keep, _reference_ml_nms(boxes, scores, labels, nms_thresh))
+
+
+def test_boxlist_ml_nms_cpu():
+    generator = torch.Generator().manual_seed(1)
+    boxes, scores, labels = _random_boxes(200, 4, generator)
+    boxlist = BoxList(boxes, (160, 160), mode="xyxy")
+    boxlist.add_field("scores", scores)
+    boxlist.add_field("labels", labels)
+    result = boxlist_ml_nms(boxlist, 0.5, max_proposals=20)
+    expected = _reference_ml_nms(boxes, scores, labels, 0.5)[:20]
+    assert torch.equal(result.bbox, boxes[expected])
+
+
+def test_empty():
+    assert len(_batched_nms(torch.zeros(0, 4), torch.zeros(0), torch.zeros(0, dtype=torch.int64), 0.5)) == 0
@@ -0,0 +1,45 @@
+import pytest
+import torch
+
+from maskrcnn_benchmark.structures.bounding_box import BoxList
+from maskrcnn_benchmark.structures.boxlist_ops import boxlist_iou_filter
+from maskrcnn_benchmark.utils.dist import get_iou
+
+
+def _reference_filter(boxlist, threshold, label_field=None):
+    # the per-box loop GLIPDemo.filter_iou used before boxlist_iou_filter
+    kept = []
+    for idx, bbox in enumerate(boxlist.bbox.tolist()):
+        add = True
+        for j in kept:
+            if label_field is not None and \
+                    boxlist.get_field(label_field)[j] != boxlist.get_field(label_field)[idx]:
+                continue
+            other = boxlist.bbox[j].tolist()
+            if get_iou(tuple(bbox[:2]), tuple(bbox[2:]), tuple(other[:2]), tuple(other[2:])) > threshold:
+                add = False
+                break
+        if add:
+            kept.append(idx)
+    return kept
+
+
+def _random_boxlist(num_boxes, generator):
+    xy = torch.randint(0, 40, (num_boxes, 2), generator=generator).float()
+    wh = torch.randint(1, 20, (num_boxes, 2), generator=generator).float()
+    boxlist = BoxList(torch.cat([xy, xy + wh], dim=1), (64, 64), mode="xyxy")
+    boxlist.add_field("labels", torch.randint(1, 4, (num_boxes,), generator=generator))
+    boxlist.add_field("scores", torch.rand(num_boxes, generator=generator).sort(descending=True)[0])
+    return boxlist
+
+
+@pytest.mark.parametrize("label_field", [None, "labels"])
+@pytest.mark.parametrize("threshold", [0.1, 0.5])
+def test_matches_per_box_loop(label_field, threshold):
+    generator = torch.Generator().manual_seed(0)
+    boxlists = [_random_boxlist(n, generator) for n in (0, 1, 30, 60)]
+    results = boxlist_iou_filter(boxlists, threshold, label_field=label_field)
+    for boxlist, result in zip(boxlists, results):
+        expected = boxlist[_reference_filter(boxlist, threshold, label_field)]
+        assert torch.equal(result.bbox, expected.bbox)
+        assert torch.equal(result.get_field("scores"), expected.get_field("scores"))
@@ -0,0 +1,97 @@
+import pytest
+import torch
+
+pytest.importorskip("timm")
+pytest.importorskip("transformers")
+
+from maskrcnn_benchmark.config import cfg as _cfg
+from maskrcnn_benchmark.modeling.backbone import swint, swint_vl
+from maskrcnn_benchmark.utils.fuse_helper import BiMultiHeadAttention
+
+ATOL = 1e-5
+
+
+def _set_fused(model, attention_cls, fused):
+    for module in model.modules():
+        if isinstance(module, attention_cls):
+            module.use_fused_attn = fused
+
+
+@pytest.mark.parametrize("qk_scale", [None, 0.1])
+def test_swint_window_attention(qk_scale):
+    torch.manual_seed(0)
+    # 100x130 input: padded, shifted windows with a mask and unshifted windows without one
+    model = swint.SwinTransformer(embed_dim=48, depths=[2, 2], num_heads=[3, 6], window_size=7,
+                                  qk_scale=qk_scale, out_features=["stage2", "stage3"])
+    model.eval()
+    x = torch.randn(2, 3, 100, 130)
+    with torch.no_grad():
+        ref = model(x)
+        _set_fused(model, swint.WindowAttention, True)
+        out = model(x)
+    for r, o in zip(ref, out):
+        assert torch.allclose(r, o, atol=ATOL)
+
+
+def test_swint_vl_window_attention():
+    torch.manual_seed(0)
+    model = swint_vl.SwinTransformer(embed_dim=48, depths=[2, 2], num_heads=[3, 6], window_size=7,
+                                     out_features=["stage2", "stage3"], max_query_len=8, lang_dim=32)
+    model.eval()
+    x = torch.randn(2, 3, 100, 130)
+    hidden = torch.randn(2, 8, 32)
+    masks = torch.ones(2, 8, dtype=torch.long)
+    masks[1, 5:] = 0
+    with torch.no_grad():
+        # only the image only stages are fused, the last stage attends to the text explicitly
+        ref_visual, ref_language = model({"img": x, "lang": {"hidden": hidden, "masks": masks}})
+        _set_fused(model, swint_vl.WindowAttention, True)
+        out_visual, out_language = model({"img": x, "lang": {"hidden": hidden, "masks": masks}})
+    for r, o in zip(ref_visual, out_visual):
+        assert torch.allclose(r, o, atol=ATOL)
+    assert torch.allclose(ref_language["hidden"], out_language["hidden"], atol=ATOL)
+
+
+@pytest.mark.parametrize("chunk_size", [0, 128])
+def test_bi_multi_head_attention(chunk_size):
+    torch.manual_seed(0)
+    cfg = _cfg.clone()
+    cfg.MODEL.DYHEAD.FUSE_CONFIG.STABLE_SOFTMAX_2D = True
+    cfg.MODEL.DYHEAD.FUSE_CONFIG.CLAMP_MIN_FOR_UNDERFLOW = True
+    cfg.MODEL.DYHEAD.FUSE_CONFIG.CLAMP_MAX_FOR_OVERFLOW = True
+    cfg.MODEL.DYHEAD.FUSE_CONFIG.ATTN_CHUNK_SIZE = chunk_size
+    attention = BiMultiHeadAttention(256, 768, 2048, 8, cfg=cfg).eval()
+    v = torch.randn(2, 500, 256)
+    l = torch.randn(2, 20, 768)
+    attention_mask_l = torch.ones(2, 20, dtype=torch.long)
+    attention_mask_l[1, 12:] = 0
+    with torch.no_grad():
+        attention.use_fused_attn = False
+        ref = attention(v, l, attention_mask_l)
+        attention.use_fused_attn = True
+        out = attention(v, l, attention_mask_l)
+    for r, o in zip(ref, out):
+        assert torch.allclose(r, o, atol=ATOL)
+
+
+@pytest.mark.parametrize("stable", [False, True])
+def test_bi_multi_head_attention_fully_masked(stable):
+    torch.manual_seed(0)
+    cfg = _cfg.clone()
+    cfg.MODEL.DYHEAD.FUSE_CONFIG.STABLE_SOFTMAX_2D = stable
+    cfg.MODEL.DYHEAD.FUSE_CONFIG.CLAMP_MIN_FOR_UNDERFLOW = stable
+    cfg.MODEL.DYHEAD.FUSE_CONFIG.CLAMP_MAX_FOR_OVERFLOW = stable
+    attention = BiMultiHeadAttention(256, 768, 512, 8, cfg=cfg).eval()
+    v = torch.randn(2, 50, 256)
+    l = torch.randn(2, 20, 768)
+    # the second caption is all padding, the explicit path then attends uniformly instead of giving NaN
+    attention_mask_l = torch.ones(2, 20, dtype=torch.long)
+    attention_mask_l[1] = 0
+    with torch.no_grad():
+        attention.use_fused_attn = False
+        ref = attention(v, l, attention_mask_l)
+        attention.use_fused_attn = True
+        out = attention(v, l, attention_mask_l)
+    for r, o in zip(ref, out):
+        assert torch.isfinite(o).all()
+        assert torch.allclose(r, o, atol=ATOL)
@@ -0,0 +1,89 @@
+import base64
+import io
+import json
+
+import pytest
+import torch
+from PIL import Image
+
+from maskrcnn_benchmark.data.datasets.caption import CaptionTSV
+from maskrcnn_benchmark.data.datasets.image_cache import ImageCache, write_image_cache
+from maskrcnn_benchmark.data.datasets.coco_dt import CocoDetectionTSV
+from maskrcnn_benchmark.data.datasets.modulated_coco import CocoGrounding, ModulatedDataset
+from maskrcnn_benchmark.data.datasets.pseudo_data import PseudoData
+from maskrcnn_benchmark.data.datasets.tsv import ODTSVDataset, TSVDataset, create_lineidx
+from maskrcnn_benchmark.data.datasets.vg import VGTSVDataset
+from maskrcnn_benchmark.structures.bounding_box import BoxList
+
+
+@pytest.mark.parametrize("dataset_cls", [ODTSVDataset, CocoDetectionTSV, VGTSVDataset, CocoGrounding])
+def test_boxlist_datasets_support_image_cache(dataset_cls):
+    assert dataset_cls.supports_image_cache
+
+
+@pytest.mark.parametrize("dataset_cls", [TSVDataset, CaptionTSV, PseudoData])
+def test_raw_target_datasets_do_not_support_image_cache(dataset_cls):
+    # their target is the annotation dict, a cached image would not match its boxes
+    assert not dataset_cls.supports_image_cache
+
+
+def test_other_datasets_do_not_support_image_cache():
+    assert not getattr(ModulatedDataset, "supports_image_cache", False)
+
+
+class _BoxTSVDataset(TSVDataset):
+    supports_image_cache = True
+
+    def get_target_from_annotations(self, annotations, img_size, idx):
+        return BoxList(torch.tensor(annotations["boxes"], dtype=torch.float32), img_size, mode="xyxy")
+
+
+def _png_base64(color, size):
+    buf = io.BytesIO()
+    Image.new("RGB", size, color).save(buf, format="PNG")
+    return base64.b64encode(buf.getvalue()).decode("ascii")
+
+
+def _write_tsv(path, rows):
+    path.write_text("".join("\t".join(row) + "\n" for row in rows), encoding="utf-8")
+
+
+def test_cached_dataset_roundtrip(tmp_path):
+    images = [("red", (80, 60)), ("blue", (20, 30)), ("green", (60, 120))]
+    boxes = [[[8., 6., 40., 30.]], [[2., 3., 10., 20.]], [[0., 0., 60., 120.], [6., 12., 30., 60.]]]
+    _write_tsv(tmp_path / "img.tsv", [(str(i), _png_base64(color, size)) for i, (color, size) in enumerate(images)])
+    _write_tsv(tmp_path / "label.tsv", [(str(i), json.dumps({"boxes": b})) for i, b in enumerate(boxes)])
+    create_lineidx(str(tmp_path / "img.tsv"), str(tmp_path / "img.lineidx.bin"))
+    dataset = _BoxTSVDataset(str(tmp_path / "img.tsv"), str(tmp_path / "label.tsv"))
+    expected = [dataset[i] for i in range(len(dataset))]
+
+    cache_dir = str(tmp_path / "cache")
+    # a tiny shard size spreads the images over several shards
+    write_image_cache(cache_dir, [dataset.image_cache_key(i) for i in range(len(dataset))], dataset.get_image,
+                      min_size=30, max_size=60, shard_bytes=8000)
+    dataset.image_cache = ImageCache(cache_dir)
+    assert len(dataset.image_cache) == len(images)
+
+    # downscaled like Resize(30, 60), images already smaller are stored as they are
+    cached_sizes = [(40, 30), (20, 30), (30, 60)]
+    for i, (color, size) in enumerate(images):
+        img, target, idx, _ = dataset[i]
+        assert idx == i
+        assert img.size == cached_sizes[i]
+        assert img.getpixel((0, 0)) == Image.new("RGB", (1, 1), color).getpixel((0, 0))
+        # the target is built at the original size, then resized to the cached image
+        assert target.size == img.size
+        assert torch.allclose(target.bbox, expected[i][1].resize(img.size).bbox)
+
+
+def test_repeated_keys_stored_once(tmp_path):
+    colors = ["red", "blue", "red"]
+    cache_dir = str(tmp_path / "cache")
+    write_image_cache(cache_dir, ["a", "b", "a"], lambda i: Image.new("RGB", (8, 6), colors[i]),
+                      min_size=30, max_size=60)
+    cache = ImageCache(cache_dir)
+    assert len(cache) == 2 and "a" in cache and "c" not in cache
+    img, orig_size = cache.get("b")
+    assert img.size == orig_size == (8, 6)
+    assert img.getpixel((0, 0)) == (0, 0, 255)
+    assert cache.get("c") is None
@@ -0,0 +1,69 @@
+import pytest
+import torch
+
+from maskrcnn_benchmark.modeling.rpn.inference import (LabelToTokenMap, convert_grounding_to_od_logits,
+                                                       convert_grounding_to_od_logits_v2)
+
+
+def _reference_v2(logits, num_class, positive_map, score_agg, disable_minus_one=True):
+    # the per-label loop convert_grounding_to_od_logits_v2 used before LabelToTokenMap
+    scores = torch.zeros(logits.shape[0], logits.shape[1], num_class)
+    for label_j, tokens in positive_map.items():
+        tokens = [tokens] if isinstance(tokens, int) else tokens
+        column = label_j if disable_minus_one else label_j - 1
+        token_scores = logits[:, :, torch.LongTensor(tokens)]
+        if score_agg == "MEAN":
+            scores[:, :, column] = token_scores.mean(-1)
+        elif score_agg == "POWER":
+            scores[:, :, column] = torch.pow(torch.prod(token_scores, dim=-1), 1 / len(tokens))
+        else:
+            scores[:, :, column] = token_scores.max(-1)[0]
+    return scores
+
+
+def _random_map(num_labels, num_tokens, generator, first_label=1):
+    positive_map = {}
+    for label in range(first_label, first_label + num_labels):
+        length = int(torch.randint(1, 5, (1,), generator=generator))
+        tokens = torch.randperm(num_tokens, generator=generator)[:length].tolist()
+        positive_map[label] = tokens[0] if length == 1 else tokens
+    return positive_map
+
+
+@pytest.mark.parametrize("score_agg", ["MEAN", "POWER", "MAX"])
+@pytest.mark.parametrize("disable_minus_one", [False, True])
+def test_matches_per_label_loop(score_agg, disable_minus_one):
+    generator = torch.Generator().manual_seed(0)
+    logits = torch.rand(2, 50, 32, generator=generator)
+    positive_map = _random_map(7, 32, generator, first_label=1)
+    num_class = 9
+    expected = _reference_v2(logits, num_class, positive_map, score_agg, disable_minus_one)
+    scores = convert_grounding_to_od_logits_v2(logits, num_class, positive_map, score_agg=score_agg,
+                                               disable_minus_one=disable_minus_one)
+    assert torch.allclose(scores, expected, atol=1e-6)
+    # the packed map is reusable across calls, like across FPN levels
+    label_to_token = LabelToTokenMap(positive_map, disable_minus_one=disable_minus_one)
+    scores = convert_grounding_to_od_logits_v2(logits, num_class, label_to_token, score_agg=score_agg)
+    assert torch.allclose(scores, expected, atol=1e-6)
+
+
+@pytest.mark.parametrize("score_agg", ["MEAN", "MAX"])
+def test_tensor_map(score_agg):
+    generator = torch.Generator().manual_seed(1)
+    logits = torch.rand(2, 50, 32, generator=generator)
+    positive_map = _random_map(5, 32, generator, first_label=0)
+    matrix = torch.zeros(5, 32)
+    for label, tokens in positive_map.items():
+        matrix[label, tokens] = 1.0
+    box_cls = torch.zeros(2, 50, 5)
+    expected = _reference_v2(logits, 5, positive_map, score_agg, disable_minus_one=True)
+    scores = convert_grounding_to_od_logits(logits, box_cls, matrix, score_agg=score_agg)
+    assert torch.allclose(scores, expected, atol=1e-6)
+
+
+def test_labels_past_num_class_are_kept():
+    logits = torch.rand(1, 4, 8)
+    scores = convert_grounding_to_od_logits_v2(logits, 2, {1: [0], 5: [3, 4]}, score_agg="MEAN",
+                                               disable_minus_one=False)
+    assert scores.shape[-1] == 5
+    assert torch.allclose(scores[..., 4], logits[..., 3:5].mean(-1))
@@ -0,0 +1,19 @@
+import sys
+import types
+
+from GLIP.maskrcnn_benchmark.data.datasets.laion import LaionProcessor
+
+
+def test_spacy_loaded_on_sidecar_miss(monkeypatch):
+    loaded = []
+
+    def load(name):
+        loaded.append(name)
+        return lambda text: "doc:" + text
+
+    monkeypatch.setitem(sys.modules, "spacy", types.SimpleNamespace(load=load))
+    processor = LaionProcessor(None, tokenizer=None, noun_chunks={"1": [["a dog", 0]]})
+    assert loaded == []
+    assert processor.parse("2", "a cat") == "doc:a cat"
+    assert processor.parse("3", "a cow") == "doc:a cow"
+    assert loaded == ["en_core_web_trf"]
@@ -0,0 +1,48 @@
+import io
+import os.path as op
+import subprocess
+import sys
+import tarfile
+
+from maskrcnn_benchmark.utils.bucketing import bucket_by_key
+from maskrcnn_benchmark.utils.laion_io import clean_caption, iter_tar_samples
+
+
+def _write_tar(path, samples):
+    with tarfile.open(path, "w") as tar:
+        for key, members in samples:
+            for suffix, payload in members.items():
+                info = tarfile.TarInfo("{}.{}".format(key, suffix))
+                info.size = len(payload)
+                tar.addfile(info, io.BytesIO(payload))
+
+
+def test_iter_tar_samples_shards(tmp_path):
+    path = str(tmp_path / "0.tar")
+    samples = [("s/{:03d}".format(i), {"jpg": b"img%d" % i, "txt": b"a dog", "json": b"{}"}) for i in range(5)]
+    _write_tar(path, samples)
+    shards = [list(iter_tar_samples(path, shard_id, 2)) for shard_id in range(2)]
+    assert [d["__key__"] for d in shards[0]] == ["s/000", "s/002", "s/004"]
+    assert [d["__key__"] for d in shards[1]] == ["s/001", "s/003"]
+    # only the requested members are read
+    assert set(shards[1][0]) == {"__key__", "jpg", "txt"}
+    assert shards[1][0]["jpg"] == b"img1"
+
+
+def test_bucket_by_key_window():
+    items = [0, 2, 4, 1, 6, 3, 8, 5]
+    batches = list(bucket_by_key(items, lambda i: i % 2, batch_size=3, window=4))
+    assert sorted(i for batch in batches for i in batch) == sorted(items)
+    assert all(len({i % 2 for i in batch}) == 1 for batch in batches)
+    assert batches[0] == [0, 2, 4]
+
+
+def test_light_imports():
+    # the preprocessing scripts import these without the data package and its dependencies
+    code = ("import sys; import maskrcnn_benchmark.utils.laion_io, maskrcnn_benchmark.utils.bucketing; "
+            "print(any(m == 'torch' or m.startswith('maskrcnn_benchmark.data') for m in sys.modules))")
+    glip_root = op.join(op.dirname(op.dirname(op.abspath(__file__))), "GLIP")
+    out = subprocess.run([sys.executable, "-c", code], cwd=glip_root, check=True,
+                         stdout=subprocess.PIPE, universal_newlines=True).stdout
+    assert out.strip() == "False"
+    assert clean_caption("a [dog]") == "a  dog "
@@ -0,0 +1,80 @@
+import pytest
+import torch
+from torch.utils.data import ConcatDataset
+
+from maskrcnn_benchmark.data.samplers.distributed import DistributedSampler
+from maskrcnn_benchmark.data.samplers.locality_sampler import LocalitySampler, contiguous_blocks
+
+
+def _reference_windows(dataset, block_size, window, epoch):
+    # the blocks of every shuffle window, in the block order of the epoch, built with python loops
+    ends = list(getattr(dataset, "cumulative_sizes", [len(dataset)]))
+    blocks, begin = [], 0
+    for end in ends:
+        for start in range(begin, end, block_size):
+            blocks.append(list(range(start, min(start + block_size, end))))
+        begin = end
+    g = torch.Generator()
+    g.manual_seed(epoch)
+    order = [blocks[i] for i in torch.randperm(len(blocks), generator=g).tolist()]
+    blocks_per_window = max(window // block_size, 1)
+    return [sum(order[i:i + blocks_per_window], []) for i in range(0, len(order), blocks_per_window)]
+
+
+def _datasets():
+    return [list(range(103)), ConcatDataset([list(range(10)), list(range(37)), list(range(5))])]
+
+
+@pytest.mark.parametrize("dataset", _datasets())
+@pytest.mark.parametrize("block_size,window", [(8, None), (8, 24), (16, 20), (1, 1)])
+def test_shuffles_within_windows(dataset, block_size, window):
+    sampler = LocalitySampler(dataset, block_size, window=window)
+    for epoch in range(3):
+        sampler.set_epoch(epoch)
+        indices = list(sampler)
+        assert sorted(indices) == list(range(len(dataset)))
+        pos = 0
+        for window_indices in _reference_windows(dataset, block_size, window or block_size, epoch):
+            assert sorted(indices[pos:pos + len(window_indices)]) == sorted(window_indices)
+            pos += len(window_indices)
+
+
+def test_blocks_do_not_cross_datasets():
+    starts, lengths = contiguous_blocks(ConcatDataset([list(range(10)), list(range(37))]), 16)
+    assert starts.tolist() == [0, 10, 26, 42]
+    assert lengths.tolist() == [10, 16, 16, 5]
+
+
+@pytest.mark.parametrize("num_replicas", [1, 3])
+def test_single_index_blocks_match_distributed_sampler(num_replicas):
+    dataset = list(range(103))
+    for rank in range(num_replicas):
+        for shuffle in (False, True):
+            sampler = LocalitySampler(dataset, 1, num_replicas=num_replicas, rank=rank, shuffle=shuffle)
+            reference = DistributedSampler(dataset, num_replicas=num_replicas, rank=rank, shuffle=shuffle)
+            sampler.set_epoch(3)
+            reference.set_epoch(3)
+            assert list(sampler) == list(reference)
+
+
+@pytest.mark.parametrize("num_replicas", [1, 3])
+def test_replicas_split_like_distributed_sampler(num_replicas):
+    dataset = list(range(103))
+    orders = []
+    for rank in range(num_replicas):
+        sampler = LocalitySampler(dataset, 8, num_replicas=num_replicas, rank=rank)
+        sampler.set_epoch(5)
+        orders.append(list(sampler))
+        assert len(orders[-1]) == len(sampler)
+    # the replicas take contiguous slices of the same padded order
+    full = sum(orders, [])
+    assert set(full) == set(dataset)
+    assert full[len(dataset):] == full[:len(full) - len(dataset)]
+
+
+def test_reads_stay_local():
+    sampler = LocalitySampler(list(range(1000)), 50)
+    indices = list(sampler)
+    # 20 blocks, only the first read of a block jumps
+    assert sampler.sequential_read_ratio == pytest.approx(1 - 19 / 999)
+    assert indices != sorted(indices)
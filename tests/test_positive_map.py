@@ -0,0 +1,92 @@
+import pytest
+import torch
+
+from maskrcnn_benchmark.utils.positive_map import create_positive_map, span_maps
+
+
+class _Tokenized(dict):
+    """Fast tokenizer output with the BatchEncoding.char_to_token lookup"""
+
+    def __init__(self, offsets):
+        super(_Tokenized, self).__init__(offset_mapping=offsets)
+
+    def char_to_token(self, batch_index, char_index):
+        for token, (start, end) in enumerate(self["offset_mapping"][batch_index].tolist()):
+            if start <= char_index < end:
+                return token
+        return None
+
+
+def _reference_map(tokenized, caption_index, tokens_positive, num_tokens):
+    # the char_to_token lookups create_positive_map and the ATSS loss used before span_maps
+    positive_map = torch.zeros((len(tokens_positive), num_tokens), dtype=torch.bool)
+    for j, tok_list in enumerate(tokens_positive):
+        for (beg, end) in tok_list:
+            beg_pos = tokenized.char_to_token(caption_index, beg)
+            end_pos = tokenized.char_to_token(caption_index, end - 1)
+            if beg_pos is None:
+                beg_pos = tokenized.char_to_token(caption_index, beg + 1)
+                if beg_pos is None:
+                    beg_pos = tokenized.char_to_token(caption_index, beg + 2)
+            if end_pos is None:
+                end_pos = tokenized.char_to_token(caption_index, end - 2)
+                if end_pos is None:
+                    end_pos = tokenized.char_to_token(caption_index, end - 3)
+            if beg_pos is None or end_pos is None:
+                continue
+            positive_map[j, beg_pos: end_pos + 1] = True
+    return positive_map
+
+
+def _tokenize(caption, num_tokens):
+    # words split on spaces, long words into pieces of at most four chars like word pieces,
+    # [CLS] first, [SEP] and padding last
+    offsets = [(0, 0)]
+    start = 0
+    for word in caption.split(" "):
+        for piece_start in range(start, start + len(word), 4):
+            offsets.append((piece_start, min(piece_start + 4, start + len(word))))
+        start += len(word) + 1
+    offsets.append((0, 0))
+    offsets += [(0, 0)] * (num_tokens - len(offsets))
+    return offsets
+
+
+def _random_spans(caption, num_boxes, generator):
+    tokens_positive = []
+    for _ in range(num_boxes):
+        spans = []
+        for _ in range(int(torch.randint(1, 3, (1,), generator=generator))):
+            beg = int(torch.randint(0, len(caption) - 1, (1,), generator=generator))
+            end = int(torch.randint(beg + 1, len(caption) + 1, (1,), generator=generator))
+            spans.append((beg, end))
+        tokens_positive.append(spans)
+    return tokens_positive
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_span_maps_match_char_to_token(seed):
+    generator = torch.Generator().manual_seed(seed)
+    captions = ["a dog  chasing a frisbee . cat", "person riding a motorcycle on the road",
+                "an extraordinarily big  table .", "x"]
+    num_tokens = 40
+    tokenized = _Tokenized(torch.tensor([_tokenize(caption, num_tokens) for caption in captions]))
+    batch_tokens_positive = [_random_spans(caption, 4, generator) if len(caption) > 1 else [[(0, 1)]]
+                             for caption in captions]
+
+    maps = span_maps(tokenized, batch_tokens_positive, num_tokens)
+    for caption_index, tokens_positive in enumerate(batch_tokens_positive):
+        expected = _reference_map(tokenized, caption_index, tokens_positive, num_tokens)
+        assert torch.equal(maps[caption_index], expected)
+
+
+def test_create_positive_map_normalized():
+    caption = "a dog and a cat"
+    tokenized = _Tokenized(torch.tensor([_tokenize(caption, 256)]))
+    # "dog", "a cat" and a span on a space, which covers no token
+    positive_map = create_positive_map(tokenized, [[(2, 5)], [(10, 15)], [(5, 6)]])
+    assert positive_map.shape == (3, 256)
+    assert positive_map[0].nonzero().view(-1).tolist() == [2]
+    assert positive_map[1].nonzero().view(-1).tolist() == [4, 5]
+    assert torch.allclose(positive_map[:2].sum(-1), torch.ones(2), atol=1e-5)
+    assert positive_map[2].sum() == 0
@@ -0,0 +1,121 @@
+import types
+
+import pytest
+import torch
+
+pytest.importorskip("timm")
+pytest.importorskip("transformers")
+
+from maskrcnn_benchmark.config import cfg as _cfg
+from maskrcnn_benchmark.utils.amp import inference_autocast
+from maskrcnn_benchmark.utils.fuse_helper import BiMultiHeadAttention
+
+# bf16 keeps 8 bits of mantissa, errors relative to the largest output value
+BF16_RTOL = 2e-2
+
+
+def _assert_close(out, ref, rtol=BF16_RTOL):
+    assert out.shape == ref.shape
+    assert torch.isfinite(out).all()
+    assert (out.float() - ref).abs().max() <= rtol * ref.abs().max()
+
+
+@pytest.mark.parametrize("chunk_size", [0, 128])
+@pytest.mark.parametrize("fused", [False, True])
+@pytest.mark.parametrize("precision", [
+    "bf16",
+    pytest.param("fp16", marks=pytest.mark.skipif(not torch.cuda.is_available(), reason="fp16 autocast needs CUDA")),
+])
+def test_fusion_bf16(chunk_size, fused, precision):
+    device = "cuda" if precision == "fp16" else "cpu"
+    torch.manual_seed(0)
+    cfg = _cfg.clone()
+    cfg.MODEL.DYHEAD.FUSE_CONFIG.STABLE_SOFTMAX_2D = True
+    cfg.MODEL.DYHEAD.FUSE_CONFIG.CLAMP_MIN_FOR_UNDERFLOW = True
+    cfg.MODEL.DYHEAD.FUSE_CONFIG.CLAMP_MAX_FOR_OVERFLOW = True
+    cfg.MODEL.DYHEAD.FUSE_CONFIG.USE_FUSED_ATTN = fused
+    cfg.MODEL.DYHEAD.FUSE_CONFIG.ATTN_CHUNK_SIZE = chunk_size
+    attention = BiMultiHeadAttention(256, 768, 2048, 8, cfg=cfg).eval().to(device)
+    v = torch.randn(2, 500, 256, device=device)
+    l = torch.randn(2, 20, 768, device=device)
+    attention_mask_l = torch.ones(2, 20, dtype=torch.long, device=device)
+    attention_mask_l[1, 12:] = 0
+    with torch.no_grad():
+        ref = attention(v, l, attention_mask_l)
+        with inference_autocast(device, precision):
+            out = attention(v, l, attention_mask_l)
+    for o, r in zip(out, ref):
+        _assert_close(o, r)
+
+
+@pytest.mark.parametrize("precision", [
+    "bf16",
+    pytest.param("fp16", marks=pytest.mark.skipif(not torch.cuda.is_available(), reason="fp16 autocast needs CUDA")),
+])
+def test_fused_fusion_guarded(precision):
+    # with the overflow guards on, the fused path takes its softmax in fp32 like the explicit one,
+    # on large logits both agree under autocast where a reduced precision softmax would not
+    device = "cuda" if precision == "fp16" else "cpu"
+    torch.manual_seed(0)
+    cfg = _cfg.clone()
+    cfg.MODEL.DYHEAD.FUSE_CONFIG.STABLE_SOFTMAX_2D = True
+    cfg.MODEL.DYHEAD.FUSE_CONFIG.CLAMP_MIN_FOR_UNDERFLOW = True
+    cfg.MODEL.DYHEAD.FUSE_CONFIG.CLAMP_MAX_FOR_OVERFLOW = True
+    attention = BiMultiHeadAttention(256, 768, 2048, 8, cfg=cfg).eval().to(device)
+    v = torch.randn(2, 500, 256, device=device) * 20
+    l = torch.randn(2, 20, 768, device=device) * 20
+    attention_mask_l = torch.ones(2, 20, dtype=torch.long, device=device)
+    attention_mask_l[1, 12:] = 0
+    with torch.no_grad(), inference_autocast(device, precision):
+        attention.use_fused_attn = False
+        ref = attention(v, l, attention_mask_l)
+        attention.use_fused_attn = True
+        out = attention(v, l, attention_mask_l)
+    for o, r in zip(out, ref):
+        _assert_close(o, r.float())
+
+
+def test_box_selection_bf16():
+    pytest.importorskip("maskrcnn_benchmark._C")
+    from maskrcnn_benchmark.modeling.rpn.inference import make_atss_postprocessor
+    from maskrcnn_benchmark.modeling.rpn.vldyhead import BoxCoder, VLDyHeadModule
+    from maskrcnn_benchmark.structures.bounding_box import BoxList
+
+    torch.manual_seed(0)
+    cfg = _cfg.clone()
+    cfg.MODEL.ATSS.INFERENCE_TH = 0.05
+    cfg.MODEL.DYHEAD.SCORE_AGG = "MEAN"
+    head = types.SimpleNamespace(box_selector_test=make_atss_postprocessor(cfg, BoxCoder(cfg), is_train=False))
+
+    image_size = (128, 96)
+    num_tokens = 16
+    box_regression, centerness, dot_product_logits, anchors = [], [], [], []
+    for stride in (8, 16):
+        H, W = image_size[1] // stride, image_size[0] // stride
+        ys, xs = torch.meshgrid(torch.arange(H), torch.arange(W), indexing="ij")
+        centers = torch.stack([xs, ys, xs, ys], dim=-1).reshape(-1, 4).float() * stride
+        anchor_boxes = centers + torch.tensor([-2., -2., 2., 2.]) * stride
+        anchors.append(BoxList(anchor_boxes, image_size, mode="xyxy"))
+        # the head emits bf16 under autocast
+        box_regression.append(torch.randn(2, 4, H, W).bfloat16())
+        centerness.append(torch.randn(2, 1, H, W).bfloat16())
+        dot_product_logits.append(torch.randn(2, H * W, num_tokens).bfloat16())
+    anchors = [anchors, anchors]
+    # multi-token labels, MEAN aggregates them with a matmul
+    positive_map = {1: [1, 2, 3], 2: [4], 3: [6, 7, 8, 9, 10]}
+
+    def select(outputs):
+        with torch.no_grad():
+            return VLDyHeadModule._forward_test(head, outputs[0], outputs[1], anchors,
+                                                dot_product_logits=outputs[2], positive_map=positive_map)[0]
+
+    ref = select([[o.float() for o in outputs] for outputs in (box_regression, centerness, dot_product_logits)])
+    with inference_autocast("cpu", "bf16"):
+        out = select((box_regression, centerness, dot_product_logits))
+    # box selection runs in fp32 on the same values, whatever the autocast state
+    for o, r in zip(out, ref):
+        assert len(r) > 0
+        assert torch.equal(o.get_field("labels"), r.get_field("labels"))
+        assert o.bbox.dtype == torch.float32
+        assert torch.allclose(o.bbox, r.bbox)
+        assert torch.allclose(o.get_field("scores"), r.get_field("scores"))
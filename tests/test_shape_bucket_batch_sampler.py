@@ -0,0 +1,38 @@
+import torch
+from torch.utils.data.sampler import RandomSampler, SequentialSampler
+
+from maskrcnn_benchmark.data.samplers.shape_bucket_batch_sampler import ShapeBucketBatchSampler
+
+
+class _NoIterSampler(SequentialSampler):
+    def __iter__(self):
+        raise AssertionError("len() must not run the sampler")
+
+
+def _shapes(num_items, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    choices = [(800, 1333), (1333, 800), (800, 800)]
+    return [choices[i] for i in torch.randint(0, len(choices), (num_items,), generator=generator).tolist()]
+
+
+def test_batches_share_a_shape():
+    shapes = _shapes(100)
+    batch_sampler = ShapeBucketBatchSampler(RandomSampler(range(100)), shapes, batch_size=4, window=16)
+    batches = list(batch_sampler)
+    assert sorted(i for batch in batches for i in batch) == list(range(100))
+    for batch in batches:
+        assert len({shapes[i] for i in batch}) == 1
+
+
+def test_len_matches_without_early_flush():
+    shapes = _shapes(100)
+    for drop_uneven in (False, True):
+        # a window as large as the epoch never flushes a bucket early
+        batch_sampler = ShapeBucketBatchSampler(SequentialSampler(range(100)), shapes, batch_size=4,
+                                                window=100, drop_uneven=drop_uneven)
+        assert len(batch_sampler) == len(list(batch_sampler))
+
+
+def test_len_does_not_iterate():
+    batch_sampler = ShapeBucketBatchSampler(_NoIterSampler(range(10)), _shapes(10), batch_size=3)
+    assert len(batch_sampler) == len(batch_sampler) > 0
@@ -0,0 +1,49 @@
+import json
+import time
+
+from maskrcnn_benchmark.utils.shard_queue import ShardQueue, load_partial_groundings
+
+
+def _record(sample_id):
+    return {"SAMPLE_ID": sample_id, "groundings": {"a dog": {"2": [[0.1, 0.2, 0.3, 0.4]]}}}
+
+
+def test_resume_from_truncated_tail(tmp_path):
+    path = tmp_path / "0.groundings.partial.jsonl"
+    complete = "".join(json.dumps(_record(i)) + "\n" for i in range(2))
+    # a crash in the middle of writing the third record
+    path.write_text(complete + json.dumps(_record(2))[:17], encoding="utf-8")
+
+    groundings = load_partial_groundings(str(path))
+    assert [g["SAMPLE_ID"] for g in groundings] == [0, 1]
+    assert groundings[0]["groundings"] == {"a dog": {2: [[0.1, 0.2, 0.3, 0.4]]}}
+    assert path.read_text(encoding="utf-8") == complete
+
+    # the restarted run appends, then crashes again, nothing written after the first crash is lost
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(_record(3)) + "\n")
+        f.write(json.dumps(_record(4))[:5])
+    groundings = load_partial_groundings(str(path))
+    assert [g["SAMPLE_ID"] for g in groundings] == [0, 1, 3]
+
+
+def test_missing_file(tmp_path):
+    assert load_partial_groundings(str(tmp_path / "missing.jsonl")) == []
+
+
+def test_renew_only_own_claim(tmp_path):
+    queue_dir = str(tmp_path / "queue")
+    first = ShardQueue(queue_dir, ["0"], worker=0, lease=0)
+    second = ShardQueue(queue_dir, ["0"], worker=1, lease=0)
+    assert first.claim() == "0"
+    assert first.renew("0")
+
+    # the lease ran out, the second worker steals the shard
+    time.sleep(0.01)
+    assert second.claim() == "0"
+    assert not first.renew("0")
+    assert second.renew("0")
+
+    second.complete("0")
+    assert not second.renew("0")
+    assert first.claim() is None
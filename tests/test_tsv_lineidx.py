@@ -0,0 +1,45 @@
+import os
+
+from maskrcnn_benchmark.data.datasets.tsv import TSVFile, load_seq_file
+
+
+def _write_tsv(path, rows):
+    path.write_text("".join("\t".join(row) + "\n" for row in rows), encoding="utf-8")
+
+
+def _touch_newer(path, than):
+    mtime = os.path.getmtime(than) + 10
+    os.utime(path, (mtime, mtime))
+
+
+def test_lineidx_bin_rebuilt_when_tsv_changes(tmp_path):
+    tsv_file = tmp_path / "a.tsv"
+    _write_tsv(tsv_file, [("0", "a"), ("1", "bb")])
+    assert [row[1] for row in TSVFile(str(tsv_file), generate_lineidx=True)] == ["a", "bb"]
+
+    _write_tsv(tsv_file, [("0", "ccc"), ("1", "d"), ("2", "eeee")])
+    _touch_newer(tsv_file, str(tmp_path / "a.lineidx.bin"))
+    assert [row[1] for row in TSVFile(str(tsv_file))] == ["ccc", "d", "eeee"]
+
+
+def test_lineidx_bin_reconverted_when_text_lineidx_changes(tmp_path):
+    tsv_file = tmp_path / "a.tsv"
+    lineidx = tmp_path / "a.lineidx"
+    _write_tsv(tsv_file, [("0", "a"), ("1", "bb")])
+    lineidx.write_text("0\n4\n")
+    assert len(TSVFile(str(tsv_file))) == 2
+
+    _write_tsv(tsv_file, [("0", "a"), ("1", "bb"), ("2", "c")])
+    lineidx.write_text("0\n4\n9\n")
+    _touch_newer(lineidx, str(tmp_path / "a.lineidx.bin"))
+    assert [row[1] for row in TSVFile(str(tsv_file))] == ["a", "bb", "c"]
+
+
+def test_seq_bin_reconverted_when_seq_file_changes(tmp_path):
+    seq_file = tmp_path / "a.seq"
+    seq_file.write_text("0\t0\n1\t5\n")
+    assert load_seq_file(str(seq_file)).tolist() == [(0, 0), (1, 5)]
+
+    seq_file.write_text("1\t2\n0\t3\n0\t4\n")
+    _touch_newer(seq_file, str(tmp_path / "a.seq.bin"))
+    assert load_seq_file(str(seq_file)).tolist() == [(1, 2), (0, 3), (0, 4)]
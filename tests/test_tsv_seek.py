@@ -0,0 +1,67 @@
+import base64
+import io
+import os
+
+import pytest
+from PIL import Image
+
+from maskrcnn_benchmark.data.datasets.tsv import TSVDataset, TSVFile, create_raw_image_file
+
+
+def _write_tsv(path, rows):
+    path.write_text("".join("\t".join(row) + "\n" for row in rows), encoding="utf-8")
+
+
+def _png_base64(color, size=(4, 3)):
+    buf = io.BytesIO()
+    Image.new("RGB", size, color).save(buf, format="PNG")
+    return base64.b64encode(buf.getvalue()).decode("ascii")
+
+
+def test_seek_columns_match_seek(tmp_path):
+    tsv_file = tmp_path / "a.tsv"
+    rows = [("0", "plain"), (" 1 ", "  padded\t", "x"), ("2", ""), ("3", "{\"a\": \"é\"}")]
+    # the last row has no trailing newline
+    tsv_file.write_text("".join("\t".join(row) + "\n" for row in rows) + "4\tlast", encoding="utf-8")
+    tsv = TSVFile(str(tsv_file), generate_lineidx=True)
+    assert len(tsv) == len(rows) + 1
+    for i in range(len(tsv)):
+        columns = [bytes(column).decode("utf-8") for column in tsv.seek_columns(i)]
+        assert columns == tsv.seek(i)
+
+
+def test_raw_image_sidecar(tmp_path):
+    img_file = tmp_path / "img.tsv"
+    _write_tsv(img_file, [("0", _png_base64("red")), ("1", _png_base64("blue"))])
+    create_raw_image_file(str(img_file))
+    dataset = TSVDataset(str(img_file))
+    assert dataset.raw_img is not None
+    assert dataset.get_image(1).getpixel((0, 0)) == (0, 0, 255)
+
+    # the image tsv is rewritten after the sidecar was built, the images come from the tsv again
+    _write_tsv(img_file, [("0", _png_base64("green")), ("1", _png_base64("white"))])
+    mtime = os.path.getmtime(str(tmp_path / "img.rawimg.idx")) + 10
+    os.utime(str(img_file), (mtime, mtime))
+    dataset = TSVDataset(str(img_file))
+    assert dataset.raw_img is None
+    assert dataset.get_image(1).getpixel((0, 0)) == (255, 255, 255)
+
+
+@pytest.mark.skipif(not os.path.isdir("/proc/self/fd"), reason="needs /proc")
+def test_mapped_file_keeps_one_descriptor(tmp_path):
+    tsv_file = tmp_path / "a.tsv"
+    _write_tsv(tsv_file, [("0", "a"), ("1", "bb")])
+    tsv = TSVFile(str(tsv_file), generate_lineidx=True)
+    assert tsv.seek(1) == ["1", "bb"]
+
+    # only the map is kept, with the descriptor mmap duplicates for itself
+    def open_fds():
+        fds = []
+        for fd in os.listdir("/proc/self/fd"):
+            try:
+                fds.append(os.readlink(os.path.join("/proc/self/fd", fd)))
+            except OSError:
+                pass
+        return fds
+    assert open_fds().count(str(tsv_file)) == 1
+    assert tsv.seek(0) == ["0", "a"]